@@ -0,0 +1,1307 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the box building tools.
+
+None of the benchmarks need VirtualBox, Vagrant or a device image, stand-ins
+are used instead.
+
+    vboxmanage   VM definition: one VBoxManage call per setting (as the
+                 builder used to do) vs. the batched VMSpec calls, against a
+                 fake VBoxManage with a configurable per-call latency
+    remaster     serial console ISO: csr_iso_modify.sh (mount, copy, mkisofs)
+                 vs. iso_remaster.py, on a synthetic ISO laid out like the
+                 CSR 1000v one
+    pack         box compression: tar and gzip on one core (as "vagrant
+                 package" does) vs. box_packer.py on all cores, on a
+                 synthetic disk
+    export       disk export: the whole dynamic VDI as a flat stream vs.
+                 sparse_disk.py walking the block map, on a synthetic VDI
+    catalog      adding a built box to a Vagrant catalog with tens to
+                 hundreds of versions
+    console      configure_xe() (line by line and --bulk) and configure_nx()
+                 against the device simulator of console_sim.py: boot wait,
+                 configuration time and console round trips
+    transport    console round trips through socat and a pty vs.
+                 console_transport.py on the socket
+    fleet        many simulated consoles configured one after another vs.
+                 all at once by console_async.py
+    bootwait     CPU spent waiting for the boot marker through a verbose
+                 simulated boot: pexpect's expect vs. expect_window, with
+                 and without the console transcript
+    nxpath       getting the NX-OS source box running and cleaned up again:
+                 vagrant box add/up/halt/destroy/box remove vs. importing
+                 the box into VirtualBox, against fake vagrant and
+                 VBoxManage commands that do the file work of the real ones
+    topology     time and disk space until all nodes of a lab answer SSH:
+                 vagrant up vs. topology.py with linked clones, against the
+                 same fakes and guests that answer after a fixed boot time
+'''
+
+from __future__ import print_function
+import sys
+import os
+import time
+import shutil
+import tempfile
+import struct
+import argparse
+import subprocess
+import textwrap
+
+# Per call latency of the fake VBoxManage, a real VBoxManage spends about
+# this long on process start and the round trip to VBoxSVC.
+VBOXMANAGE_LATENCY = 0.08
+
+# Per call start-up of a fake vagrant: Ruby, the gems and the plugins are
+# loaded and the environment is checked before any command runs.
+VAGRANT_LATENCY = 2.0
+
+FAKE_VBOXMANAGE = '''#!/bin/sh
+sleep %s
+'''
+
+
+def fake_vboxmanage(latency):
+    """
+    Put a fake VBoxManage first on the PATH, return its folder.
+    """
+
+    bin_dir = tempfile.mkdtemp(prefix='fake_vbox_')
+    path = os.path.join(bin_dir, 'VBoxManage')
+    with open(path, 'w') as f:
+        f.write(FAKE_VBOXMANAGE % latency)
+    os.chmod(path, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    return bin_dir
+
+
+def bench_run(cmd, hide_error=False, cont_on_error=False):
+    subprocess.check_call(cmd)
+    return b''
+
+
+def timed(cmds):
+    start = time.time()
+    for cmd in cmds:
+        bench_run(cmd)
+    return time.time() - start
+
+
+def legacy_vm_commands(vmname, base_dir, vbox, vdi, iso, console_port):
+    """
+    The VM definition as iosxe_iso2vbox.py used to issue it.
+    """
+
+    return [
+        ['VBoxManage', 'createvm', '--name', vmname, '--ostype', 'Linux26_64', '--basefolder', base_dir],
+        ['VBoxManage', 'registervm', vbox],
+        ['VBoxManage', 'modifyvm', vmname, '--vram', '4'],
+        ['VBoxManage', 'modifyvm', vmname, '--memory', '4096', '--acpi', 'on'],
+        ['VBoxManage', 'modifyvm', vmname, '--nic1', 'nat', '--nictype1', 'virtio'],
+        ['VBoxManage', 'modifyvm', vmname, '--cableconnected1', 'on'],
+        ['VBoxManage', 'modifyvm', vmname, '--uart1', '0x3f8', '4', '--uartmode1', 'tcpserver', str(console_port)],
+        ['VBoxManage', 'modifyvm', vmname, '--uart2', '0x2f8', '3', '--uartmode2', 'disconnected'],
+        ['VBoxManage', 'createhd', '--filename', vdi, '--size', '8192'],
+        ['VBoxManage', 'storagectl', vmname, '--name', 'IDE_Controller', '--add', 'ide'],
+        ['VBoxManage', 'storageattach', vmname, '--storagectl', 'IDE_Controller', '--port', '0', '--device', '0', '--type', 'hdd', '--medium', vdi],
+        ['VBoxManage', 'showhdinfo', vdi],
+        ['VBoxManage', 'storageattach', vmname, '--storagectl', 'IDE_Controller', '--port', '1', '--device', '0', '--type', 'dvddrive', '--medium', iso],
+        ['VBoxManage', 'modifyvm', vmname, '--boot1', 'disk'],
+        ['VBoxManage', 'modifyvm', vmname, '--boot2', 'dvd'],
+        # before export
+        ['VBoxManage', 'modifyvm', vmname, '--uart1', 'off'],
+        ['VBoxManage', 'modifyvm', vmname, '--uart2', 'off'],
+    ]
+
+
+def spec_vm_commands(vmname, base_dir, vbox, vdi, iso, console_port):
+    """
+    The VM definition as iosxe_iso2vbox.py issues it now.
+    """
+
+    import iosxe_iso2vbox
+    import vboxmanage
+
+    spec = iosxe_iso2vbox.xe_vm_spec(vmname, 4096, 16.7, console_port, vdi, iso)
+    uarts_off = vboxmanage.VMSpec(vmname).modify('--uart1', 'off').modify('--uart2', 'off')
+    return ([['VBoxManage', 'createhd', '--filename', vdi, '--size', '8192'],
+             ['VBoxManage', 'createvm', '--name', vmname, '--ostype', 'Linux26_64',
+              '--basefolder', base_dir, '--register']] +
+            spec.commands() + uarts_off.commands())
+
+
+def rerun_vm_commands(vmname, vdi, iso, console_port):
+    """
+    Re-applying the spec to a VM that already matches it.
+    """
+
+    import iosxe_iso2vbox
+    import vboxmanage
+
+    current = {
+        'vram': '4', 'memory': '4096', 'acpi': 'on', 'nic1': 'nat',
+        'nictype1': 'virtio', 'cableconnected1': 'on',
+        'uart1': '0x03f8,4', 'uartmode1': 'tcpserver,%d' % console_port,
+        'uart2': '0x02f8,3', 'uartmode2': 'disconnected',
+        'boot1': 'disk', 'boot2': 'dvd',
+        'storagecontrollername0': 'IDE_Controller',
+        'IDE_Controller-0-0': vdi, 'IDE_Controller-1-0': iso,
+    }
+    spec = iosxe_iso2vbox.xe_vm_spec(vmname, 4096, 16.7, console_port, vdi, iso)
+    # one showvminfo to read the current state
+    return [['VBoxManage', 'showvminfo', vmname, '--machinereadable']] + \
+        spec.commands(current)
+
+
+def vboxmanage_benchmark(args):
+    bin_dir = fake_vboxmanage(args.latency)
+    try:
+        vmname = 'csr1000v-universalk9.16.07.01'
+        base_dir = '/tmp/created_boxes'
+        box_dir = os.path.join(base_dir, vmname)
+        vbox = os.path.join(box_dir, vmname + '.vbox')
+        vdi = os.path.join(box_dir, vmname + '.vdi')
+        iso = '/tmp/%s.iso' % vmname
+
+        runs = [
+            ('call per setting', legacy_vm_commands(vmname, base_dir, vbox, vdi, iso, 65000)),
+            ('VMSpec', spec_vm_commands(vmname, base_dir, vbox, vdi, iso, 65000)),
+            ('VMSpec, unchanged VM', rerun_vm_commands(vmname, vdi, iso, 65000)),
+        ]
+
+        print('Fake VBoxManage latency: %.0f ms per call' % (args.latency * 1000))
+        print('%-22s  %5s  %8s' % ('', 'CALLS', 'TIME'))
+        for name, cmds in runs:
+            best = min(timed(cmds) for _ in range(args.repeat))
+            print('%-22s  %5d  %7.2fs' % (name, len(cmds), best))
+    finally:
+        shutil.rmtree(bin_dir)
+
+
+SECTOR = 2048
+
+GRUB_MENU_LST = b'''default 0
+timeout 5
+
+title CSR1000v - packages.conf
+root (cd)
+kernel /csr1000v-rpboot.SPA.pkg
+title CSR1000v - packages.conf (serial console)
+root (cd)
+kernel /csr1000v-rpboot.SPA.pkg console=ttyS0
+'''
+
+
+def _both(fmt, value):
+    """
+    ISO9660 both-endian number: little endian, then big endian.
+    """
+
+    return struct.pack('<' + fmt, value) + struct.pack('>' + fmt, value)
+
+
+def _dir_record(name, lba, size, is_dir):
+    length = 33 + len(name) + (1 - len(name) % 2)
+    return (struct.pack('<BB', length, 0) + _both('I', lba) + _both('I', size) +
+            b'\x00' * 7 + struct.pack('<BBB', 2 if is_dir else 0, 0, 0) +
+            _both('H', 1) + struct.pack('<B', len(name)) + name +
+            b'\x00' * (1 - len(name) % 2))
+
+
+def _directory(lba, parent, entries):
+    data = _dir_record(b'\x00', lba, SECTOR, True) + \
+        _dir_record(b'\x01', parent, SECTOR, True)
+    for name, entry_lba, size, is_dir in entries:
+        data += _dir_record(name, entry_lba, size, is_dir)
+    return data.ljust(SECTOR, b'\x00')
+
+
+def make_test_iso(path, package_mb):
+    """
+    Write a minimal ISO9660 image with /boot/grub/menu.lst and a package of
+    package_mb MB, like the CSR 1000v ISO.
+    """
+
+    path_l, path_m, root, boot, grub, menu, package = 18, 19, 20, 21, 22, 23, 24
+    package_size = package_mb * 1024 * 1024
+    sectors = package + (package_size + SECTOR - 1) // SECTOR
+
+    # path tables, little and big endian: root, /BOOT, /BOOT/GRUB
+    tables = []
+    for order in '<>':
+        table = b''
+        for name, lba, parent in ((b'\x00', root, 1), (b'BOOT', boot, 1),
+                                  (b'GRUB', grub, 2)):
+            table += struct.pack(order + 'BBIH', len(name), 0, lba, parent) + \
+                name + b'\x00' * (len(name) % 2)
+        tables.append(table)
+
+    pvd = bytearray(SECTOR)
+    pvd[0:7] = b'\x01CD001\x01'
+    pvd[40:72] = b'CSR1000V'.ljust(32)
+    pvd[80:88] = _both('I', sectors)
+    pvd[120:124] = _both('H', 1)
+    pvd[124:128] = _both('H', 1)
+    pvd[128:132] = _both('H', SECTOR)
+    pvd[132:140] = _both('I', len(tables[0]))
+    pvd[140:144] = struct.pack('<I', path_l)
+    pvd[148:152] = struct.pack('>I', path_m)
+    pvd[156:190] = _dir_record(b'\x00', root, SECTOR, True)
+    pvd[881] = 1
+    terminator = b'\xffCD001\x01'.ljust(SECTOR, b'\x00')
+
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * 16 * SECTOR)
+        f.write(bytes(pvd))
+        f.write(terminator)
+        for table in tables:
+            f.write(table.ljust(SECTOR, b'\x00'))
+        f.write(_directory(root, root, [
+            (b'BOOT', boot, SECTOR, True),
+            (b'CSR1000V.PKG;1', package, package_size, False)]))
+        f.write(_directory(boot, root, [(b'GRUB', grub, SECTOR, True)]))
+        f.write(_directory(grub, boot, [
+            (b'MENU.LST;1', menu, len(GRUB_MENU_LST), False)]))
+        f.write(GRUB_MENU_LST.ljust(SECTOR, b'\x00'))
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(package_mb):
+            f.write(chunk)
+        f.truncate(sectors * SECTOR)
+
+
+def _which(program):
+    for folder in os.environ['PATH'].split(os.pathsep):
+        if os.access(os.path.join(folder, program), os.X_OK):
+            return True
+    return False
+
+
+def remaster_benchmark(args):
+    import iso_remaster
+
+    work_dir = tempfile.mkdtemp(prefix='remaster_', dir=args.dir)
+    try:
+        iso = os.path.join(work_dir, 'csr1000v-universalk9.16.07.01.iso')
+        make_test_iso(iso, args.size)
+        size = os.path.getsize(iso)
+        print('Synthetic ISO: %d MB in %s' % (size // 1024 ** 2, work_dir))
+        print('%-34s  %8s  %10s' % ('', 'TIME', 'WRITTEN'))
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'csr_iso_modify.sh')
+        if sys.platform.startswith('linux') and _which('mkisofs') and _which('sudo'):
+            start = time.time()
+            subprocess.check_call(['bash', script, iso], cwd=work_dir,
+                                  stdout=open(os.devnull, 'w'))
+            print('%-34s  %7.2fs  %7d MB' % ('csr_iso_modify.sh', time.time() - start,
+                                           2 * size // 1024 ** 2))
+        else:
+            # what the script writes at least: the copied tree and the new image
+            copy = os.path.join(work_dir, 'copy.iso')
+            start = time.time()
+            for _ in range(2):
+                shutil.copyfile(iso, copy)
+                os.remove(copy)
+            print('%-34s  %7.2fs  %7d MB' % ('2 full copies (no mkisofs/sudo)',
+                                           time.time() - start, 2 * size // 1024 ** 2))
+
+        output = os.path.join(work_dir, 'serial-csr1000v-universalk9.16.07.01.iso')
+        start = time.time()
+        stats = iso_remaster.remaster(iso, output)
+        written = stats['sectors'] * iso_remaster.SECTOR
+        if stats['clone'] == 'copy':
+            written += size
+        print('%-34s  %7.2fs  %7d MB' % ('iso_remaster.py (%s)' % stats['clone'],
+                                       time.time() - start, written // 1024 ** 2))
+        with open(output, 'rb') as f:
+            lba, menu_size = iso_remaster.find(f, iso_remaster.GRUB_MENU)
+            f.seek(lba * iso_remaster.SECTOR)
+            assert f.read(menu_size).startswith(b'default 1')
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def make_test_disk(path, size_mb):
+    """
+    Write a disk image of size_mb MB that compresses about like an exported
+    IOS XE disk: packages that barely compress, text and empty space.
+    """
+
+    noise = os.urandom(1024 * 1024)
+    text = (b'interface GigabitEthernet1\n ip address dhcp\n negotiation auto\n'
+            * 20000)[:1024 * 1024]
+    zeros = b'\x00' * 1024 * 1024
+    with open(path, 'wb') as f:
+        for mb in range(size_mb):
+            f.write((noise, text, text, zeros)[mb % 4])
+
+
+def make_test_vdi(path, size_mb, used_mb):
+    """
+    Write a dynamic VDI of size_mb MB with used_mb MB of 1 MB blocks
+    allocated, spread over the disk, a quarter of them zeroed again (as
+    deleted files look after a compact).
+    """
+
+    block = 1024 * 1024
+    header_size = 512
+    blocks_offset = header_size
+    data_offset = blocks_offset + ((4 * size_mb + block - 1) // block) * block
+    step = max(size_mb // max(used_mb, 1), 1)
+    used = list(range(0, size_mb, step))[:used_mb]
+
+    header = bytearray(header_size)
+    header[0:40] = b'<<< Oracle VM VirtualBox Disk Image >>>\n'
+    header[64:72] = struct.pack('<II', 0xbeda107f, 0x00010001)
+    header[72:84] = struct.pack('<III', 400, 1, 0)
+    header[340:348] = struct.pack('<II', blocks_offset, data_offset)
+    header[368:392] = struct.pack('<QIIII', size_mb * block, block, 0,
+                                  size_mb, len(used))
+    block_map = [0xffffffff] * size_mb
+    for index, number in enumerate(used):
+        block_map[number] = index
+
+    noise = os.urandom(block)
+    text = (b'interface GigabitEthernet1\n ip address dhcp\n' * 30000)[:block]
+    with open(path, 'wb') as f:
+        f.write(bytes(header))
+        f.write(struct.pack('<%dI' % size_mb, *block_map))
+        f.seek(data_offset)
+        for index in range(len(used)):
+            f.write((noise, text, text, b'\x00' * block)[index % 4])
+
+
+def export_benchmark(args):
+    import sparse_disk
+    import box_packer
+
+    work_dir = tempfile.mkdtemp(prefix='export_', dir=args.dir)
+    try:
+        vdi = os.path.join(work_dir, 'disk.vdi')
+        make_test_vdi(vdi, args.size, args.used)
+        print('Synthetic VDI: %d MB logical, %d MB allocated, %d MB on disk' % (
+            args.size, args.used, os.path.getsize(vdi) // 1024 ** 2))
+        print('%-28s  %8s  %8s  %8s' % ('', 'TIME', 'READ', 'OUTPUT'))
+
+        # flat: every logical byte is read and compressed, zeros included
+        reader = sparse_disk.open_disk(vdi)
+        output = os.path.join(work_dir, 'flat.gz')
+        start = time.time()
+        with open(output, 'wb') as f:
+            writer = box_packer.ParallelGzipWriter(f, threads=args.threads)
+            zero = b'\x00' * reader.block_size
+            position = 0
+            for offset, data in reader.extents():
+                for position in range(position, offset, reader.block_size):
+                    writer.write(zero)
+                writer.write(data)
+                position = offset + len(data)
+            for position in range(position, reader.size, reader.block_size):
+                writer.write(zero)
+            writer.close()
+        print('%-28s  %7.2fs  %5d MB  %5d MB' % (
+            'flat stream, gzip', time.time() - start, reader.size // 1024 ** 2,
+            os.path.getsize(output) // 1024 ** 2))
+        reader.close()
+
+        output = os.path.join(work_dir, 'disk.vmdk')
+        start = time.time()
+        with open(output, 'wb') as f:
+            stats = sparse_disk.export_vmdk(vdi, f, args.threads or box_packer.cpu_count())
+        print('%-28s  %7.2fs  %5d MB  %5d MB' % (
+            'block map, streamOptimized', time.time() - start,
+            stats['allocated'] // 1024 ** 2, os.path.getsize(output) // 1024 ** 2))
+
+        # the VMDK has to read back as the VDI
+        exported = dict(sparse_disk.grains(sparse_disk.open_disk(output)))
+        assert exported == dict(sparse_disk.grains(sparse_disk.open_disk(vdi)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def pack_benchmark(args):
+    import box_packer
+
+    work_dir = tempfile.mkdtemp(prefix='pack_', dir=args.dir)
+    try:
+        ovf = os.path.join(work_dir, 'box.ovf')
+        with open(ovf, 'w') as f:
+            f.write('<?xml version="1.0"?>\n<Envelope/>\n')
+        disk = os.path.join(work_dir, 'box-disk001.vmdk')
+        make_test_disk(disk, args.size)
+        files = [('box.ovf', ovf), ('box-disk001.vmdk', disk)]
+        size_mb = os.path.getsize(disk) / 1024.0 ** 2
+        print('Synthetic disk: %d MB, %d CPUs' % (size_mb, box_packer.cpu_count()))
+        print('%-28s  %8s  %8s  %9s' % ('', 'TIME', 'SIZE', 'MB/s'))
+
+        def report(name, seconds, output):
+            print('%-28s  %7.2fs  %6d MB  %9.0f' % (
+                name, seconds, os.path.getsize(output) // 1024 ** 2,
+                size_mb / max(seconds, 0.001)))
+            os.remove(output)
+
+        output = os.path.join(work_dir, 'out.box')
+        start = time.time()
+        if _which('bsdtar'):
+            name = 'bsdtar -czf (one core)'
+            subprocess.check_call(['bsdtar', '-czf', output, '-C', work_dir,
+                                   'box.ovf', 'box-disk001.vmdk'])
+        else:
+            name = 'tar + gzip (one core)'
+            box_packer.write_box(output, files, '080027000000',
+                                 compression='gzip', threads=1)
+        report(name, time.time() - start, output)
+
+        variants = [('box_packer gzip', 'gzip')]
+        if box_packer.zstandard is not None or _which('zstd'):
+            variants.append(('box_packer zstd', 'zstd'))
+        for name, compression in variants:
+            stats = box_packer.write_box(output, files, '080027000000',
+                                         compression=compression,
+                                         threads=args.threads)
+            report(name, stats['seconds'], output)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def catalog_benchmark(args):
+    import box_catalog
+
+    work_dir = tempfile.mkdtemp(prefix='catalog_', dir=args.dir)
+    try:
+        box = os.path.join(work_dir, 'out.box')
+        with open(box, 'wb') as f:
+            f.write(b'box')
+        checksum = '0' * 64
+        print('%-32s  %8s  %8s' % ('', 'TIME', 'SIZE'))
+        path = box_catalog.catalog_path(work_dir, 'iosxe')
+        catalog = box_catalog.Catalog(path, 'iosxe')
+        count = 0
+        for versions in (10, 100, args.versions):
+            for count in range(count, versions):
+                catalog.add('16.%d.%02d' % (count // 100, count % 100),
+                            'file:///box', checksum)
+            count = versions
+            best = None
+            for number in range(args.repeat):
+                start = time.time()
+                box_catalog.add_box(work_dir, 'iosxe', '99.%d' % number, box,
+                                    checksum)
+                seconds = time.time() - start
+                best = seconds if best is None else min(best, seconds)
+                catalog.remove('99.%d' % number)
+            print('%-32s  %6.1fms  %5d KB' % (
+                'add to %d versions' % versions, best * 1000,
+                os.path.getsize(path) // 1024))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def console_benchmark(args):
+    import logging
+    import console_sim
+    import console_transport
+    import iosxe_iso2vbox
+    import nxosv_vbox_prep
+
+    class CountingSpawn(console_transport.ConsoleSpawn):
+        """
+        Console child counting expects (round trips) and lines sent.
+        """
+
+        expects = 0
+        lines = 0
+
+        def expect_list(self, *args, **kwargs):
+            self.expects += 1
+            return console_transport.ConsoleSpawn.expect_list(self, *args, **kwargs)
+
+        def sendline(self, s=''):
+            self.lines += 1
+            return console_transport.ConsoleSpawn.sendline(self, s)
+
+    work_dir = tempfile.mkdtemp(prefix='console_')
+    cases = [
+        ('IOS XE line by line', 'iosxe', iosxe_iso2vbox.configure_xe, {}, {}),
+        ('IOS XE --bulk', 'iosxe', iosxe_iso2vbox.configure_xe, {'bulk': True}, {}),
+        ('NX-OS', 'nxos', nxosv_vbox_prep.configure_nx, {}, {}),
+        # show version without the image, two images on the bootflash
+        ('NX-OS, guest shell', 'nxos', nxosv_vbox_prep.configure_nx, {},
+         {'show_image': False, 'images': ['nxos.7.0.3.I7.1.bin', 'nxos.7.0.3.I6.1.bin']}),
+    ]
+    print('%d baud, %.0f ms per line, %.1f s boot' % (
+        args.baud, args.line_latency * 1000, args.boot_time))
+    print('%-22s  %8s  %8s  %7s  %6s' % ('', 'BOOT', 'CONFIG', 'EXPECTS', 'LINES'))
+    # the configuration engines log every line
+    logging.disable(logging.WARNING)
+    try:
+        for name, platform, configure, kwargs, device in cases:
+            address = ('unix:' + os.path.join(work_dir, 'console')
+                       if platform == 'nxos' else 'tcp:%d' % iosxe_iso2vbox.free_port())
+            server = console_sim.serve(platform, address, args.baud, args.line_latency,
+                                       args.boot_time, service_time=args.service_time)
+            for attribute, value in device.items():
+                setattr(server.device, attribute, value)
+            child = CountingSpawn(address, timeout=600)
+            try:
+                start = time.time()
+                timings = configure(console=child, **kwargs)
+                seconds = time.time() - start
+            finally:
+                child.close()
+                server.stop()
+            boot = dict(timings)['boot']
+            print('%-22s  %7.2fs  %7.2fs  %7d  %6d' % (
+                name, boot, seconds - boot, child.expects, child.lines))
+    finally:
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(work_dir)
+
+
+# Stand-in for socat when it isn't installed: the same copy loop between a
+# raw pty and the socket, in a process of its own
+RELAY = '''
+import os, sys, socket, select, tty
+tty.setraw(0)
+s = socket.create_connection(('127.0.0.1', int(sys.argv[1])))
+while True:
+    r = select.select([0, s], [], [])[0]
+    if 0 in r:
+        d = os.read(0, 4096)
+        if not d:
+            break
+        s.sendall(d)
+    if s in r:
+        d = s.recv(4096)
+        if not d:
+            break
+        os.write(1, d)
+'''
+
+
+def echo_server():
+    """
+    Start a TCP echo server in a thread, return its port.
+    """
+
+    import socket
+    import threading
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+
+    def echo(sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            sock.sendall(data)
+        sock.close()
+
+    def serve():
+        while True:
+            sock, _ = listener.accept()
+            thread = threading.Thread(target=echo, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return listener.getsockname()[1]
+
+
+def _process_cpu(pid):
+    """
+    CPU seconds of a running process, 0 where /proc isn't there.
+    """
+
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def transport_benchmark(args):
+    import pexpect
+    import console_transport
+
+    port = echo_server()
+    if _which('socat'):
+        relay = ('socat', 'socat TCP:localhost:%d -,raw,echo=0,escape=0x1d' % port)
+    else:
+        relay = ('python relay (no socat)', '%s -c "%s" %d' % (
+            sys.executable, RELAY.replace('"', '\\"'), port))
+    print('%d one byte round trips through a TCP echo server, CPU of all processes'
+          % args.count)
+    print('%-30s  %10s  %10s  %9s' % ('', 'ROUND TRIP', 'CPU', 'PROCESSES'))
+    def spawn_relay():
+        child = pexpect.spawn(relay[1])
+        # by default pexpect.spawn sleeps 50 ms before every send
+        child.delaybeforesend = None
+        return child
+
+    for name, spawn, processes in [
+            (relay[0] + ' + pty', spawn_relay, 1),
+            ('console_transport', lambda: console_transport.ConsoleSpawn('tcp:%d' % port), 0)]:
+        child = spawn()
+        # settle: the relay is connected once the first byte comes back
+        child.send(b'.')
+        child.expect_exact(b'.', timeout=10)
+        best = None
+        for _ in range(args.repeat):
+            cpu = sum(os.times()[:2]) + _process_cpu(child.pid or 0)
+            start = time.time()
+            for _ in range(args.count):
+                child.send(b'x')
+                child.expect_exact(b'x')
+            seconds = time.time() - start
+            cpu = sum(os.times()[:2]) + _process_cpu(child.pid or 0) - cpu
+            if best is None or seconds < best[0]:
+                best = (seconds, cpu)
+        child.close()
+        print('%-30s  %8.0fus  %8.0fus  %9d' % (
+            name, best[0] / args.count * 1e6, best[1] / args.count * 1e6, processes))
+
+
+def fleet_benchmark(args):
+    import logging
+    import threading
+    import console_sim
+    import console_async
+    import iosxe_iso2vbox
+
+    work_dir = tempfile.mkdtemp(prefix='fleet_')
+
+    def sessions(count):
+        servers = []
+        jobs = []
+        for number in range(count):
+            if number % 2:
+                platform, script = 'nxos', console_async.configure_nx
+                address = 'unix:' + os.path.join(work_dir, 'nx%d' % number)
+            else:
+                platform, script = 'iosxe', console_async.configure_xe
+                address = 'tcp:%d' % iosxe_iso2vbox.free_port()
+            servers.append(console_sim.serve(platform, address, args.baud,
+                                             args.line_latency, args.boot_time,
+                                             service_time=args.service_time))
+            jobs.append(console_async.Session('%s%d' % (platform, number), address,
+                                              script, timeout=600))
+        return servers, jobs
+
+    print('%d baud, %.0f ms per line, %.1f s boot, IOS XE and NX-OS alternating' % (
+        args.baud, args.line_latency * 1000, args.boot_time))
+    print('%-44s  %8s  %8s  %8s' % ('', 'WALL', 'SLOWEST', 'THREADS'))
+    logging.disable(logging.WARNING)
+    try:
+        for count, limit, name in [(2, 1, 'one after another'),
+                                   (args.sessions, None, 'all at once')]:
+            servers, jobs = sessions(count)
+            threads = threading.active_count() - len(servers)
+            try:
+                start = time.time()
+                failed = console_async.run_sessions(jobs, limit)
+                seconds = time.time() - start
+            finally:
+                for server in servers:
+                    server.stop()
+            if failed:
+                sys.exit('%s failed: %s' % (failed[0].name, failed[0].error))
+            if limit == 1:
+                # one IOS XE and one NX-OS, scaled to the whole fleet
+                seconds *= args.sessions / 2.0
+                name = '%s (2 run x %d)' % (name, args.sessions // 2)
+            print('%-44s  %7.1fs  %7.1fs  %8d' % (
+                '%d consoles, %s' % (args.sessions, name), seconds,
+                max(job.seconds for job in jobs), threads))
+    finally:
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(work_dir)
+
+
+def bootwait_benchmark(args):
+    import console_sim
+    import console_dialog
+    import console_log
+    import console_transport
+    import iosxe_iso2vbox
+
+    class CountingSpawn(console_transport.ConsoleSpawn):
+        """
+        Console child counting the bytes and reads it got.
+        """
+
+        received = 0
+        reads = 0
+
+        def read_nonblocking(self, size=1, timeout=-1):
+            data = console_transport.ConsoleSpawn.read_nonblocking(self, size, timeout)
+            self.received += len(data)
+            self.reads += 1
+            return data
+
+    work_dir = tempfile.mkdtemp(prefix='bootwait_')
+    sim = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'console_sim.py')
+    cases = [
+        ('expect', None, None),
+        ('expect, plain transcript', None, 'plain'),
+        ('expect_window', console_dialog.MARKER_WINDOW, None),
+        ('expect_window, console_log', console_dialog.MARKER_WINDOW, 'gzip'),
+    ]
+    print('IOS XE boot transcript x %d over %.0f s, %s baud' % (
+        args.boot_repeat, args.boot_time, args.baud or 'unlimited'))
+    print('%-28s  %8s  %7s  %8s  %8s  %9s' % (
+        '', 'OUTPUT', 'READS', 'WALL', 'CPU', 'KEPT'))
+    try:
+        for name, window, transcript in cases:
+            address = 'tcp:%d' % iosxe_iso2vbox.free_port()
+            server = subprocess.Popen(
+                [sys.executable, sim, 'iosxe', address, '--baud', str(args.baud),
+                 '--boot-time', str(args.boot_time), '--boot-repeat', str(args.boot_repeat)],
+                stderr=open(os.devnull, 'w'))
+            log_path = os.path.join(work_dir, 'console.log')
+            try:
+                child = CountingSpawn(address, timeout=600)
+                if transcript == 'plain':
+                    child.logfile = open(log_path, 'wb')
+                elif transcript == 'gzip':
+                    child.logfile = console_log.ConsoleLog(log_path)
+                step = console_dialog.Step('boot', iosxe_iso2vbox.XE_BOOT_MARKER,
+                                           timeout=600, window=window)
+                dialog = console_dialog.Dialog('boot wait')
+                cpu = sum(os.times()[:2])
+                start = time.time()
+                dialog.run(child, [step])
+                seconds = time.time() - start
+                if child.logfile is not None:
+                    child.logfile.close()
+                cpu = sum(os.times()[:2]) - cpu
+                kept = len(child.before)
+                child.close()
+            finally:
+                server.kill()
+                server.wait()
+            print('%-28s  %6.1fMB  %7d  %7.1fs  %7.2fs  %7.0fKB' % (
+                name, child.received / 1024.0 ** 2, child.reads, seconds, cpu,
+                kept / 1024.0))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+# Fake vagrant and VBoxManage for nxpath and topology: the start-up latency
+# of the real command, then the file work it does (extracting the box,
+# copying its disk into the VM folder, a linked clone only gets a new
+# differencing image), with the VMs kept as folders under $FAKE_STATE.  A
+# started VM is a guest process that answers on its forwarded SSH port
+# after $FAKE_BOOT seconds (never, if unset).
+FAKE_VM_TOOLS = r'''#!%(python)s
+import os, re, sys, time, json, signal, socket, shutil, tarfile, subprocess
+time.sleep(%(latency)s)
+state = os.environ['FAKE_STATE']
+vms = os.path.join(state, 'vms')
+boxes = os.path.join(state, 'boxes')
+args = sys.argv[1:]
+with open(os.path.join(state, 'calls'), 'a') as f:
+    f.write('%(tool)s %%s\n' %% ' '.join(args))
+
+GUEST = """
+import sys, time, socket
+time.sleep(float(sys.argv[2]))
+s = socket.socket()
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.bind(('127.0.0.1', int(sys.argv[1])))
+s.listen(5)
+while True:
+    c, _ = s.accept()
+    c.sendall(b'SSH-2.0-Fake\\r\\n')
+    c.close()
+"""
+
+
+def vm_file(name, key):
+    return os.path.join(vms, name, key)
+
+
+def set_vm(name, key, value):
+    with open(vm_file(name, key), 'w') as f:
+        f.write(value)
+
+
+def get_vm(name, key, default=None):
+    if default is not None and not os.path.exists(vm_file(name, key)):
+        return default
+    with open(vm_file(name, key)) as f:
+        return f.read()
+
+
+def new_vm(name, basefolder):
+    os.makedirs(os.path.join(vms, name))
+    folder = os.path.join(basefolder, name)
+    os.makedirs(folder)
+    with open(os.path.join(folder, name + '.vbox'), 'w') as f:
+        f.write('<VirtualBox/>\n')
+    set_vm(name, 'folder', folder)
+    set_vm(name, 'state', 'poweroff')
+    return folder
+
+
+def create_vm(name, source, basefolder):
+    folder = new_vm(name, basefolder)
+    for other in os.listdir(source):
+        if other.endswith('.vmdk'):
+            shutil.copyfile(os.path.join(source, other), os.path.join(folder, other))
+
+
+def start_vm(name):
+    set_vm(name, 'state', 'running')
+    for rule in json.loads(get_vm(name, 'forwards', '[]')):
+        fields = rule.split(',')
+        if fields[5] == '22' and os.environ.get('FAKE_BOOT'):
+            # keeps the guest off the output pipe of the caller
+            devnull = open(os.devnull, 'r+')
+            guest = subprocess.Popen([sys.executable, '-c', GUEST, fields[3],
+                                      os.environ['FAKE_BOOT']],
+                                     stdin=devnull, stdout=devnull, stderr=devnull)
+            set_vm(name, 'guest', str(guest.pid))
+
+
+def stop_vm(name):
+    if os.path.exists(vm_file(name, 'guest')):
+        try:
+            os.kill(int(get_vm(name, 'guest')), signal.SIGTERM)
+        except OSError:
+            pass
+        os.remove(vm_file(name, 'guest'))
+    set_vm(name, 'state', 'poweroff')
+
+
+def delete_vm(name):
+    if os.path.isdir(os.path.join(vms, name)):
+        stop_vm(name)
+        shutil.rmtree(get_vm(name, 'folder'))
+        shutil.rmtree(os.path.join(vms, name))
+
+
+def ssh_answers(port):
+    try:
+        s = socket.create_connection(('127.0.0.1', port), 1)
+    except socket.error:
+        return False
+    try:
+        return s.recv(64).startswith(b'SSH-')
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def up_machines(vagrantfile):
+    # one machine after the other, each waits for its SSH like vagrant does
+    box_dir = os.path.join(os.environ['VAGRANT_HOME'], 'boxes')
+    port = 2222
+    for number, define in enumerate(vagrantfile.split('config.vm.define "')[1:]):
+        machine = define.split('"')[0]
+        box = re.search(r'node.vm.box = "(.*)"', define).group(1)
+        ssh = re.search(r'guest: 22, host: (\d+)', define)
+        if ssh:
+            host = int(ssh.group(1))
+        else:
+            host = port
+            port += 1
+        name = '%%s_%%s_%%d' %% (os.path.basename(os.getcwd()), machine, time.time() * 1000)
+        create_vm(name, os.path.join(box_dir, box.replace('/', '-VAGRANTSLASH-'),
+                                     '0', 'virtualbox'),
+                  os.path.join(state, 'VirtualBox VMs'))
+        set_vm(name, 'forwards', json.dumps(['ssh,tcp,127.0.0.1,%%d,,22' %% host]))
+        machine_dir = os.path.join('.vagrant', 'machines', machine, 'virtualbox')
+        os.makedirs(machine_dir)
+        with open(os.path.join(machine_dir, 'id'), 'w') as f:
+            f.write(name)
+        start_vm(name)
+        while not ssh_answers(host):
+            time.sleep(0.5)
+
+
+if '%(tool)s' == 'vagrant':
+    if args[:2] == ['box', 'add']:
+        tar = tarfile.open(args[-1], 'r|*')
+        tar.extractall(os.path.join(boxes, args[-2]))
+        tar.close()
+    elif args[:2] == ['box', 'remove']:
+        shutil.rmtree(os.path.join(boxes, args[-1]))
+    elif args[0] == 'up' and 'config.vm.define' in open('Vagrantfile').read():
+        up_machines(open('Vagrantfile').read())
+    elif args[0] == 'up':
+        box = re.search(r'config.vm.box = "(.*)"', open('Vagrantfile').read()).group(1)
+        name = '%%s_default_%%d' %% (os.path.basename(os.getcwd()), time.time() * 1000)
+        create_vm(name, os.path.join(boxes, box), os.path.join(state, 'VirtualBox VMs'))
+        with open('.vagrant_vm', 'w') as f:
+            f.write(name)
+        set_vm(name, 'state', 'running')
+        # the guest never answers vagrant's SSH
+        sys.exit(1)
+    elif args[0] == 'destroy' and os.path.isdir('.vagrant'):
+        for machine in os.listdir(os.path.join('.vagrant', 'machines')):
+            path = os.path.join('.vagrant', 'machines', machine, 'virtualbox', 'id')
+            delete_vm(open(path).read())
+        shutil.rmtree('.vagrant')
+    elif args[0] in ('halt', 'destroy') and os.path.exists('.vagrant_vm'):
+        name = open('.vagrant_vm').read()
+        if args[0] == 'halt':
+            set_vm(name, 'state', 'poweroff')
+        else:
+            delete_vm(name)
+            os.remove('.vagrant_vm')
+else:
+    if args[:2] == ['list', 'runningvms']:
+        for name in sorted(os.listdir(vms)):
+            if get_vm(name, 'state') == 'running':
+                print('"%%s" {00000000-0000-0000-0000-000000000000}' %% name)
+    elif args[0] == 'showvminfo':
+        if not os.path.isdir(os.path.join(vms, args[1])):
+            sys.exit(1)
+        print('VMState="%%s"' %% get_vm(args[1], 'state'))
+        print('CfgFile="%%s"' %% os.path.join(get_vm(args[1], 'folder'), args[1] + '.vbox'))
+        if os.path.exists(vm_file(args[1], 'snapshot')):
+            print('SnapshotName="%%s"' %% get_vm(args[1], 'snapshot'))
+        for number, rule in enumerate(json.loads(get_vm(args[1], 'forwards', '[]'))):
+            print('Forwarding(%%d)="%%s"' %% (number, rule))
+    elif args[0] == 'import':
+        create_vm(args[args.index('--vmname') + 1], os.path.dirname(args[1]),
+                  args[args.index('--basefolder') + 1])
+    elif args[0] == 'snapshot':
+        set_vm(args[1], 'snapshot', args[3])
+    elif args[0] == 'clonevm':
+        folder = new_vm(args[args.index('--name') + 1], args[args.index('--basefolder') + 1])
+        # a new differencing image: header and block map, no data
+        os.makedirs(os.path.join(folder, 'Snapshots'))
+        with open(os.path.join(folder, 'Snapshots', 'diff.vdi'), 'wb') as f:
+            f.write(b'\x7f' * 1024 * 1024)
+    elif args[0] == 'modifyvm':
+        forwards = json.loads(get_vm(args[1], 'forwards', '[]'))
+        flags = args[2:]
+        while flags:
+            if flags[0] == '--natpf1' and flags[1] == 'delete':
+                forwards = [rule for rule in forwards if rule.split(',')[0] != flags[2]]
+                flags = flags[3:]
+            elif flags[0] == '--natpf1':
+                forwards.append(flags[1])
+                flags = flags[2:]
+            else:
+                flags = flags[1:]
+        set_vm(args[1], 'forwards', json.dumps(forwards))
+    elif args[0] == 'startvm':
+        start_vm(args[1])
+    elif args[:3] == ['controlvm', args[1], 'poweroff']:
+        stop_vm(args[1])
+    elif args[0] == 'unregistervm':
+        delete_vm(args[1])
+'''
+
+
+def make_test_box(path, size_mb, work_dir):
+    """
+    Write a Vagrant box with an OVF and a synthetic disk of size_mb MB.
+    """
+
+    import tarfile
+
+    disk = os.path.join(work_dir, 'box-disk1.vmdk')
+    make_test_disk(disk, size_mb)
+    ovf = os.path.join(work_dir, 'box.ovf')
+    with open(ovf, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<Envelope/>\n')
+    metadata = os.path.join(work_dir, 'metadata.json')
+    with open(metadata, 'w') as f:
+        f.write('{"provider": "virtualbox"}\n')
+    with tarfile.open(path, 'w:gz', compresslevel=1) as tar:
+        for name in (metadata, ovf, disk):
+            tar.add(name, arcname=os.path.basename(name))
+    for name in (metadata, ovf, disk):
+        os.remove(name)
+
+
+def fake_vm_tools(work_dir, vagrant_latency, latency):
+    """
+    Put the fake vagrant and VBoxManage first on the PATH, return the
+    folder of their state.  The caller restores PATH.
+    """
+
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    for tool, seconds in (('vagrant', vagrant_latency), ('VBoxManage', latency)):
+        with open(os.path.join(bin_dir, tool), 'w') as f:
+            f.write(FAKE_VM_TOOLS % {'python': sys.executable, 'tool': tool,
+                                     'latency': seconds})
+        os.chmod(os.path.join(bin_dir, tool), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    state = os.path.join(work_dir, 'state')
+    os.environ['FAKE_STATE'] = state
+    os.makedirs(os.path.join(state, 'vms'))
+    os.makedirs(os.path.join(state, 'boxes'))
+    return state
+
+
+def nxpath_benchmark(args):
+    import logging
+    import nxosv_vbox_prep
+    import vboxmanage
+
+    work_dir = os.path.abspath(tempfile.mkdtemp(prefix='nxpath_', dir=args.dir))
+    cwd = os.getcwd()
+    path = os.environ['PATH']
+    try:
+        state = fake_vm_tools(work_dir, args.vagrant_latency, args.latency)
+        box = os.path.join(work_dir, 'nxosv-final.7.0.3.I7.1.box')
+        make_test_box(box, args.size, work_dir)
+        box_name = os.path.basename(box)
+        box_dir = os.path.join(work_dir, 'created_boxes', 'nxos_7.0.3.I7.1')
+        os.makedirs(box_dir)
+        project = os.path.join(work_dir, 'box_building')
+        os.makedirs(project)
+
+        def vagrant_path():
+            os.chdir(project)
+            vmname = nxosv_vbox_prep.vagrant_create(box_name, box, 'box_building_default_')
+            nxosv_vbox_prep.wait_for_state(vmname, vboxmanage.RUNNING, timeout=60)
+            nxosv_vbox_prep.run(['vagrant', 'halt', '-f'])
+            nxosv_vbox_prep.wait_for_state(vmname, vboxmanage.STOPPED)
+            nxosv_vbox_prep.vagrant_cleanup(box_name)
+            os.chdir(cwd)
+
+        def import_path():
+            vmname = 'nxos_7.0.3.I7.1-build'
+            console_socket = os.path.join(work_dir, vmname + '.console')
+            nxosv_vbox_prep.import_box(box, vmname, box_dir, console_socket)
+            nxosv_vbox_prep.run(['VBoxManage', 'startvm', vmname, '--type', 'headless'])
+            nxosv_vbox_prep.wait_for_state(vmname, vboxmanage.RUNNING, timeout=60)
+            nxosv_vbox_prep.run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
+            nxosv_vbox_prep.wait_for_state(vmname, vboxmanage.STOPPED)
+            nxosv_vbox_prep.run(['VBoxManage', 'modifyvm', vmname, '--uartmode1',
+                                 'disconnected'])
+            nxosv_vbox_prep.cleanup_vm(vmname, console_socket)
+
+        print('%d MB box, fake vagrant %.1f s and VBoxManage %.0f ms per call' % (
+            os.path.getsize(box) // 1024 ** 2, args.vagrant_latency, args.latency * 1000))
+        print('%-34s  %7s  %10s  %8s' % ('', 'VAGRANT', 'VBOXMANAGE', 'TIME'))
+        # the builder logs every step
+        logging.disable(logging.CRITICAL)
+        try:
+            for name, steps in [('vagrant box add, up, halt, ...', vagrant_path),
+                                ('import into VirtualBox', import_path)]:
+                calls = os.path.join(state, 'calls')
+                if os.path.exists(calls):
+                    os.remove(calls)
+                start = time.time()
+                steps()
+                seconds = time.time() - start
+                with open(calls) as f:
+                    tools = [line.split()[0] for line in f]
+                print('%-34s  %7d  %10d  %7.1fs' % (
+                    name, tools.count('vagrant'), tools.count('VBoxManage'), seconds))
+        finally:
+            logging.disable(logging.NOTSET)
+    finally:
+        os.chdir(cwd)
+        os.environ['PATH'] = path
+        shutil.rmtree(work_dir)
+
+
+def topology_benchmark(args):
+    import json
+    import logging
+    import tarfile
+    import topology
+    import disk_cache
+
+    work_dir = os.path.abspath(tempfile.mkdtemp(prefix='topology_', dir=args.dir))
+    path = os.environ['PATH']
+    environ = dict((key, os.environ.get(key)) for key in ('VAGRANT_HOME', 'FAKE_BOOT'))
+    try:
+        fake_vm_tools(work_dir, args.vagrant_latency, args.latency)
+        os.environ['VAGRANT_HOME'] = os.path.join(work_dir, 'vagrant.d')
+        os.environ['FAKE_BOOT'] = str(args.boot_time)
+        # the box as "vagrant box add" leaves it
+        box = os.path.join(work_dir, 'iosxe.box')
+        make_test_box(box, args.size, work_dir)
+        box_dir = os.path.join(os.environ['VAGRANT_HOME'], 'boxes',
+                               'iosxe-VAGRANTSLASH-16.06.02', '0', 'virtualbox')
+        os.makedirs(box_dir)
+        with tarfile.open(box) as tar:
+            tar.extractall(box_dir)
+        os.remove(box)
+
+        # a chain of nodes, as in lab/hands_on_2
+        lab = os.path.join(work_dir, 'lab.json')
+        with open(lab, 'w') as f:
+            json.dump({'name': 'lab', 'nodes': [
+                {'name': 'iosxe%d' % number, 'box': 'iosxe/16.06.02',
+                 'intnets': ['link%d' % number, 'link%d' % (number + 1)]}
+                for number in range(1, args.nodes + 1)]}, f)
+        base_dir = os.path.join(work_dir, 'topologies')
+
+        print('%d nodes of a %d MB box, guests answer SSH %.0f s after the start' % (
+            args.nodes, args.size, args.boot_time))
+        print('fake vagrant %.1f s and VBoxManage %.0f ms per call' % (
+            args.vagrant_latency, args.latency * 1000))
+        print('%-30s  %8s  %8s  %8s' % ('', 'FIRST UP', 'ALL UP', 'DISK'))
+        # the launcher logs every step
+        logging.disable(logging.CRITICAL)
+        try:
+            for name, up, vagrant in [
+                    ('vagrant up', topology.up_vagrant, True),
+                    ('linked clones, first run', topology.up_linked, False),
+                    ('linked clones, base imported', topology.up_linked, False)]:
+                lab_topology = topology.load(lab)
+                result = up(lab_topology, base_dir, timeout=600)
+                topology.down(lab_topology, base_dir, vagrant)
+                up_times = [node.up for node in lab_topology.nodes]
+                if None in up_times:
+                    sys.exit('%s: not all nodes came up' % name)
+                print('%-30s  %7.1fs  %7.1fs  %8s' % (
+                    name, min(up_times), result['seconds'],
+                    disk_cache.format_size(result['disk'])))
+        finally:
+            logging.disable(logging.NOTSET)
+    finally:
+        os.environ['PATH'] = path
+        for key, value in environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(work_dir)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Offline benchmarks for the box building tools.
+        '''))
+    benchmarks = parser.add_subparsers(dest='benchmark')
+
+    vbox = benchmarks.add_parser('vboxmanage',
+                                 help='VBoxManage calls to define the build VM')
+    vbox.add_argument('--latency', type=float, default=VBOXMANAGE_LATENCY,
+                      help='seconds per fake VBoxManage call (default: %(default)s)')
+    vbox.add_argument('--repeat', type=int, default=3,
+                      help='runs per variant, the best one counts (default: %(default)s)')
+    vbox.set_defaults(func=vboxmanage_benchmark)
+
+    remaster = benchmarks.add_parser('remaster',
+                                     help='serial console ISO remastering')
+    remaster.add_argument('--size', type=int, default=400,
+                          help='MB of package data in the synthetic ISO (default: %(default)s)')
+    remaster.add_argument('--dir',
+                          help='folder for the ISOs, e.g. on a reflink capable file system')
+    remaster.set_defaults(func=remaster_benchmark)
+
+    pack = benchmarks.add_parser('pack', help='box compression')
+    pack.add_argument('--size', type=int, default=1024,
+                      help='MB of synthetic disk (default: %(default)s)')
+    pack.add_argument('--threads', type=int,
+                      help='compression threads (default: number of CPUs)')
+    pack.add_argument('--dir', help='folder for the test files')
+    pack.set_defaults(func=pack_benchmark)
+
+    export = benchmarks.add_parser('export', help='disk export')
+    export.add_argument('--size', type=int, default=8192,
+                        help='MB logical size of the synthetic VDI (default: %(default)s)')
+    export.add_argument('--used', type=int, default=1024,
+                        help='MB allocated in the synthetic VDI (default: %(default)s)')
+    export.add_argument('--threads', type=int,
+                        help='compression threads (default: number of CPUs)')
+    export.add_argument('--dir', help='folder for the test files')
+    export.set_defaults(func=export_benchmark)
+
+    catalog = benchmarks.add_parser('catalog', help='Vagrant catalog update')
+    catalog.add_argument('--versions', type=int, default=500,
+                         help='versions already in the catalog (default: %(default)s)')
+    catalog.add_argument('--repeat', type=int, default=5,
+                         help='catalog updates, the best one counts (default: %(default)s)')
+    catalog.add_argument('--dir', help='folder for the test files')
+    catalog.set_defaults(func=catalog_benchmark)
+
+    console = benchmarks.add_parser('console',
+                                    help='console configuration against the simulator')
+    console.add_argument('--baud', type=int, default=9600,
+                         help='serial speed of the simulated console (default: %(default)s)')
+    console.add_argument('--line-latency', type=float, default=0.05,
+                         help='seconds the simulated CLI takes per line (default: %(default)s)')
+    console.add_argument('--boot-time', type=float, default=2.0,
+                         help='seconds of boot transcript replay (default: %(default)s)')
+    console.add_argument('--service-time', type=float, default=2.0,
+                         help='seconds the NX-OS guest shell takes to activate '
+                         '(default: %(default)s)')
+    console.set_defaults(func=console_benchmark)
+
+    transport = benchmarks.add_parser('transport', help='console transport latency')
+    transport.add_argument('--count', type=int, default=2000,
+                           help='round trips per run (default: %(default)s)')
+    transport.add_argument('--repeat', type=int, default=3,
+                           help='runs per variant, the best one counts (default: %(default)s)')
+    transport.set_defaults(func=transport_benchmark)
+
+    fleet = benchmarks.add_parser('fleet', help='many consoles driven by console_async.py')
+    fleet.add_argument('--sessions', type=int, default=24,
+                       help='simulated consoles (default: %(default)s)')
+    fleet.add_argument('--baud', type=int, default=9600,
+                       help='serial speed of the simulated consoles (default: %(default)s)')
+    fleet.add_argument('--line-latency', type=float, default=0.05,
+                       help='seconds the simulated CLI takes per line (default: %(default)s)')
+    fleet.add_argument('--boot-time', type=float, default=2.0,
+                       help='seconds of boot transcript replay (default: %(default)s)')
+    fleet.add_argument('--service-time', type=float, default=2.0,
+                       help='seconds the NX-OS guest shell takes to activate '
+                       '(default: %(default)s)')
+    fleet.set_defaults(func=fleet_benchmark)
+
+    bootwait = benchmarks.add_parser('bootwait', help='boot marker matching CPU')
+    bootwait.add_argument('--boot-repeat', type=int, default=600,
+                          help='times the boot transcript is replayed (default: %(default)s)')
+    bootwait.add_argument('--boot-time', type=float, default=20.0,
+                          help='seconds of boot transcript replay (default: %(default)s)')
+    bootwait.add_argument('--baud', type=int, default=0,
+                          help='serial speed of the simulated console, 0 for unlimited '
+                          '(default: %(default)s)')
+    bootwait.set_defaults(func=bootwait_benchmark)
+
+    nxpath = benchmarks.add_parser('nxpath', help='NX-OS box import vs. vagrant up')
+    nxpath.add_argument('--size', type=int, default=1024,
+                        help='MB of synthetic disk in the source box (default: %(default)s)')
+    nxpath.add_argument('--vagrant-latency', type=float, default=VAGRANT_LATENCY,
+                        help='seconds per fake vagrant call (default: %(default)s)')
+    nxpath.add_argument('--latency', type=float, default=VBOXMANAGE_LATENCY,
+                        help='seconds per fake VBoxManage call (default: %(default)s)')
+    nxpath.add_argument('--dir', help='folder for the test files')
+    nxpath.set_defaults(func=nxpath_benchmark)
+
+    lab = benchmarks.add_parser('topology', help='lab topology from linked clones vs. vagrant up')
+    lab.add_argument('--nodes', type=int, default=4,
+                     help='nodes in the topology (default: %(default)s)')
+    lab.add_argument('--size', type=int, default=512,
+                     help='MB of synthetic disk in the box (default: %(default)s)')
+    lab.add_argument('--boot-time', type=float, default=20.0,
+                     help='seconds until a started guest answers SSH (default: %(default)s)')
+    lab.add_argument('--vagrant-latency', type=float, default=VAGRANT_LATENCY,
+                     help='seconds per fake vagrant call (default: %(default)s)')
+    lab.add_argument('--latency', type=float, default=VBOXMANAGE_LATENCY,
+                     help='seconds per fake VBoxManage call (default: %(default)s)')
+    lab.add_argument('--dir', help='folder for the test files')
+    lab.set_defaults(func=topology_benchmark)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+'''
+Versioned Vagrant catalogs of the built boxes.
+
+"vagrant box add" takes a catalog, a metadata.json listing the versions of
+a box and where to get each one:
+
+    {
+      "name": "iosxe",
+      "description": "Cisco CSR 1000v (IOS XE)",
+      "versions": [
+        {
+          "version": "16.07.01",
+          "providers": [
+            {"name": "virtualbox",
+             "url": "file:///.../csr1000v-universalk9.16.07.01.box",
+             "checksum_type": "sha256", "checksum": "..."}
+          ]
+        }
+      ]
+    }
+
+With a catalog, Vagrant knows the versions of a box, checks the download
+against the checksum and tells when a newer version is available.
+
+The builders add the version they just built, with the checksum computed
+while the box was written, so no box is read again.  An update only reads
+and rewrites the small catalog file, under a lock, so builds running side
+by side don't lose each other's versions.  Catalogs live in
+<catalog folder>/<box name>/metadata.json, by default in created_boxes.
+
+E.g.:
+    vagrant box add created_boxes/iosxe/metadata.json
+    vagrant init iosxe --box-version 16.07.01
+    python box_catalog.py list created_boxes/iosxe/metadata.json
+    python box_catalog.py add created_boxes iosxe 16.07.01 \\
+        created_boxes/csr1000v-universalk9.16.07.01/csr1000v-universalk9.16.07.01.box
+    python box_catalog.py remove created_boxes/iosxe/metadata.json 16.06.02
+'''
+
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import logging
+import argparse
+import textwrap
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+from disk_cache import file_sha256
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAME = 'metadata.json'
+
+DESCRIPTIONS = {
+    'iosxe': 'Cisco CSR 1000v (IOS XE)',
+    'nxos': 'Cisco Nexus 9000v (NX-OS)',
+}
+
+
+class CatalogError(Exception):
+    pass
+
+
+def catalog_path(catalog_dir, name):
+    """
+    Return the path of the catalog of box name, e.g. created_boxes/iosxe/metadata.json.
+    """
+
+    return os.path.join(catalog_dir, name, CATALOG_NAME)
+
+
+def file_url(path):
+    """
+    Return the file:// URL of a local box.
+    """
+
+    url = pathname2url(os.path.abspath(path))
+    # pathname2url gives /a/b on POSIX, ///C:/a/b on Windows
+    return 'file:' + url if url.startswith('//') else 'file://' + url
+
+
+def version_key(version):
+    """
+    Sort key of a version, numbers compared as numbers: 16.9.1 < 16.10.1,
+    7.0.3.I7.1 < 7.0.3.I7.2.
+    """
+
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part)
+            for part in re.split(r'[.-]', version)]
+
+
+@contextmanager
+def _locked(path):
+    """
+    Hold an exclusive lock on path + '.lock' (not on Windows).
+    """
+
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+class Catalog(object):
+    """
+    The Vagrant catalog (metadata.json) of one box name.
+    """
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name or os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {'name': self.name,
+                    'description': DESCRIPTIONS.get(self.name, ''),
+                    'versions': []}
+        with open(self.path) as f:
+            try:
+                return json.load(f)
+            except ValueError as e:
+                raise CatalogError('%s: %s' % (self.path, e))
+
+    def _save(self, metadata):
+        # one version per line: readable, and the C encoder does the work
+        # (indent would switch to the pure Python one)
+        items = ['%s: %s' % (json.dumps(key), json.dumps(value, sort_keys=True))
+                 for key, value in sorted(metadata.items()) if key != 'versions']
+        versions = ',\n  '.join(json.dumps(entry, sort_keys=True)
+                                for entry in metadata['versions'])
+        items.append('"versions": [%s]' % ('\n  ' + versions + '\n ' if versions else ''))
+        text = '{' + ',\n '.join(items) + '}\n'
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.rename(tmp, self.path)
+
+    def versions(self):
+        return [entry['version'] for entry in self.load()['versions']]
+
+    def add(self, version, url, checksum, provider='virtualbox'):
+        """
+        Add version, or replace its provider entry, keeping the versions
+        sorted newest first.
+        """
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with _locked(self.path):
+            metadata = self.load()
+            versions = dict((entry['version'], entry) for entry in metadata['versions'])
+            entry = versions.setdefault(version, {'version': version, 'providers': []})
+            entry['providers'] = [p for p in entry['providers'] if p['name'] != provider]
+            entry['providers'].append({'name': provider, 'url': url,
+                                       'checksum_type': 'sha256',
+                                       'checksum': checksum})
+            metadata['versions'] = sorted(versions.values(), reverse=True,
+                                          key=lambda entry: version_key(entry['version']))
+            self._save(metadata)
+        return entry
+
+    def remove(self, version):
+        """
+        Drop version from the catalog, return whether it was there.
+        """
+
+        with _locked(self.path):
+            metadata = self.load()
+            kept = [entry for entry in metadata['versions'] if entry['version'] != version]
+            if len(kept) == len(metadata['versions']):
+                return False
+            metadata['versions'] = kept
+            self._save(metadata)
+        return True
+
+
+def add_box(catalog_dir, name, version, box, checksum=None):
+    """
+    Add the box as version of name to its catalog in catalog_dir, return
+    the catalog path.  The box is hashed only if checksum is None.
+    """
+
+    if checksum is None:
+        checksum = file_sha256(box)
+    path = catalog_path(catalog_dir, name)
+    Catalog(path, name).add(version, file_url(box), checksum)
+    logger.info('Added %s %s to %s', name, version, path)
+    return path
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Show and edit the Vagrant catalogs of the built boxes.
+        '''))
+    commands = parser.add_subparsers(dest='command')
+    show = commands.add_parser('list', help='show the versions in a catalog')
+    show.add_argument('CATALOG', help='metadata.json of a box')
+    add = commands.add_parser('add', help='add a box to the catalog of its name')
+    add.add_argument('CATALOG_DIR', help='folder of the catalogs, e.g. created_boxes')
+    add.add_argument('NAME', help='box name, e.g. iosxe')
+    add.add_argument('VERSION', help='box version, e.g. 16.07.01')
+    add.add_argument('BOX', help='box file')
+    add.add_argument('--sha256', help='checksum of the box, saves reading it')
+    remove = commands.add_parser('remove', help='remove a version from a catalog')
+    remove.add_argument('CATALOG', help='metadata.json of a box')
+    remove.add_argument('VERSION')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+    try:
+        if args.command == 'list':
+            for entry in Catalog(args.CATALOG).load()['versions']:
+                for provider in entry['providers']:
+                    print('%-16s %-12s %s  %s' % (entry['version'], provider['name'],
+                                                  provider['checksum'][:12],
+                                                  provider['url']))
+        elif args.command == 'add':
+            add_box(args.CATALOG_DIR, args.NAME, args.VERSION, args.BOX, args.sha256)
+        elif args.command == 'remove':
+            if not Catalog(args.CATALOG).remove(args.VERSION):
+                sys.exit('%s is not in %s' % (args.VERSION, args.CATALOG))
+        else:
+            parser.print_help()
+    except (CatalogError, IOError, OSError) as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+'''
+Package a VirtualBox VM as a Vagrant box, compressing on all cores.
+
+"vagrant package" exports the VM and then gzips the multi GB tarball on a
+single core.  This packer writes the box layout itself:
+
+    metadata.json          {"provider": "virtualbox"}
+    Vagrantfile            base_mac of the VM, loads include/_Vagrantfile
+    include/_Vagrantfile   the embedded Vagrantfile of the box
+    box.ovf                from "VBoxManage export"
+    box-disk001.vmdk       written from the block map of the disk (see
+                           sparse_disk.py), or from "VBoxManage export"
+
+The same export can also be written as an OVA and the disk as a qcow2
+image: the disk is read once for all of them, and the box and the OVA are
+written side by side from the exported files.
+
+The tar stream is cut into blocks that are compressed in parallel, each one
+a complete gzip member (a file of concatenated members is a valid gzip
+file, bsdtar and thus "vagrant box add" read it like any other), and
+written to the output in order as they are done.  With zstd, the
+zstandard module (or the zstd command) compresses on all cores instead.
+
+E.g.:
+    python box_packer.py csr1000v-universalk9.16.07.01 csr.box \\
+        --vagrantfile include/embedded_vagrantfile_xe_virtio
+    python box_packer.py csr1000v-universalk9.16.07.01 csr.box \
+        --ova csr1000v-universalk9.16.07.01.ova --qcow2 csr1000v-universalk9.16.07.01.qcow2
+'''
+
+from __future__ import print_function
+import sys
+import os
+import io
+import re
+import json
+import time
+import zlib
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import argparse
+import logging
+import threading
+import subprocess
+import textwrap
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import vboxmanage
+import sparse_disk
+import build_trace
+
+logger = logging.getLogger(__name__)
+
+# Input per gzip member.  Large enough that the member headers and the
+# restarted dictionaries cost next to nothing, small enough to keep every
+# core busy.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+COMPRESSIONS = ('gzip', 'zstd', 'none')
+
+# What "vagrant package" writes as the box Vagrantfile
+BOX_VAGRANTFILE = '''Vagrant.configure("2") do |config|
+  config.vm.base_mac = "%s"
+end
+
+# Load include vagrant file if it exists after the auto-generated
+# so it can override any of the settings
+include_vagrantfile = File.expand_path("../include/_Vagrantfile", __FILE__)
+load include_vagrantfile if File.exist?(include_vagrantfile)
+'''
+
+
+class PackError(Exception):
+    pass
+
+
+def _which(program):
+    for folder in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(folder, program), os.X_OK):
+            return True
+    return False
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def gzip_member(data, level=6):
+    """
+    Compress data into one complete gzip member.
+    """
+
+    # wbits 31: zlib writes the gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    File object that gzips what is written to it on several threads.
+
+    Blocks are compressed as independent gzip members and written to
+    fileobj in order.  At most two blocks per thread are in flight, so
+    memory stays bounded however large the input.
+    """
+
+    def __init__(self, fileobj, level=6, threads=None, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or cpu_count()
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+        self.jobs = queue.Queue()
+        self.workers = []
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job['result'] = gzip_member(job['data'], self.level)
+            except Exception as e:
+                job['error'] = e
+            job['done'].set()
+
+    def _submit(self, data):
+        job = {'data': data, 'done': threading.Event(), 'result': None,
+               'error': None}
+        self.pending.append(job)
+        self.jobs.put(job)
+        while len(self.pending) > 2 * self.threads:
+            self._write_next()
+
+    def _write_next(self):
+        job = self.pending.popleft()
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        self.fileobj.write(job['result'])
+        self.bytes_out += len(job['result'])
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = b''.join(self.buffer)
+            full = len(data) - len(data) % self.block_size
+            for start in range(0, full, self.block_size):
+                self._submit(data[start:start + self.block_size])
+            self.buffer = [data[full:]]
+            self.buffered = len(data) - full
+
+    def close(self):
+        # an empty stream still gets one (empty) member
+        if self.buffered or self.bytes_in == 0:
+            self._submit(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self._write_next()
+        for _ in self.workers:
+            self.jobs.put(None)
+
+
+class _ProcessWriter(object):
+    """
+    File object that pipes into a compressor command writing to fileobj.
+    """
+
+    def __init__(self, cmd, fileobj):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        # fileobj may be a HashingWriter, so the output goes through here
+        self.copier = threading.Thread(target=shutil.copyfileobj,
+                                       args=(self.proc.stdout, fileobj))
+        self.copier.daemon = True
+        self.copier.start()
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.copier.join()
+        if self.proc.wait() != 0:
+            raise PackError('%s exited with %d' % (self.cmd[0], self.proc.returncode))
+
+
+class HashingWriter(object):
+    """
+    File object that writes to fileobj and hashes what goes through, so
+    an artifact's checksum is known once it is written.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+class _PlainWriter(object):
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+def compressed_writer(fileobj, compression='gzip', level=None, threads=None):
+    """
+    Return a file object compressing into fileobj; close() finishes the
+    stream but leaves fileobj open.
+    """
+
+    threads = threads or cpu_count()
+    if compression == 'gzip':
+        return ParallelGzipWriter(fileobj, level=6 if level is None else level,
+                                  threads=threads)
+    if compression == 'zstd':
+        level = 3 if level is None else level
+        if zstandard is not None:
+            compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+            return compressor.stream_writer(fileobj, closefd=False)
+        if _which('zstd'):
+            return _ProcessWriter(['zstd', '-q', '-c', '-%d' % level,
+                                   '-T%d' % threads], fileobj)
+        raise PackError('zstd needs the zstandard module or the zstd command')
+    if compression == 'none':
+        return _PlainWriter(fileobj)
+    raise PackError('unknown compression %s' % compression)
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_box(output, files, base_mac, vagrantfile=None, compression='gzip',
+              level=None, threads=None):
+    """
+    Write the box archive to output.
+
+    files is a list of (name in the box, path), e.g. box.ovf and its disks.
+    The files are streamed into the archive, nothing is copied first.
+    Returns stats: bytes in, bytes out, seconds and the SHA-256 of the box.
+    """
+
+    start = time.time()
+    partial = output + '.partial'
+    with open(partial, 'wb') as f, build_trace.span('box', 'package',
+                                                    compression=compression):
+        out = HashingWriter(f)
+        writer = compressed_writer(out, compression, level, threads)
+        tar = tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT)
+        _add_bytes(tar, 'metadata.json',
+                   json.dumps({'provider': 'virtualbox'}).encode('utf-8'))
+        _add_bytes(tar, 'Vagrantfile', (BOX_VAGRANTFILE % base_mac).encode('utf-8'))
+        if vagrantfile:
+            tar.add(vagrantfile, arcname='include/_Vagrantfile')
+        bytes_in = 0
+        for name, path in files:
+            tar.add(path, arcname=name)
+            bytes_in += os.path.getsize(path)
+        tar.close()
+        writer.close()
+    bytes_out = os.path.getsize(partial)
+    os.rename(partial, output)
+    return {'bytes_in': bytes_in, 'bytes_out': bytes_out,
+            'seconds': time.time() - start, 'sha256': out.hexdigest()}
+
+
+def write_ova(output, files):
+    """
+    Write files, (name, path) with the OVF first, as an OVA: a plain tar
+    archive, which is what "VBoxManage export --output x.ova" writes.
+    Returns its SHA-256.
+    """
+
+    partial = output + '.partial'
+    with open(partial, 'wb') as f, build_trace.span('ova', 'package'):
+        out = HashingWriter(f)
+        tar = tarfile.open(fileobj=out, mode='w|', format=tarfile.USTAR_FORMAT)
+        for name, path in files:
+            tar.add(path, arcname=name)
+        tar.close()
+    os.rename(partial, output)
+    return out.hexdigest()
+
+
+def write_qcow2(disk, output):
+    """
+    Convert an exported disk to a qcow2 image at output.
+    """
+
+    with open(output + '.partial', 'wb') as f, build_trace.span('qcow2', 'package'):
+        sparse_disk.export_disk(disk, qcow2=f)
+    os.rename(output + '.partial', output)
+
+
+def clear_forwarded_ports(vmname, run, info=None):
+    """
+    Remove the NAT port forwards, as "vagrant package" does: vagrant sets up
+    its own when the box comes up.
+    """
+
+    if info is None:
+        info = vboxmanage.showvminfo(vmname, run)
+    for key, value in sorted(info.items()):
+        if key.startswith('Forwarding('):
+            run(['VBoxManage', 'modifyvm', vmname, '--natpf1', 'delete',
+                 value.split(',')[0]])
+
+
+def hard_disks(info):
+    """
+    Return (controller, port, device, path) of the VM's hard disks.
+    """
+
+    disks = []
+    for key, value in sorted(info.items()):
+        match = re.match(r'^(.+)-(\d+)-(\d+)$', key)
+        if match and os.path.splitext(value)[1].lower() in ('.vdi', '.vmdk'):
+            disks.append(match.groups() + (value,))
+    return disks
+
+
+def _set_attribute(text, element, href, attribute, value):
+    """
+    Set attribute of the OVF element referring to href, if it has one.
+    """
+
+    def replace(match):
+        return re.sub(r'(%s=")\d+(")' % attribute,
+                      r'\g<1>%d\g<2>' % value, match.group(0))
+
+    return re.sub(r'<%s\b[^>]*"%s"[^>]*>' % (element, re.escape(href)), replace, text)
+
+
+def _medium_uuid(path, run):
+    """
+    Return the UUID of the disk at path, from "VBoxManage showmediuminfo".
+    """
+
+    output = run(['VBoxManage', 'showmediuminfo', 'disk', path])
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    for line in output.splitlines():
+        key, _, value = line.partition(':')
+        if key.strip() == 'UUID':
+            return value.strip()
+    raise PackError('No UUID for %s' % path)
+
+
+def _export_sparse(vmname, disk, ovf, run, threads, qcow2=None):
+    """
+    Export the VM with its disk written from the disk's block map.
+
+    VBoxManage export writes the OVF (with every setting of the VM) but
+    reads the whole disk.  So the VM is exported with an empty placeholder
+    disk of the same size, and the placeholder VMDK is then replaced with
+    one written by sparse_disk, along with the qcow2 image if asked for.
+    The OVF gets the UUID and the populated size of the real disk.
+    Returns the disk stats, or None if the disk can't be read that way.
+    """
+
+    controller, port, device, path = disk
+    try:
+        reader = sparse_disk.open_disk(path)
+    except sparse_disk.DiskError as e:
+        logger.info('%s, exporting the whole disk', e)
+        return None
+    size = reader.size
+    reader.close()
+
+    export_dir = os.path.dirname(ovf)
+    placeholder = os.path.join(export_dir, 'placeholder.vdi')
+    attach = ['VBoxManage', 'storageattach', vmname, '--storagectl', controller,
+              '--port', port, '--device', device, '--type', 'hdd', '--medium']
+    run(['VBoxManage', 'createmedium', 'disk', '--filename', placeholder,
+         '--sizebyte', str(size), '--format', 'VDI'])
+    placeholder_uuid = _medium_uuid(placeholder, run)
+    run(attach + [placeholder])
+    try:
+        run(['VBoxManage', 'export', vmname, '--output', ovf])
+    finally:
+        run(attach + [path])
+        # it's in the export folder, it would end up in the box
+        run(['VBoxManage', 'closemedium', 'disk', placeholder, '--delete'])
+        if os.path.exists(placeholder):
+            raise PackError('Could not delete the placeholder disk %s' % placeholder)
+
+    vmdk = [name for name in os.listdir(export_dir) if name.endswith('.vmdk')][0]
+    with open(os.path.join(export_dir, vmdk), 'wb') as f, \
+            build_trace.span('disk', 'package', qcow2=bool(qcow2)):
+        if qcow2:
+            with open(qcow2 + '.partial', 'wb') as image:
+                stats = sparse_disk.export_disk(path, f, image,
+                                                threads or cpu_count(), vmdk)
+            os.rename(qcow2 + '.partial', qcow2)
+        else:
+            stats = sparse_disk.export_vmdk(path, f, threads or cpu_count(), vmdk)
+    with open(ovf) as f:
+        text = f.read()
+    text = _set_attribute(text, 'File', vmdk, 'ovf:size',
+                          os.path.getsize(os.path.join(export_dir, vmdk)))
+    file_id = re.search(r'<File\b[^>]*"%s"[^>]*>' % re.escape(vmdk), text)
+    file_id = file_id and re.search(r'ovf:id="([^"]+)"', file_id.group(0))
+    if file_id:
+        text = _set_attribute(text, 'Disk', file_id.group(1), 'ovf:populatedSize',
+                              stats['data'])
+    text = re.sub(re.escape(placeholder_uuid), _medium_uuid(path, run), text,
+                  flags=re.IGNORECASE)
+    with open(ovf, 'w') as f:
+        f.write(text)
+    # a manifest would have the checksum of the placeholder
+    for name in os.listdir(export_dir):
+        if name.endswith('.mf'):
+            os.remove(os.path.join(export_dir, name))
+    return stats
+
+
+def export(vmname, ovf, run, info=None, threads=None, sparse=True, qcow2=None):
+    """
+    Export the VM as OVF, return the exported files as (name, path) with
+    the OVF first.
+
+    With sparse, a VM with one VDI or sparse VMDK disk gets its disk
+    exported from the block map, skipping unallocated and zero blocks.
+    With qcow2, the disk is also written there as a qcow2 image.
+    """
+
+    if info is None:
+        info = vboxmanage.showvminfo(vmname, run)
+    disks = hard_disks(info)
+    logger.info('Exporting %s', vmname)
+    if sparse and len(disks) == 1 and \
+            _export_sparse(vmname, disks[0], ovf, run, threads, qcow2):
+        qcow2 = None
+    else:
+        run(['VBoxManage', 'export', vmname, '--output', ovf])
+    export_dir = os.path.dirname(ovf)
+    name = os.path.basename(ovf)
+    files = [(name, ovf)] + [
+        (other, os.path.join(export_dir, other))
+        for other in sorted(os.listdir(export_dir)) if other != name]
+    if qcow2:
+        vmdks = [path for other, path in files if other.endswith('.vmdk')]
+        if len(vmdks) != 1:
+            raise PackError('%s has %d disks, no qcow2 image written'
+                            % (vmname, len(vmdks)))
+        write_qcow2(vmdks[0], qcow2)
+    return files
+
+
+def package(vmname, output, run, vagrantfile=None, compression='gzip',
+            level=None, threads=None, sparse=True, ova=None, qcow2=None,
+            include=()):
+    """
+    Package the (powered off) VM as a Vagrant box.
+
+    Replaces "vagrant package --base vmname --vagrantfile vagrantfile
+    --include include --output output".  With ova and qcow2, the same
+    export is also written as an OVA and a qcow2 image.  Returns the stats
+    of write_box(), plus the SHA-256 of the OVA as ova_sha256.
+    """
+
+    info = vboxmanage.showvminfo(vmname, run)
+    if not info:
+        raise PackError("VM '%s' not found" % vmname)
+    base_mac = info.get('macaddress1')
+    clear_forwarded_ports(vmname, run, info)
+
+    export_dir = tempfile.mkdtemp(prefix='box_', dir=os.path.dirname(
+        os.path.abspath(output)))
+    try:
+        files = export(vmname, os.path.join(export_dir, 'box.ovf'), run, info,
+                       threads, sparse, qcow2)
+        ova_writer = None
+        if ova:
+            # the box and the OVA read the same files, from the page cache
+            errors = []
+            ova_sha256 = []
+
+            def write():
+                try:
+                    ova_sha256.append(write_ova(ova, files))
+                except Exception as e:
+                    errors.append(e)
+            ova_writer = threading.Thread(target=write, name='ova')
+            ova_writer.start()
+        logger.info('Compressing box with %s on %d threads', compression,
+                    threads or cpu_count())
+        try:
+            # next to the embedded Vagrantfile, as "vagrant package --include"
+            extra = [('include/' + os.path.basename(path), path) for path in include]
+            stats = write_box(output, files + extra, base_mac, vagrantfile,
+                              compression, level, threads)
+        finally:
+            if ova_writer:
+                ova_writer.join()
+        if ova_writer and errors:
+            raise PackError('Writing %s failed: %s' % (ova, errors[0]))
+        if ova:
+            stats['ova_sha256'] = ova_sha256[0]
+            logger.info('Wrote %s', ova)
+    finally:
+        shutil.rmtree(export_dir)
+    logger.info('Packed %d MB into %d MB in %.1f s (%.0f MB/s)',
+                stats['bytes_in'] // 1024 ** 2, stats['bytes_out'] // 1024 ** 2,
+                stats['seconds'],
+                stats['bytes_in'] / 1024.0 ** 2 / max(stats['seconds'], 0.001))
+    return stats
+
+
+def unpack(box_file, directory):
+    """
+    Extract a box (a tar archive, compressed or not) into directory, return
+    the path of its OVF.
+    """
+
+    with build_trace.span('unpack box', 'package'):
+        tar = tarfile.open(box_file, 'r|*')
+        try:
+            for member in tar:
+                parts = member.name.replace('\\', '/').split('/')
+                if member.name.startswith('/') or '..' in parts or \
+                        not (member.isfile() or member.isdir()):
+                    raise PackError('%s: unexpected member %s' % (box_file, member.name))
+                tar.extract(member, directory)
+        finally:
+            tar.close()
+    ovfs = [name for name in os.listdir(directory) if name.endswith('.ovf')]
+    if len(ovfs) != 1:
+        raise PackError('%s: expected one OVF, found %s' % (box_file, ovfs or 'none'))
+    return os.path.join(directory, ovfs[0])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Package a VirtualBox VM as a Vagrant box on all cores.
+        '''))
+    parser.add_argument('VM', help='name of the VirtualBox VM, powered off')
+    parser.add_argument('BOX', help='box file to write')
+    parser.add_argument('--vagrantfile', help='Vagrantfile to embed in the box')
+    parser.add_argument('-c', '--compression', choices=COMPRESSIONS, default='gzip',
+                        help='(default: %(default)s)')
+    parser.add_argument('-l', '--level', type=int,
+                        help='compression level (default: 6 for gzip, 3 for zstd)')
+    parser.add_argument('-j', '--threads', type=int,
+                        help='compression threads (default: number of CPUs)')
+    parser.add_argument('--full-disk', action='store_true',
+                        help='export the whole disk with VBoxManage export')
+    parser.add_argument('--ova', help='also write the VM to this OVA file')
+    parser.add_argument('--qcow2', help='also write the disk to this qcow2 image')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+
+    def run(cmd, hide_error=False, cont_on_error=False):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0 and not hide_error:
+            sys.exit('%s failed: %s' % (' '.join(cmd), err.decode('utf-8', 'replace')))
+        return out
+
+    try:
+        package(args.VM, args.BOX, run, args.vagrantfile, args.compression,
+                args.level, args.threads, not args.full_disk, args.ova,
+                args.qcow2)
+    except PackError as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
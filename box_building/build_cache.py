@@ -0,0 +1,173 @@
+'''
+Whole build cache for the box building scripts.
+
+Every input that shapes a box goes into its build key: the SHA-256 of the
+ISO, the embedded Vagrantfile, the configuration pushed to the device, the
+VM hardware spec (with the packaging options) and the version of the builder.  A manifest next to the
+created boxes records which key produced which artifacts.  When a build
+comes up with a key that is in the manifest and its artifacts are still in
+place, untouched, the builder hands them back instead of building again.
+
+The manifest is JSON, e.g. created_boxes/build_manifest.json:
+
+    {
+      "<key>": {
+        "created": 1538000000.0,
+        "inputs": {"iso": "csr1000v-universalk9.16.07.01.iso", ...},
+        "artifacts": {
+          "box": {"path": ".../csr1000v-universalk9.16.07.01.box",
+                  "size": 1389395968, "mtime": 1538000000.0,
+                  "sha256": "..."}
+        }
+      }
+    }
+'''
+
+import os
+import json
+import time
+import hashlib
+import logging
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from disk_cache import file_sha256
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'build_manifest.json'
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def build_key(iso_sha256, vagrantfile, config, vm_spec, version):
+    """
+    Return the build key of a box.
+
+    iso_sha256   SHA-256 of the ISO
+    vagrantfile  path of the embedded Vagrantfile
+    config       configuration blocks pushed to the device, as (name, lines)
+    vm_spec      VMSpec.key() of the VM hardware
+    version      version of the builder
+    """
+
+    with open(vagrantfile, 'rb') as f:
+        vagrantfile_sha256 = _digest(f.read())
+    inputs = {
+        'iso': iso_sha256,
+        'vagrantfile': vagrantfile_sha256,
+        'config': [[name, list(lines)] for name, lines in config],
+        'vm_spec': vm_spec,
+        'version': version,
+    }
+    return _digest(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+
+
+def _stat(path):
+    st = os.stat(path)
+    return {'path': path, 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+@contextmanager
+def _locked(path):
+    """
+    Hold an exclusive lock on path + '.lock' (not on Windows).
+    """
+
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+class BuildManifest(object):
+    """
+    Build key to artifacts map, stored as JSON.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def lookup(self, key, wanted=('box',)):
+        """
+        Return the artifacts built with key, or None.
+
+        Every wanted artifact must have been built and still be in place,
+        with the size and modification time it had when it was recorded.
+        """
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        artifacts = entry['artifacts']
+        for name in wanted:
+            artifact = artifacts.get(name)
+            if artifact is None:
+                logger.debug('Build %s has no %s', key[:12], name)
+                return None
+            path = artifact['path']
+            if not os.path.exists(path):
+                logger.debug('%s of build %s is gone', path, key[:12])
+                return None
+            current = _stat(path)
+            if current['size'] != artifact['size'] or current['mtime'] != artifact['mtime']:
+                logger.debug('%s changed since build %s', path, key[:12])
+                return None
+        return artifacts
+
+    def record(self, key, artifacts, inputs=None, checksums=None):
+        """
+        Record the artifacts, a dict of name to path, as built with key.
+
+        checksums has the SHA-256 of artifacts already hashed while they
+        were written, the others are read to hash them.
+
+        Builds sharing the manifest run at the same time, so the entry is
+        merged into the manifest as it is on disk now, under its lock.
+        """
+
+        checksums = checksums or {}
+        entry = {'created': time.time(), 'inputs': inputs or {},
+                 'artifacts': {}}
+        for name, path in artifacts.items():
+            artifact = _stat(path)
+            artifact['sha256'] = checksums.get(name) or file_sha256(path)
+            entry['artifacts'][name] = artifact
+        with _locked(self.path):
+            self.entries = self.load()
+            # a path holds the artifact of one build only
+            paths = set(artifacts.values())
+            for other in list(self.entries):
+                others = self.entries[other]['artifacts']
+                for name in list(others):
+                    if others[name]['path'] in paths:
+                        del others[name]
+                if not others:
+                    del self.entries[other]
+            self.entries[key] = entry
+            self.save()
+        return entry
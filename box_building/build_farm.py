@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+'''
+Build several IOS XE Vagrant boxes at once on a single host.
+
+Each ISO is handed to iosxe_iso2vbox.py in its own process.  Every build gets
+its own console port, its own VM folder below the shared base folder and its
+own build and console logs, so builds don't trip over each other.
+
+Builds are admitted only while the host can take them:
+
+  . the memory of all running VMs (--memory per VM, 4096 MB by default, the
+    same as iosxe_iso2vbox.py) must fit into the host RAM minus a reserve
+  . on Linux the currently available memory is re-checked before each start
+    (not with --host-memory, which plans for another machine)
+  . no more builds than CPUs (or --jobs, if lower)
+
+Once all builds have finished a per-build result table is printed.  The exit
+status is non-zero if any build failed.
+
+E.g.:
+    python build_farm.py csr1000v-universalk9.16.06.02.iso \\
+                         csr1000v-universalk9.16.07.01.iso \\
+                         csr1000v-universalk9.16.08.01.iso
+'''
+
+from __future__ import print_function
+import sys
+import os
+import time
+import socket
+import argparse
+import subprocess
+import threading
+import logging
+import textwrap
+
+logger = logging.getLogger(__name__)
+
+# First console port handed out, iosxe_iso2vbox.py uses this one by default
+BASE_CONSOLE_PORT = 65000
+
+# Memory per VM, matches the default of iosxe_iso2vbox.py
+VM_MEMORY = 4096
+
+# Memory left over for the host OS, VBoxSVC and the build processes
+HOST_RESERVE = 2048
+
+# How often the scheduler re-evaluates the waiting builds
+SCHEDULE_INTERVAL = 5
+
+
+def host_memory():
+    """
+    Return (total, available) host memory in MB.
+
+    available is None where it can't be determined cheaply (OS X).
+    """
+
+    if os.path.exists('/proc/meminfo'):
+        info = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0]) // 1024
+        return info['MemTotal'], info.get('MemAvailable', info.get('MemFree'))
+
+    try:
+        total = subprocess.check_output(['sysctl', '-n', 'hw.memsize'])
+        return int(total) // (1024 * 1024), None
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        pass
+
+    sys.exit('Could not determine the host memory, use --host-memory.')
+
+
+def host_cpus():
+    """
+    Return the number of host CPUs.
+    """
+
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def port_is_free(port):
+    """
+    Check that nothing is listening on localhost:port.
+    """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+class Build(object):
+    """
+    A single box build and its result.
+    """
+
+    def __init__(self, iso, console_port, build_dir, memory=VM_MEMORY):
+        self.iso = iso
+        self.vmname = os.path.basename(os.path.splitext(iso)[0])
+        self.console_port = console_port
+        self.build_dir = build_dir
+        self.memory = memory
+        self.box = os.path.join(build_dir, self.vmname + '.box')
+        self.build_log = os.path.join(build_dir, 'build.log')
+        self.console_log = os.path.join(build_dir, 'console.log.gz')
+        self.returncode = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def status(self):
+        if self.started is None:
+            return 'waiting'
+        if self.returncode is None:
+            return 'running'
+        if self.returncode == 0 and os.path.exists(self.box):
+            return 'ok'
+        return 'failed'
+
+
+def run_build(build, builder_args):
+    """
+    Run iosxe_iso2vbox.py for one build and wait for it to finish.
+
+    builder_args are passed through unchanged (e.g. ['--create_ova']).
+    """
+
+    builder = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                           'iosxe_iso2vbox.py')
+    cmd = [sys.executable, builder, build.iso,
+           '--console-port', str(build.console_port),
+           '--base-dir', os.path.dirname(build.build_dir),
+           '--log-file', build.console_log,
+           '--memory', str(build.memory),
+           '--nocolor', '--verbose'] + list(builder_args)
+
+    if not os.path.exists(build.build_dir):
+        os.makedirs(build.build_dir)
+
+    logger.info("'%s'", ' '.join(cmd))
+    build.started = time.time()
+    with open(build.build_log, 'w') as log:
+        build.returncode = subprocess.call(cmd, stdout=log,
+                                           stderr=subprocess.STDOUT)
+    build.finished = time.time()
+
+    if build.status == 'ok':
+        logger.warn('Finished %s in %d s', build.vmname, build.duration)
+    else:
+        logger.error('Build of %s failed, see %s', build.vmname, build.build_log)
+
+
+class Farm(object):
+    """
+    Admit builds while host RAM and CPUs allow and run them in threads.
+    """
+
+    def __init__(self, builds, builder_args=(), max_jobs=None,
+                 host_total=None, reserve=HOST_RESERVE):
+        self.builds = builds
+        self.builder_args = builder_args
+        self.reserve = reserve
+        # an overridden host memory plans for another machine, the live
+        # memory of this one doesn't count then
+        self.planned = host_total is not None
+        total, _ = host_memory() if host_total is None else (host_total, None)
+        self.budget = total - reserve
+        self.max_jobs = min(max_jobs or host_cpus(), host_cpus())
+        self.threads = []
+
+    def running(self):
+        return [b for b in self.builds if b.status == 'running']
+
+    def can_admit(self, build):
+        running = self.running()
+        if len(running) >= self.max_jobs:
+            return False
+
+        committed = sum(b.memory for b in running)
+        if committed + build.memory > self.budget:
+            return False
+
+        if self.planned:
+            return True
+
+        # VMs that are still booting have not touched all of their memory
+        # yet, so only ask the OS once nothing else is starting up.
+        _, available = host_memory()
+        if available is not None and running and \
+                available - self.reserve < build.memory:
+            logger.debug('Only %d MB available, holding back %s',
+                         available, build.vmname)
+            return False
+
+        return True
+
+    def start(self, build):
+        logger.warn('Starting build of %s (console port %d)',
+                    build.vmname, build.console_port)
+        build.started = time.time()
+        t = threading.Thread(target=run_build,
+                             args=(build, self.builder_args))
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def run(self):
+        for build in self.builds:
+            if build.memory > self.budget:
+                sys.exit('%s needs %d MB, but only %d MB can be used for VMs'
+                         % (build.vmname, build.memory, self.budget))
+
+        logger.warn('Building %d boxes, up to %d at once within %d MB',
+                    len(self.builds), self.max_jobs, self.budget)
+
+        waiting = list(self.builds)
+        while waiting:
+            if self.can_admit(waiting[0]):
+                self.start(waiting.pop(0))
+                # give VirtualBox a moment to claim the VM memory
+                time.sleep(1)
+                continue
+            time.sleep(SCHEDULE_INTERVAL)
+
+        for t in self.threads:
+            while t.is_alive():
+                t.join(SCHEDULE_INTERVAL)
+
+    def report(self):
+        """
+        Print a result table and return True if all builds succeeded.
+        """
+
+        width = max(len(b.vmname) for b in self.builds)
+        print()
+        print('%-*s  %-7s  %8s  %s' % (width, 'VM', 'STATUS', 'TIME', 'RESULT'))
+        for b in self.builds:
+            result = b.box if b.status == 'ok' else b.build_log
+            print('%-*s  %-7s  %7ds  %s' % (width, b.vmname, b.status,
+                                            b.duration, result))
+        print()
+        return all(b.status == 'ok' for b in self.builds)
+
+
+def allocate_ports(count, first=BASE_CONSOLE_PORT, taken=()):
+    """
+    Return count free console ports, starting at first.
+
+    Ports in taken are skipped: they belong to builds whose VM may not be
+    listening on them yet.
+    """
+
+    ports = []
+    port = first
+    while len(ports) < count:
+        if port > 65535:
+            sys.exit('Ran out of free console ports.')
+        if port not in taken and port_is_free(port):
+            ports.append(port)
+        port += 1
+    return ports
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Build IOS XE Vagrant boxes for several ISOs in parallel.
+
+            As many builds run at once as host RAM and CPUs allow.
+        '''),
+        epilog=textwrap.dedent('''\
+            E.g.:
+                %(prog)s csr1000v-universalk9.16.06.02.iso csr1000v-universalk9.16.07.01.iso
+        '''))
+
+    parser.add_argument('ISO_FILE', nargs='+',
+                        help='local ISO filenames or remote URI ISO filenames')
+    parser.add_argument('-o', '--create_ova', action='store_true',
+                        help='additionally use VBoxManage to export an OVA')
+    parser.add_argument('-b', '--base-dir', default=os.path.join(os.getcwd(), 'created_boxes'),
+                        help='folder for the VMs and created boxes (default: ./created_boxes)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='maximum number of builds at once (default: number of CPUs)')
+    parser.add_argument('-m', '--memory', type=int, default=VM_MEMORY,
+                        help='memory per VM in MB (default: %(default)s)')
+    parser.add_argument('-r', '--reserve', type=int, default=HOST_RESERVE,
+                        help='host memory in MB kept free of VMs (default: %(default)s)')
+    parser.add_argument('--host-memory', type=int,
+                        help='plan for this much host memory in MB instead of the '
+                             'memory of this host')
+    parser.add_argument('-p', '--base-port', type=int, default=BASE_CONSOLE_PORT,
+                        help='first console port to hand out (default: %(default)s)')
+    parser.add_argument('-v', '--verbose',
+                        action='store_const', const=logging.INFO,
+                        default=logging.WARN, help='turn on verbose messages')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.verbose, format="==> %(message)s")
+
+    vmnames = [os.path.basename(os.path.splitext(iso)[0]) for iso in args.ISO_FILE]
+    if len(set(vmnames)) != len(vmnames):
+        sys.exit('Every ISO must have a unique filename, the VM is named after it.')
+
+    base_dir = os.path.abspath(args.base_dir)
+    ports = allocate_ports(len(args.ISO_FILE), args.base_port)
+    builds = [Build(iso, port, os.path.join(base_dir, vmname), args.memory)
+              for iso, port, vmname in zip(args.ISO_FILE, ports, vmnames)]
+
+    builder_args = ['--create_ova'] if args.create_ova else []
+    farm = Farm(builds, builder_args, max_jobs=args.jobs,
+                host_total=args.host_memory, reserve=args.reserve)
+    farm.run()
+
+    if not farm.report():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
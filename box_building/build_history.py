@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+'''
+History of box build durations, with regression detection.
+
+Every build of iosxe_iso2vbox.py and nxosv_vbox_prep.py appends its phase
+timings (see build_trace.py), the sizes of its artifacts and a description
+of the host to a SQLite database, by default
+~/.cache/vagrant_net_prog/build_history.db.
+
+The report compares the latest build of every platform and version family
+(16.07 for IOS XE 16.07.01, 7.0.3.I7 for NX-OS 7.0.3.I7.1) with the builds
+before it: per phase, against the median of the last --window builds of
+the same family, or of the platform if the family has no history yet (a
+new release).  Only builds made with the same phase shaping options count
+(a cached disk, --split, --bulk, --saved-state, the packer, ...), a build
+isn't judged against builds that skipped or added minutes of work.  A phase is a regression if it is a significant outlier for
+the baseline (robust z-score over the median absolute deviation above
+--threshold) and also slower by a relevant amount (--min-increase and
+--min-seconds), so a jittery 3 second phase doesn't fail the report.
+The exit status is 1 if there are regressions, for CI gating.
+
+E.g.:
+    python build_history.py list
+    python build_history.py report
+    python build_history.py report --platform iosxe --window 5
+'''
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import platform as host_platform
+import textwrap
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY = os.path.join(os.path.expanduser('~'), '.cache',
+                               'vagrant_net_prog', 'build_history.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    platform TEXT NOT NULL,
+    version TEXT NOT NULL,
+    family TEXT NOT NULL,
+    started REAL NOT NULL,
+    seconds REAL NOT NULL,
+    host TEXT NOT NULL,
+    host_info TEXT NOT NULL,
+    options TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    build_id INTEGER NOT NULL REFERENCES builds(id),
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    build_id INTEGER NOT NULL REFERENCES builds(id),
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_family ON builds (platform, family, id);
+'''
+
+# Builds in the baseline of a phase
+WINDOW = 10
+
+# Fewer baseline builds than this and a phase isn't judged
+MIN_SAMPLES = 3
+
+# Robust z-score above which a phase is an outlier
+THRESHOLD = 3.5
+
+# ... and it has to be this much slower as well, relative and absolute
+MIN_INCREASE = 0.25
+MIN_SECONDS = 5.0
+
+# Build options that change phase durations, a baseline has the same ones
+PHASE_OPTIONS = ('serial', 'bulk', 'split', 'cached_disk', 'compression',
+                 'saved_state', 'vagrant_package', 'vagrant_up')
+
+
+def phase_options(options):
+    """
+    Return the phase shaping options of a build from its stored options.
+    """
+
+    if not isinstance(options, dict):
+        options = json.loads(options or '{}')
+    return dict((key, options.get(key)) for key in PHASE_OPTIONS)
+
+
+def version_family(version):
+    """
+    Return the release family of a version: 16.07.01 -> 16.07,
+    7.0.3.I7.1 -> 7.0.3.I7.
+    """
+
+    return version.rsplit('.', 1)[0] if '.' in version else version
+
+
+def host_info(vbox_version=None):
+    """
+    Describe the build host.
+    """
+
+    import build_farm
+    try:
+        memory = build_farm.host_memory()[0]
+    except SystemExit:
+        memory = None
+    info = {'os': host_platform.system(), 'release': host_platform.release(),
+            'python': host_platform.python_version(),
+            'cpus': build_farm.host_cpus(), 'memory_mb': memory}
+    if vbox_version:
+        if isinstance(vbox_version, bytes):
+            vbox_version = vbox_version.decode('utf-8', 'replace')
+        info['virtualbox'] = vbox_version.strip()
+    return info
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def judge(value, baseline, threshold=THRESHOLD, min_increase=MIN_INCREASE,
+          min_seconds=MIN_SECONDS):
+    """
+    Return (median, z-score, regression) of value against the baseline
+    values.  z-score is None if the baseline doesn't vary.
+    """
+
+    center = median(baseline)
+    mad = median([abs(v - center) for v in baseline]) * 1.4826
+    z = (value - center) / mad if mad > 0 else None
+    slower = value - center >= max(min_seconds, center * min_increase)
+    return center, z, slower and (z is None or z > threshold)
+
+
+class BuildHistory(object):
+    """
+    SQLite store of build timings.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def record(self, platform, version, phases, artifacts=None, info=None,
+               options=None, started=None):
+        """
+        Add a build: phases as (phase, seconds), artifacts as name -> path.
+        Returns the build id.
+        """
+
+        with self.db:
+            cur = self.db.execute(
+                'INSERT INTO builds (platform, version, family, started, seconds, '
+                'host, host_info, options) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (platform, version, version_family(version),
+                 started or time.time(), sum(s for _, s in phases),
+                 socket.gethostname(), json.dumps(info or {}, sort_keys=True),
+                 json.dumps(options or {}, sort_keys=True)))
+            build_id = cur.lastrowid
+            self.db.executemany(
+                'INSERT INTO phases (build_id, phase, seconds) VALUES (?, ?, ?)',
+                [(build_id, phase, seconds) for phase, seconds in phases])
+            self.db.executemany(
+                'INSERT INTO artifacts (build_id, name, size) VALUES (?, ?, ?)',
+                [(build_id, name, os.path.getsize(path))
+                 for name, path in sorted((artifacts or {}).items())
+                 if os.path.exists(path)])
+        return build_id
+
+    def builds(self, platform=None, limit=None):
+        sql = 'SELECT * FROM builds'
+        params = []
+        if platform:
+            sql += ' WHERE platform = ?'
+            params.append(platform)
+        sql += ' ORDER BY id DESC'
+        if limit:
+            sql += ' LIMIT %d' % limit
+        return self.db.execute(sql, params).fetchall()
+
+    def phases(self, build_id):
+        return [(row['phase'], row['seconds']) for row in self.db.execute(
+            'SELECT phase, seconds FROM phases WHERE build_id = ? ORDER BY rowid',
+            (build_id,))]
+
+    def artifacts(self, build_id):
+        return dict((row['name'], row['size']) for row in self.db.execute(
+            'SELECT name, size FROM artifacts WHERE build_id = ?', (build_id,)))
+
+    def latest(self, platform=None):
+        """
+        Return the latest build of every platform and family.
+        """
+
+        sql = 'SELECT * FROM builds WHERE id IN (SELECT MAX(id) FROM builds'
+        params = []
+        if platform:
+            sql += ' WHERE platform = ?'
+            params.append(platform)
+        sql += ' GROUP BY platform, family) ORDER BY platform, family'
+        return self.db.execute(sql, params).fetchall()
+
+    def baseline(self, build, window=WINDOW):
+        """
+        Return (scope, {phase: [seconds]}) of the builds before build with
+        the same phase shaping options in its family, or in its platform if
+        there are too few of those.
+        """
+
+        options = phase_options(build['options'])
+        for scope, sql, params in [
+                ('family', 'platform = ? AND family = ?',
+                 (build['platform'], build['family'])),
+                ('platform', 'platform = ?', (build['platform'],))]:
+            ids = []
+            for row in self.db.execute(
+                    'SELECT id, options FROM builds WHERE %s AND id < ? '
+                    'ORDER BY id DESC' % sql, params + (build['id'],)):
+                if phase_options(row['options']) == options:
+                    ids.append(row['id'])
+                    if len(ids) == window:
+                        break
+            if len(ids) >= MIN_SAMPLES:
+                break
+        samples = {}
+        for build_id in ids:
+            for phase, seconds in self.phases(build_id):
+                samples.setdefault(phase, []).append(seconds)
+            samples.setdefault('total', []).append(
+                sum(seconds for _, seconds in self.phases(build_id)))
+        return scope, samples
+
+    def report(self, platform=None, window=WINDOW, threshold=THRESHOLD,
+               min_increase=MIN_INCREASE, min_seconds=MIN_SECONDS, out=sys.stdout):
+        """
+        Print the latest builds against their baselines, return the
+        regressions as (build, phase, seconds, baseline median).
+        """
+
+        regressions = []
+        for build in self.latest(platform):
+            scope, samples = self.baseline(build, window)
+            phases = self.phases(build['id'])
+            phases.append(('total', sum(seconds for _, seconds in phases)))
+            print('%s %s (build %d on %s, baseline: %s)' % (
+                build['platform'], build['version'], build['id'], build['host'],
+                '%d builds of the %s' % (len(samples.get('total', [])), scope)
+                if samples else 'none'), file=out)
+            print('  %-28s %9s %9s %7s' % ('PHASE', 'SECONDS', 'BASELINE', 'Z'),
+                  file=out)
+            for phase, seconds in phases:
+                baseline = samples.get(phase, [])
+                if len(baseline) < MIN_SAMPLES:
+                    print('  %-28s %9.1f %9s %7s' % (phase, seconds, '-', '-'), file=out)
+                    continue
+                center, z, regression = judge(seconds, baseline, threshold,
+                                              min_increase, min_seconds)
+                print('  %-28s %9.1f %9.1f %7s%s' % (
+                    phase, seconds, center, '-' if z is None else '%.1f' % z,
+                    '  REGRESSION' if regression else ''), file=out)
+                if regression:
+                    regressions.append((build, phase, seconds, center))
+        return regressions
+
+
+def record_build(history, platform, version, artifacts=None, vbox_version=None,
+                 options=None):
+    """
+    Record the phases timed so far by build_trace in the history at path
+    history.  A build history that can't be written doesn't fail the build.
+    """
+
+    import build_trace
+    build_trace.phase(None)
+    try:
+        build_id = BuildHistory(history).record(
+            platform, version, build_trace.current().phases(), artifacts,
+            host_info(vbox_version), options)
+        logger.info('Recorded build %d in %s', build_id, history)
+        return build_id
+    except (sqlite3.Error, IOError, OSError) as e:
+        logger.warn('Could not record the build in %s: %s', history, e)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Show the build history and check the latest builds for regressions.
+        '''))
+    parser.add_argument('-d', '--history', default=DEFAULT_HISTORY,
+                        help='history database (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    show = commands.add_parser('list', help='show the recorded builds')
+    show.add_argument('--platform', choices=('iosxe', 'nxos'))
+    show.add_argument('-n', '--limit', type=int, default=20,
+                      help='builds to show (default: %(default)s)')
+    report = commands.add_parser('report', help='compare the latest builds with '
+                                 'their baseline, exit 1 on regressions')
+    report.add_argument('--platform', choices=('iosxe', 'nxos'))
+    report.add_argument('--window', type=int, default=WINDOW,
+                        help='builds in the baseline (default: %(default)s)')
+    report.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='robust z-score of a regression (default: %(default)s)')
+    report.add_argument('--min-increase', type=float, default=MIN_INCREASE,
+                        help='relative slowdown of a regression (default: %(default)s)')
+    report.add_argument('--min-seconds', type=float, default=MIN_SECONDS,
+                        help='absolute slowdown of a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+    try:
+        history = BuildHistory(args.history)
+        if args.command == 'list':
+            for build in history.builds(args.platform, args.limit):
+                sizes = history.artifacts(build['id'])
+                print('%5d  %s  %-6s %-12s %8.1f s  %-16s %s' % (
+                    build['id'],
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(build['started'])),
+                    build['platform'], build['version'], build['seconds'],
+                    build['host'], ' '.join('%s=%dMB' % (name, size // 1024 ** 2)
+                                            for name, size in sorted(sizes.items()))))
+        elif args.command == 'report':
+            regressions = history.report(args.platform, args.window, args.threshold,
+                                         args.min_increase, args.min_seconds)
+            if regressions:
+                for build, phase, seconds, center in regressions:
+                    logger.warn('%s %s: %s took %.1f s, baseline %.1f s',
+                                build['platform'], build['version'], phase,
+                                seconds, center)
+                sys.exit(1)
+        else:
+            parser.print_help()
+    except sqlite3.Error as e:
+        sys.exit('%s: %s' % (args.history, e))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
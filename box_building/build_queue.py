@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+'''
+Distribute box builds over several hosts through a shared job queue.
+
+The queue is a SQLite database, typically on storage every build host can
+reach.  Jobs are submitted with the platform (iosxe or nxos) and the source
+image (an IOS XE ISO or an NX-OS base box).  Idle workers lease the next job,
+run the regular build script for it (iosxe_iso2vbox.py through build_farm.py,
+or nxosv_vbox_prep.py) and publish the resulting .box into a common
+created_boxes tree.
+
+A worker runs several jobs at once, admitted like the builds of
+build_farm.py: only while the memory of their VMs fits into the host RAM
+minus a reserve, and never more than CPUs (or --jobs).  The worker hands
+out the console ports of its IOS XE builds itself, so run one worker per
+host.  NX-OS builds have a console socket per VM.
+
+A leased job is kept alive by heartbeats from its worker.  If a worker dies,
+its lease runs out and the job is handed to the next idle worker, up to
+--attempts times.
+
+Sources and the publish folder must be reachable under the same path on all
+hosts.  Keep the database on a local disk or on storage with working POSIX
+locks, SQLite does not cope with NFS mounts that lack them.
+
+E.g.:
+    coordinator:
+        python build_queue.py -q /shared/queue.db submit iosxe /shared/isos/csr1000v-universalk9.16.07.01.iso
+        python build_queue.py -q /shared/queue.db submit nxos /shared/boxes/nxosv-final.7.0.3.I7.1.box
+        python build_queue.py -q /shared/queue.db status
+    each build host:
+        python build_queue.py -q /shared/queue.db worker --publish-dir /shared/created_boxes
+'''
+
+from __future__ import print_function
+import sys
+import os
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import subprocess
+import threading
+import logging
+import textwrap
+
+import build_farm
+
+logger = logging.getLogger(__name__)
+
+PLATFORMS = ('iosxe', 'nxos')
+
+# Seconds a lease is valid without a heartbeat
+LEASE_TIME = 120
+
+# Seconds between heartbeats, well within LEASE_TIME
+HEARTBEAT_INTERVAL = 30
+
+# Seconds an idle worker waits before looking for work again
+POLL_INTERVAL = 10
+
+# How often a job is tried before it is marked as failed
+MAX_ATTEMPTS = 3
+
+# Memory of the build VM per platform, as the build scripts set it
+VM_MEMORY = {
+    'iosxe': build_farm.VM_MEMORY,
+    'nxos': 4096,
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    platform TEXT NOT NULL,
+    source TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT
+)
+'''
+
+
+def box_name(platform, source):
+    """
+    Return the name of the box a build produces, as the build scripts do.
+    """
+
+    filename = os.path.basename(source)
+    if platform == 'nxos':
+        version = filename[filename.find(".")+1:len(filename)-4]
+        return "nxos_{}".format(version)
+    return os.path.splitext(filename)[0]
+
+
+class JobQueue(object):
+    """
+    SQLite backed job queue with leases.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # autocommit, transactions are started explicitly where needed
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.db.execute(SCHEMA)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params)
+
+    def submit(self, platform, source, max_attempts=MAX_ATTEMPTS):
+        if platform not in PLATFORMS:
+            raise ValueError('Unknown platform %s' % platform)
+        cur = self.execute(
+            'INSERT INTO jobs (platform, source, name, max_attempts, submitted) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (platform, source, box_name(platform, source), max_attempts,
+             time.time()))
+        return cur.lastrowid
+
+    def lease(self, worker, lease_time=LEASE_TIME):
+        """
+        Lease the oldest runnable job to worker, return it or None.
+
+        Jobs whose lease ran out are runnable again.  Jobs that already used
+        up their attempts are marked as failed instead.
+        """
+
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute(
+                    "UPDATE jobs SET state = 'failed', finished = ?, "
+                    "result = 'lease expired after ' || attempts || ' attempts' "
+                    "WHERE state = 'leased' AND lease_expires < ? "
+                    "AND attempts >= max_attempts", (now, now))
+                job = self.db.execute(
+                    "SELECT * FROM jobs WHERE state = 'queued' "
+                    "OR (state = 'leased' AND lease_expires < ?) "
+                    "ORDER BY id LIMIT 1", (now,)).fetchone()
+                if job is not None:
+                    if job['state'] == 'leased':
+                        logger.warn('Lease of job %d held by %s expired, retrying',
+                                    job['id'], job['worker'])
+                    self.db.execute(
+                        "UPDATE jobs SET state = 'leased', worker = ?, "
+                        "lease_expires = ?, attempts = attempts + 1, "
+                        "started = ? WHERE id = ?",
+                        (worker, now + lease_time, now, job['id']))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return job
+
+    def heartbeat(self, job_id, worker, lease_time=LEASE_TIME):
+        """
+        Extend the lease, return False if worker no longer holds it.
+        """
+
+        cur = self.execute(
+            "UPDATE jobs SET lease_expires = ? "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + lease_time, job_id, worker))
+        return cur.rowcount == 1
+
+    def finish(self, job_id, worker, ok, result):
+        """
+        Record the outcome of a job.
+
+        A failed job goes back into the queue while it has attempts left.
+        """
+
+        if ok:
+            state = "'done'"
+        else:
+            state = "CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END"
+        self.execute(
+            "UPDATE jobs SET state = " + state + ", finished = ?, result = ?, "
+            "lease_expires = NULL WHERE id = ? AND worker = ?",
+            (time.time(), result, job_id, worker))
+
+    def jobs(self):
+        return self.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+
+    def pending(self):
+        row = self.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'leased')").fetchone()
+        return row[0]
+
+
+class Heartbeat(threading.Thread):
+    """
+    Keep the lease of a running job alive.
+    """
+
+    def __init__(self, queue, job_id, worker, interval=HEARTBEAT_INTERVAL):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.job_id = job_id
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.queue.heartbeat(self.job_id, self.worker):
+                logger.error('Lost the lease on job %d', self.job_id)
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def build_iosxe(build):
+    """
+    Build an IOS XE box with iosxe_iso2vbox.py, return the box path or None.
+    """
+
+    build_farm.run_build(build, [])
+    return build.box if build.status == 'ok' else None
+
+
+def build_nxos(build):
+    """
+    Build an NX-OS box with nxosv_vbox_prep.py, return the box path or None.
+
+    nxosv_vbox_prep.py works in the current directory, so every job gets its
+    own.
+    """
+
+    name = box_name('nxos', build.iso)
+    if not os.path.exists(build.build_dir):
+        os.makedirs(build.build_dir)
+
+    builder = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                           'nxosv_vbox_prep.py')
+    cmd = [sys.executable, builder, build.iso, '--nocolor', '--verbose']
+    logger.info("'%s'", ' '.join(cmd))
+    with open(build.build_log, 'w') as log:
+        build.returncode = subprocess.call(cmd, cwd=build.build_dir, stdout=log,
+                                           stderr=subprocess.STDOUT)
+    build.finished = time.time()
+
+    box = os.path.join(build.build_dir, 'created_boxes', name, name + '.box')
+    return box if build.returncode == 0 and os.path.exists(box) else None
+
+
+BUILDERS = {
+    'iosxe': build_iosxe,
+    'nxos': build_nxos,
+}
+
+
+def publish(box, publish_dir, name):
+    """
+    Copy box to publish_dir/<name>/<name>.box.
+
+    The box is copied next to its final name first and then renamed, so
+    nobody ever sees a partial box.
+    """
+
+    target_dir = os.path.join(publish_dir, name)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    target = os.path.join(target_dir, name + '.box')
+    partial = '%s.%s.%d.part' % (target, socket.gethostname(), os.getpid())
+    shutil.copyfile(box, partial)
+    os.rename(partial, target)
+    return target
+
+
+def run_job(queue, worker, job, build, publish_dir):
+    """
+    Build and publish a leased job, keeping its lease alive meanwhile.
+    """
+
+    heartbeat = Heartbeat(queue, job['id'], worker)
+    heartbeat.start()
+    try:
+        box = BUILDERS[job['platform']](build)
+        if box is not None and not heartbeat.lost:
+            box = publish(box, publish_dir, job['name'])
+    except Exception:
+        logger.exception('Job %d failed', job['id'])
+        box = None
+    finally:
+        if build.returncode is None:
+            build.returncode = -1
+        heartbeat.stop()
+
+    if heartbeat.lost:
+        # someone else has the job by now, don't touch its record
+        return
+    if box is None:
+        queue.finish(job['id'], worker, False, 'build failed on %s' % worker)
+    else:
+        queue.finish(job['id'], worker, True, box)
+        logger.warn('Job %d: published %s', job['id'], box)
+
+
+def work(queue, worker, work_dir, publish_dir, once=False, max_jobs=None,
+         host_total=None, reserve=build_farm.HOST_RESERVE):
+    """
+    Lease and build jobs until the queue is empty (once) or forever.
+
+    A job is only leased while build_farm admits one more VM of the largest
+    platform, up to max_jobs builds run at once.
+    """
+
+    farm = build_farm.Farm([], max_jobs=max_jobs, host_total=host_total,
+                           reserve=reserve)
+    largest = build_farm.Build('next', None, work_dir, max(VM_MEMORY.values()))
+    while True:
+        farm.threads = [t for t in farm.threads if t.is_alive()]
+        farm.builds = farm.running()
+        if not farm.can_admit(largest):
+            time.sleep(build_farm.SCHEDULE_INTERVAL)
+            continue
+
+        job = queue.lease(worker)
+        if job is None:
+            if once and not farm.threads:
+                return
+            # a running job may fail and be queued again
+            time.sleep(build_farm.SCHEDULE_INTERVAL if farm.threads else POLL_INTERVAL)
+            continue
+
+        port = None
+        if job['platform'] == 'iosxe':
+            # ports of running builds may not be bound by their VM yet
+            port = build_farm.allocate_ports(
+                1, taken=[b.console_port for b in farm.builds])[0]
+        build = build_farm.Build(job['source'], port,
+                                 os.path.join(work_dir, job['name']),
+                                 VM_MEMORY[job['platform']])
+        logger.warn('Job %d: building %s box from %s%s', job['id'],
+                    job['platform'], job['source'],
+                    ' (console port %d)' % port if port else '')
+        build.started = time.time()
+        farm.builds.append(build)
+        t = threading.Thread(target=run_job,
+                             args=(queue, worker, job, build, publish_dir))
+        t.daemon = True
+        t.start()
+        farm.threads.append(t)
+        # give VirtualBox a moment to claim the VM memory
+        time.sleep(1)
+
+
+def print_status(queue):
+    jobs = queue.jobs()
+    if not jobs:
+        print('No jobs.')
+        return
+
+    width = max(len(j['name']) for j in jobs)
+    print('%4s  %-5s  %-*s  %-6s  %3s  %-20s  %8s  %s' % (
+        'ID', 'TYPE', width, 'NAME', 'STATE', 'TRY', 'WORKER', 'TIME', 'RESULT'))
+    for j in jobs:
+        if j['started'] is None:
+            duration = ''
+        else:
+            duration = '%ds' % ((j['finished'] or time.time()) - j['started'])
+        print('%4d  %-5s  %-*s  %-6s  %3d  %-20s  %8s  %s' % (
+            j['id'], j['platform'], width, j['name'], j['state'],
+            j['attempts'], j['worker'] or '', duration, j['result'] or ''))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Queue box builds and work them off on several build hosts.
+        '''),
+        epilog=textwrap.dedent('''\
+            E.g.:
+                %(prog)s -q /shared/queue.db submit iosxe /shared/isos/csr1000v-universalk9.16.07.01.iso
+                %(prog)s -q /shared/queue.db worker --publish-dir /shared/created_boxes
+                %(prog)s -q /shared/queue.db status
+        '''))
+    parser.add_argument('-q', '--queue', required=True,
+                        help='SQLite queue database, created if missing')
+    parser.add_argument('-v', '--verbose',
+                        action='store_const', const=logging.INFO,
+                        default=logging.WARN, help='turn on verbose messages')
+    commands = parser.add_subparsers(dest='command')
+
+    submit = commands.add_parser('submit', help='queue builds')
+    submit.add_argument('PLATFORM', choices=PLATFORMS)
+    submit.add_argument('SOURCE', nargs='+',
+                        help='IOS XE ISOs or NX-OS base boxes')
+    submit.add_argument('--attempts', type=int, default=MAX_ATTEMPTS,
+                        help='how often to try each build (default: %(default)s)')
+
+    worker = commands.add_parser('worker', help='build queued jobs')
+    worker.add_argument('--publish-dir', required=True,
+                        help='common created_boxes folder for the finished boxes')
+    worker.add_argument('--work-dir', default=os.path.join(os.getcwd(), 'created_boxes'),
+                        help='local folder for the builds (default: ./created_boxes)')
+    worker.add_argument('--name', default='%s-%d' % (socket.gethostname(), os.getpid()),
+                        help='worker name shown in the status (default: host-pid)')
+    worker.add_argument('--once', action='store_true',
+                        help='exit when the queue is empty instead of waiting for jobs')
+    worker.add_argument('-j', '--jobs', type=int,
+                        help='maximum number of builds at once (default: number of CPUs)')
+    worker.add_argument('-r', '--reserve', type=int, default=build_farm.HOST_RESERVE,
+                        help='host memory in MB kept free of VMs (default: %(default)s)')
+    worker.add_argument('--host-memory', type=int,
+                        help='override the detected host memory in MB')
+
+    commands.add_parser('status', help='show all jobs')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.verbose, format="==> %(message)s")
+
+    queue = JobQueue(args.queue)
+
+    if args.command == 'submit':
+        for source in args.SOURCE:
+            # local sources are handed to workers with a full path
+            if not os.path.isabs(source) and ':/' not in source:
+                source = os.path.abspath(source)
+            job_id = queue.submit(args.PLATFORM, source, args.attempts)
+            logger.warn('Queued job %d: %s %s', job_id, args.PLATFORM, source)
+    elif args.command == 'worker':
+        work(queue, args.name, os.path.abspath(args.work_dir),
+             os.path.abspath(args.publish_dir), once=args.once,
+             max_jobs=args.jobs, host_total=args.host_memory, reserve=args.reserve)
+    elif args.command == 'status':
+        print_status(queue)
+        if queue.pending():
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+'''
+Span tracing of box builds.
+
+A build is a series of phases (fetch, VM create, install, configure,
+shutdown, compact, package, cleanup).  Within them, every run() call, every
+console dialog step and the export and compression work of the packer is
+recorded as a span, and syslog messages seen on the console (the boot
+marker, %VMAN-2-ACTIVATION_STATE, ...) as instant events.
+
+The trace is written as Chrome trace JSON, which chrome://tracing and
+https://ui.perfetto.dev open, with a summary table next to it.
+
+Tracing is off unless a builder is run with --trace.  Until then current()
+is a NullTracer, which only times the phases (a dozen per build) and whose
+other methods do nothing, so the instrumentation costs a method call per
+span.
+
+E.g.:
+    python iosxe_iso2vbox.py --trace csr1000v-universalk9.16.07.01.iso
+    python build_trace.py created_boxes/csr1000v-universalk9.16.07.01/csr1000v-universalk9.16.07.01-trace.json
+'''
+
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+import textwrap
+
+logger = logging.getLogger(__name__)
+
+# Syslog messages on the console, e.g.
+# %VMAN-2-ACTIVATION_STATE: Successfully activated virtual service 'guestshell+'
+# *Oct 17 10:00:00.000: %CRYPTO-6-GDOI_ON_OFF: GDOI is OFF
+SYSLOG = re.compile(r'%([A-Z0-9_]+-\d-[A-Z0-9_]+):[^\r\n]*')
+
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data if isinstance(data, type(u'')) else ''
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, time.time() - self.start,
+                             self.category, self.args)
+        return False
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _PhaseClock(object):
+    """
+    Time the phases of the build, one after the other.
+    """
+
+    def __init__(self):
+        self.phase_times = []
+        self.current_phase = None
+
+    def phase(self, name):
+        """
+        End the current phase of the build and start the next one; None
+        just ends it.
+        """
+
+        now = time.time()
+        if self.current_phase is not None:
+            phase, start = self.current_phase
+            self.phase_times.append((phase, now - start))
+            self.complete(phase, start, now - start, 'phase')
+        self.current_phase = (name, now) if name is not None else None
+
+    def phases(self):
+        """
+        Return (phase, seconds) of the phases ended so far.
+        """
+
+        return list(self.phase_times)
+
+
+class NullTracer(_PhaseClock):
+    """
+    Tracer used while tracing is off: it only keeps the phase durations,
+    for the build history (see build_history.py).
+    """
+
+    enabled = False
+
+    def span(self, name, category='span', **args):
+        return _NULL_SPAN
+
+    def complete(self, name, start, seconds, category='span', args=None):
+        pass
+
+    def instant(self, name, category='console', **args):
+        pass
+
+    def console(self, *texts):
+        pass
+
+
+class Tracer(_PhaseClock):
+    """
+    Record spans and events of one build, in memory.
+    """
+
+    enabled = True
+
+    def __init__(self, name):
+        _PhaseClock.__init__(self)
+        self.name = name
+        self.origin = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def _event(self, event):
+        event['pid'] = self.pid
+        event['tid'] = threading.current_thread().ident
+        event['_thread'] = threading.current_thread().name
+        with self.lock:
+            self.events.append(event)
+
+    def span(self, name, category='span', **args):
+        """
+        Context manager recording the block as a span.
+        """
+
+        return _Span(self, name, category, args)
+
+    def complete(self, name, start, seconds, category='span', args=None):
+        """
+        Record a span that started at start (time.time()) and took seconds.
+        """
+
+        self._event({'name': name, 'cat': category, 'ph': 'X',
+                     'ts': int((start - self.origin) * 1e6),
+                     'dur': int(seconds * 1e6), 'args': args or {}})
+
+    def instant(self, name, category='console', **args):
+        self._event({'name': name, 'cat': category, 'ph': 'i', 's': 'p',
+                     'ts': int((time.time() - self.origin) * 1e6), 'args': args})
+
+    def console(self, *texts):
+        """
+        Record the syslog messages in console output as events.
+        """
+
+        for match in SYSLOG.finditer(''.join(_text(text) for text in texts)):
+            self.instant(match.group(1), message=match.group(0).strip())
+
+    def trace(self):
+        """
+        Return the trace as a Chrome trace object.
+        """
+
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                   'args': {'name': self.name}}]
+        threads = {}
+        for event in self.events:
+            threads[event['tid']] = event['_thread']
+            events.append(dict((k, v) for k, v in event.items() if k != '_thread'))
+        for tid, name in sorted(threads.items()):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                           'tid': tid, 'args': {'name': name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'build': self.name, 'started': self.origin}}
+
+    def write(self, path):
+        """
+        End the current phase and write the Chrome trace to path and the
+        summary to path with .txt instead of .json.  Returns the summary.
+        """
+
+        self.phase(None)
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+        text = summary(self.trace())
+        with open(os.path.splitext(path)[0] + '.txt', 'w') as f:
+            f.write(text)
+        return text
+
+
+def summary(trace):
+    """
+    Return the summary table of a Chrome trace object: the phases with
+    their share of the build, the slowest spans and the console events.
+    """
+
+    events = [e for e in trace['traceEvents'] if e['ph'] in ('X', 'i')]
+    phases = [e for e in events if e['ph'] == 'X' and e['cat'] == 'phase']
+    total = sum(e['dur'] for e in phases) or 1
+    lines = ['%-36s %9s %6s' % ('PHASE', 'SECONDS', '%')]
+    for event in sorted(phases, key=lambda e: e['ts']):
+        lines.append('%-36s %9.1f %5.1f%%' % (event['name'], event['dur'] / 1e6,
+                                                100.0 * event['dur'] / total))
+    lines.append('%-36s %9.1f' % ('total', total / 1e6))
+
+    totals = {}
+    for event in events:
+        if event['ph'] == 'X' and event['cat'] != 'phase':
+            count, seconds = totals.get((event['cat'], event['name']), (0, 0))
+            totals[(event['cat'], event['name'])] = (count + 1, seconds + event['dur'] / 1e6)
+    if totals:
+        lines += ['', '%-36s %9s %6s' % ('SLOWEST SPANS', 'SECONDS', 'CALLS')]
+        slowest = sorted(totals.items(), key=lambda item: -item[1][1])[:15]
+        for (category, name), (count, seconds) in slowest:
+            lines.append('%-36s %9.1f %6d' % (('%s: %s' % (category, name))[:36],
+                                               seconds, count))
+
+    console = [e for e in events if e['ph'] == 'i']
+    if console:
+        lines += ['', '%-36s %9s' % ('CONSOLE EVENTS', 'AT')]
+        for event in sorted(console, key=lambda e: e['ts']):
+            lines.append('%-36s %9.1f' % (event['name'][:36], event['ts'] / 1e6))
+    return '\n'.join(lines) + '\n'
+
+
+_current = NullTracer()
+
+
+def current():
+    """
+    Return the tracer of this build, a NullTracer unless tracing is on.
+    """
+
+    return _current
+
+
+def start(name):
+    """
+    Switch tracing on for this process, return the Tracer.
+    """
+
+    global _current
+    _current = Tracer(name)
+    return _current
+
+
+def span(name, category='span', **args):
+    return _current.span(name, category, **args)
+
+
+def phase(name):
+    _current.phase(name)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Show the summary table of a build trace.
+        '''))
+    parser.add_argument('TRACE', help='Chrome trace JSON written with --trace')
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.TRACE) as f:
+            trace = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        sys.exit('%s: %s' % (args.TRACE, e))
+    sys.stdout.write(summary(trace))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
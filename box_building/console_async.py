@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+'''
+asyncio console driver: configure many devices from one process.
+
+configure_xe() and configure_nx() of the builders hold a blocking pexpect
+child per console, and wait up to 600 seconds in child.expect().  Here every console is a pair of asyncio streams straight
+to the TCP or unix socket uart, and AsyncConsole has the send/expect calls
+of the builders (sendline, expect, send_line, send_cmd, console dialogs
+and bulk_push) as coroutines.  So one thread drives dozens of consoles;
+each session has its own timeout and cancelling the orchestrator closes
+every console.
+
+The configuration scripts below are the same as those of the builders:
+they use the prompts, dialogs and baseline configurations of
+iosxe_iso2vbox.py and nxosv_vbox_prep.py.
+
+Python 3 only.
+
+E.g.:
+    python3 console_async.py iosxe tcp:65000 tcp:65001 tcp:65002 --bulk
+    python3 console_async.py nxos unix:/tmp/nx1 unix:/tmp/nx2 --timeout 1200 --log-dir logs
+
+    sessions = [console_async.Session('csr%d' % i, 'tcp:%d' % (65000 + i),
+                                      console_async.configure_xe, timeout=900)
+                for i in range(24)]
+    console_async.run_sessions(sessions, limit=12)
+'''
+
+import sys
+import os
+import re
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import textwrap
+
+import pexpect
+
+import build_trace
+import console_dialog
+import console_log
+from console_dialog import Step
+from console_transport import parse_address
+
+logger = logging.getLogger(__name__)
+
+CRLF = "\r\n"
+
+
+class ConsoleTimeout(console_dialog.DialogTimeout):
+    pass
+
+
+class ConsoleEOF(pexpect.EOF):
+    pass
+
+
+class ConsoleError(Exception):
+    pass
+
+
+def _bytes(data):
+    return data if isinstance(data, bytes) else data.encode('utf-8')
+
+
+class AsyncConsole(object):
+    """
+    A device console over asyncio streams, with the expect semantics of a
+    pexpect child: patterns are searched in the output not matched yet,
+    the earliest match wins, before and after hold the text in front of
+    and the text of the match.
+    """
+
+    def __init__(self, reader, writer, name, timeout=600, logfile=None):
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.timeout = timeout
+        self.logfile = logfile
+        self.buffer = b''
+        self.before = b''
+        self.after = b''
+        self.match = None
+        self.patterns = {}
+
+    @classmethod
+    async def open(cls, address, name=None, timeout=600, logfile=None,
+                   connect_timeout=30):
+        """
+        Connect to the console at tcp:PORT, tcp:HOST:PORT or unix:PATH.
+        """
+
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX:
+            connection = asyncio.open_unix_connection(addr)
+        else:
+            connection = asyncio.open_connection(*addr)
+        try:
+            reader, writer = await asyncio.wait_for(connection, connect_timeout)
+        except asyncio.TimeoutError:
+            raise ConsoleTimeout('%s: no connection within %s seconds'
+                                 % (address, connect_timeout))
+        return cls(reader, writer, name or address, timeout, logfile)
+
+    def close(self):
+        self.writer.close()
+
+    def _compile(self, patterns):
+        if not isinstance(patterns, (list, tuple)):
+            patterns = [patterns]
+        compiled = []
+        for pattern in patterns:
+            if not hasattr(pattern, 'search'):
+                if pattern not in self.patterns:
+                    self.patterns[pattern] = re.compile(_bytes(pattern), re.DOTALL)
+                pattern = self.patterns[pattern]
+            compiled.append(pattern)
+        return compiled
+
+    async def expect(self, patterns, timeout=-1, window=None):
+        """
+        Wait for one of patterns, return its index.
+
+        With window only the new output and the window bytes in front of
+        it are searched, older output is dropped a line at a time, like
+        console_dialog.expect_window().
+        """
+
+        if timeout == -1:
+            timeout = self.timeout
+        compiled = self._compile(patterns)
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        searched = 0
+        while True:
+            start = 0 if window is None else max(0, searched - window)
+            best = None
+            for index, pattern in enumerate(compiled):
+                match = pattern.search(self.buffer, start)
+                if match is not None and (best is None or match.start() < best[1].start()):
+                    best = (index, match)
+            if best is not None:
+                index, self.match = best
+                self.before = self.buffer[:self.match.start()]
+                self.after = self.match.group(0)
+                self.buffer = self.buffer[self.match.end():]
+                return index
+            if window is not None and len(self.buffer) > 2 * window:
+                cut = self.buffer.rfind(b'\n', 0, len(self.buffer) - window) + 1
+                if cut:
+                    build_trace.current().console(self.buffer[:cut])
+                    self.buffer = self.buffer[cut:]
+            searched = len(self.buffer)
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                raise ConsoleTimeout('%s: no match for %s within %s seconds'
+                                     % (self.name, patterns, timeout))
+            try:
+                data = await asyncio.wait_for(self.reader.read(4096), remaining)
+            except asyncio.TimeoutError:
+                raise ConsoleTimeout('%s: no match for %s within %s seconds'
+                                     % (self.name, patterns, timeout))
+            if not data:
+                self.before = self.buffer
+                raise ConsoleEOF('%s: console closed' % self.name)
+            if self.logfile is not None:
+                self.logfile.write(data)
+            self.buffer += data
+
+    async def send(self, s):
+        self.writer.write(_bytes(s))
+        await self.writer.drain()
+
+    async def sendline(self, s=''):
+        await self.send(_bytes(s) + os.linesep.encode('ascii'))
+
+    async def send_line(self, line=CRLF):
+        """
+        Send a line and wait for its echo, like send_line() of the builders.
+        """
+
+        await self.sendline(line)
+        if line != CRLF:
+            logger.debug('%s config: %s', self.name, line)
+            await self.expect(re.escape(line))
+
+    async def send_cmd(self, cmd, prompt):
+        """
+        Send a command (or list of lines) and wait for the prompt, like
+        send_cmd() of the builders.
+        """
+
+        if not isinstance(cmd, list):
+            cmd = [cmd]
+        for c in cmd:
+            await self.send_line(c)
+        await self.expect(prompt)
+
+    async def wait(self, dialog, step):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + step.timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise ConsoleTimeout("%s: no match for %s within %s seconds"
+                                     % (dialog.name, step.name, step.timeout))
+            if step.nudge is None:
+                return await self.expect(step.expect, remaining, step.window)
+            try:
+                return await self.expect(step.expect, min(step.nudge, remaining),
+                                         step.window)
+            except ConsoleTimeout:
+                logger.debug('%s: nudging console for %s', dialog.name, step.name)
+                await self.send('\r')
+
+    async def run_dialog(self, dialog, steps):
+        """
+        Run the steps of a console_dialog.Dialog, recording their timings
+        in it.
+        """
+
+        for step in steps:
+            start = time.time()
+            if step.expect is not None:
+                await self.wait(dialog, step)
+                build_trace.current().console(self.before, self.after)
+            waited = time.time() - start
+            if step.send is not None:
+                await self.sendline(step.send)
+            dialog.record(step.name, waited)
+        return dialog.timings
+
+
+async def bulk_push(console, blocks, prompt, window=console_dialog.BULK_WINDOW):
+    """
+    console_dialog.bulk_push() on an AsyncConsole.
+    """
+
+    stats = {'lines': 0, 'round_trips': 0, 'line_by_line': 0}
+    transcript = []
+
+    async def sync(pattern, count=1):
+        for _ in range(count):
+            await console.expect(pattern)
+            transcript.append(console.before + console.after)
+        stats['round_trips'] += 1
+
+    for name, lines in blocks:
+        logger.debug('%s: bulk push %s (%d lines)', console.name, name, len(lines))
+        pending = []
+        outstanding = 0
+        for line in lines:
+            await console.sendline(line)
+            pending.append(line)
+            outstanding += len(line) + 1
+            if outstanding >= window:
+                # identical lines further up echo first
+                await sync(console_dialog._echo(line), pending.count(line))
+                pending = []
+                outstanding = 0
+        if pending:
+            await sync(console_dialog._echo(pending[-1]), pending.count(pending[-1]))
+        await sync(prompt)
+        stats['lines'] += len(lines)
+        stats['line_by_line'] += 2 * len(lines)
+
+    errors = console_dialog.rejected_lines(
+        b''.join(transcript).decode('utf-8', 'replace'),
+        [line for _, lines in blocks for line in lines])
+    if errors:
+        raise console_dialog.BulkPushError('%s: lines rejected by the device:\n%s' % (
+            console.name, '\n'.join('  %s: %s' % (line, error) for line, error in errors)))
+    return stats
+
+
+async def configure_xe(console, wait=True, bulk=False):
+    """
+    configure_xe() of iosxe_iso2vbox.py over the console, without --split.
+    """
+
+    import iosxe_iso2vbox as xe
+
+    dialog = console_dialog.Dialog('IOS XE %s' % console.name)
+    console.timeout = xe.CONSOLE_TIMEOUT
+    if wait:
+        await console.run_dialog(dialog, [Step('boot', xe.XE_BOOT_MARKER,
+                                               timeout=xe.CONSOLE_TIMEOUT,
+                                               window=console_dialog.MARKER_WINDOW)])
+    await console.run_dialog(dialog, xe.XE_WAKE_DIALOG)
+    with dialog.timed('console config'):
+        if bulk:
+            await bulk_push(console, xe.XE_BASELINE_CONFIG, xe.XE_PROMPT)
+        else:
+            for _, lines in xe.XE_BASELINE_CONFIG:
+                for line in lines:
+                    await console.send_cmd(line, xe.XE_PROMPT)
+    await console.run_dialog(dialog, xe.XE_SAVE_DIALOG)
+    return dialog.timings
+
+
+async def configure_nx(console, wait=True):
+    """
+    configure_nx() of nxosv_vbox_prep.py over the console, without --split.
+    """
+
+    import nxosv_vbox_prep as nx
+
+    dialog = console_dialog.Dialog('NX-OS %s' % console.name)
+    console.timeout = nx.CONSOLE_TIMEOUT
+    if wait:
+        await console.run_dialog(dialog, [Step('boot', nx.NX_BOOT_MARKER,
+                                               timeout=nx.CONSOLE_TIMEOUT,
+                                               window=console_dialog.MARKER_WINDOW)])
+    await console.run_dialog(dialog, nx.NX_SETUP_DIALOG)
+    await console.send_cmd("term width 300", nx.NX_PROMPT)
+    await console.send_cmd("terminal length 0", nx.NX_PROMPT)
+    with dialog.timed('console config'):
+        for line in ["enable", "conf t"] + nx.NX_BASELINE_CONFIG:
+            await console.send_cmd(line, nx.NX_PROMPT)
+    with dialog.timed('boot image: show version'):
+        await console.send_cmd("show version", nx.NX_PROMPT)
+        version = console.before
+        await console.send_cmd("dir bootflash:", nx.NX_PROMPT)
+        boot_image = nx.boot_image_from_cli(version, console.before)
+    if boot_image is None:
+        await console.run_dialog(dialog, nx.NX_GUESTSHELL_ENABLE_DIALOG)
+        with dialog.timed('boot image: guestshell'):
+            await console.send_cmd("guestshell run ls /bootflash/nxos*", nx.NX_PROMPT)
+            try:
+                boot_image = nx.boot_image_name(console.before)
+            except SystemExit as e:
+                raise ConsoleError('%s: %s' % (console.name, e))
+        await console.run_dialog(dialog, nx.NX_GUESTSHELL_DESTROY_DIALOG)
+    await console.send_cmd("boot nxos bootflash:/{}".format(boot_image), nx.NX_PROMPT)
+    await console.send_cmd("end", nx.NX_PROMPT)
+    await console.run_dialog(dialog, nx.NX_SAVE_DIALOG)
+    return dialog.timings
+
+
+SCRIPTS = {'iosxe': configure_xe, 'nxos': configure_nx}
+
+
+class Session(object):
+    """
+    One console to drive: script(console, **kwargs) is run on the console
+    at address, and has timeout seconds (None: no limit) from connecting to
+    finishing.  Afterwards result holds what the script returned, or error
+    the exception it failed with, and seconds how long it ran.
+    """
+
+    def __init__(self, name, address, script, timeout=None, logfile=None, **kwargs):
+        self.name = name
+        self.address = address
+        self.script = script
+        self.timeout = timeout
+        self.logfile = logfile
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.seconds = None
+
+    async def drive(self, limit):
+        async with limit:
+            start = time.time()
+            logfile = console_log.ConsoleLog(self.logfile) if self.logfile else None
+            console = None
+            try:
+                console = await AsyncConsole.open(self.address, self.name, logfile=logfile)
+                self.result = await asyncio.wait_for(
+                    self.script(console, **self.kwargs), self.timeout)
+            except asyncio.TimeoutError:
+                self.error = ConsoleTimeout('%s: not done within %s seconds'
+                                            % (self.name, self.timeout))
+            except (pexpect.ExceptionPexpect, console_dialog.BulkPushError,
+                    ConsoleError, OSError) as e:
+                self.error = e
+            finally:
+                self.seconds = time.time() - start
+                if console is not None:
+                    console.close()
+                if logfile is not None:
+                    logfile.close()
+            if self.error is not None:
+                logger.warn('%s failed after %.1f s: %s', self.name, self.seconds, self.error)
+            else:
+                logger.info('%s done in %.1f s', self.name, self.seconds)
+        return self
+
+
+async def drive_sessions(sessions, limit=None):
+    """
+    Drive the sessions concurrently, at most limit at a time.  Cancelling
+    this coroutine cancels every session and closes its console.
+    """
+
+    semaphore = asyncio.Semaphore(limit or max(1, len(sessions)))
+    return await asyncio.gather(*[session.drive(semaphore) for session in sessions])
+
+
+def run_sessions(sessions, limit=None):
+    """
+    Drive the sessions in a new event loop, return those that failed.
+    """
+
+    asyncio.run(drive_sessions(sessions, limit))
+    return [session for session in sessions if session.error is not None]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Configure the devices on several consoles at once.
+        '''))
+    parser.add_argument('PLATFORM', choices=sorted(SCRIPTS))
+    parser.add_argument('ADDRESS', nargs='+', help='tcp:PORT, tcp:HOST:PORT or unix:PATH')
+    parser.add_argument('--no-wait', dest='wait', action='store_false',
+                        help="the devices are booted, don't wait for the boot marker")
+    parser.add_argument('--bulk', action='store_true',
+                        help='stream the IOS XE configuration block by block')
+    parser.add_argument('--timeout', type=float, default=1200,
+                        help='seconds per console (default: %(default)s)')
+    parser.add_argument('--limit', type=int,
+                        help='consoles driven at once (default: all)')
+    parser.add_argument('--log-dir', help='write a compressed transcript per console here')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="==> %(message)s")
+    kwargs = {'wait': args.wait}
+    if args.PLATFORM == 'iosxe':
+        kwargs['bulk'] = args.bulk
+    if args.log_dir and not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+    sessions = []
+    for address in args.ADDRESS:
+        logfile = None
+        if args.log_dir:
+            logfile = os.path.join(args.log_dir, re.sub(r'[^\w.-]', '_', address) + '.log')
+        sessions.append(Session(address, address, SCRIPTS[args.PLATFORM],
+                                args.timeout, logfile, **kwargs))
+    try:
+        failed = run_sessions(sessions, args.limit)
+    except KeyboardInterrupt:
+        sys.exit('Interrupted, consoles closed')
+    logger.info('%d of %d consoles configured', len(sessions) - len(failed), len(sessions))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
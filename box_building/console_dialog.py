@@ -0,0 +1,352 @@
+'''
+Prompt driven console dialogs for the box building scripts.
+
+A dialog is a list of steps.  Each step waits for one of its expected
+patterns on the console and then sends its response, so the dialog moves on
+as soon as the device is ready instead of sleeping for a guessed amount of
+time.  A step can nudge the console with a return while it waits, for
+prompts that only show up after a key press.
+
+pexpect searches everything read since the last match again after every
+read, and keeps all of it: waiting through a verbose boot for the boot
+marker is quadratic in the boot output.  A step with a window matches with
+expect_window() instead, which only searches the data just read and the
+tail of what came before it, and keeps at most window bytes of context.
+
+The time each step spent waiting is recorded, so slow spots in boot and
+configuration show up in the log, and in the build trace (see
+build_trace.py) along with the syslog messages the device printed.
+
+bulk_push() streams whole blocks of configuration to the console and only
+syncs on the prompt at block boundaries, checking the transcript for
+rejected lines afterwards.
+
+ssh_session() logs into the device over a forwarded SSH port, so bulk
+configuration can go over the network instead of the serial console.
+'''
+
+import re
+import time
+import logging
+import contextlib
+
+import pexpect
+
+import build_trace
+
+logger = logging.getLogger(__name__)
+
+# Bytes of console output kept while waiting for a boot or syslog marker
+MARKER_WINDOW = 4096
+
+
+class DialogTimeout(pexpect.TIMEOUT):
+    pass
+
+
+class Step(object):
+    """
+    One state of a console dialog.
+
+    expect  pattern or list of patterns to wait for (None: don't wait)
+    send    line to send once a pattern matched (None: send nothing)
+    timeout seconds to wait for the patterns
+    nudge   send a return every nudge seconds while waiting
+    window  match with expect_window(), keeping window bytes (None: expect)
+    """
+
+    def __init__(self, name, expect=None, send=None, timeout=60, nudge=None,
+                 window=None):
+        self.name = name
+        if expect is not None and not isinstance(expect, list):
+            expect = [expect]
+        self.expect = expect
+        self.send = send
+        self.timeout = timeout
+        self.nudge = nudge
+        self.window = window
+
+
+def expect_window(child, patterns, timeout=-1, window=MARKER_WINDOW):
+    """
+    child.expect(patterns, timeout) for markers in a lot of output.
+
+    Only the data just read is searched, along with the last window bytes
+    before it for a marker split across reads.  Output older than that is
+    dropped a line at a time, after the build trace saw its syslog
+    messages, so child.before holds at most window bytes and a line.
+
+    Returns the index of the pattern that matched, raises pexpect.TIMEOUT
+    or pexpect.EOF like expect.
+    """
+
+    if timeout == -1:
+        timeout = child.timeout
+    compiled = child.compile_pattern_list(patterns)
+    tracer = build_trace.current()
+    newline = b'\n' if child.string_type is bytes else '\n'
+    deadline = None if timeout is None else time.time() + timeout
+    data = child.buffer
+    searched = 0
+    while True:
+        start = max(0, searched - window)
+        first = None
+        for index, pattern in enumerate(compiled):
+            match = pattern.search(data, start)
+            if match is not None and (first is None or match.start() < first[1].start()):
+                first = index, match
+        if first is not None:
+            index, match = first
+            child.before = data[:match.start()]
+            child.after = data[match.start():match.end()]
+            child.match = match
+            child.match_index = index
+            rest = data[match.end():]
+            child.buffer = rest
+            if hasattr(child, '_before'):
+                # pexpect 4 keeps what's been read since the last match
+                child._before = child.buffer_type()
+                child._before.write(rest)
+            return index
+        if len(data) > 2 * window:
+            cut = data.rfind(newline, 0, len(data) - window) + 1
+            if cut:
+                tracer.console(data[:cut])
+                data = data[cut:]
+        searched = len(data)
+        try:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            data += child.read_nonblocking(child.maxread, remaining)
+        except (pexpect.TIMEOUT, pexpect.EOF) as e:
+            eof = isinstance(e, pexpect.EOF)
+            child.before = data
+            child.after = pexpect.EOF if eof else pexpect.TIMEOUT
+            child.match = child.match_index = None
+            # a timeout keeps the unmatched output for the next call
+            child.buffer = child.string_type() if eof else data
+            if hasattr(child, '_before'):
+                child._before = child.buffer_type()
+                if not eof:
+                    child._before.write(data)
+            raise
+
+
+class Dialog(object):
+    """
+    Run steps against a pexpect child and record how long each one took.
+    """
+
+    def __init__(self, name, steps=()):
+        self.name = name
+        self.steps = list(steps)
+        self.timings = []
+
+    def wait(self, child, step):
+        """
+        Wait for the patterns of step, nudging the console if asked to.
+
+        Returns the index of the pattern that matched.
+        """
+
+        deadline = time.time() + step.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DialogTimeout("%s: no match for %s within %s seconds"
+                                    % (self.name, step.name, step.timeout))
+            if step.nudge is None:
+                return self.expect(child, step, remaining)
+            try:
+                return self.expect(child, step, min(step.nudge, remaining))
+            except pexpect.TIMEOUT:
+                logger.debug('%s: nudging console for %s', self.name, step.name)
+                child.send('\r')
+
+    def expect(self, child, step, timeout):
+        if step.window is None:
+            return child.expect(step.expect, timeout=timeout)
+        return expect_window(child, step.expect, timeout, step.window)
+
+    def run(self, child, steps=None):
+        """
+        Run the steps (by default those of the dialog), return the list of
+        (step name, seconds) timings recorded so far.
+        """
+
+        for step in self.steps if steps is None else steps:
+            start = time.time()
+            if step.expect is not None:
+                self.wait(child, step)
+                build_trace.current().console(child.before, child.after)
+            waited = time.time() - start
+            if step.send is not None:
+                child.sendline(step.send)
+            self.record(step.name, waited)
+        return self.timings
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """
+        Record the time spent in a block that isn't a step, e.g. a series of
+        configuration commands.
+        """
+
+        start = time.time()
+        yield
+        self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        logger.debug('%s: %s took %.1f s', self.name, name, seconds)
+        self.timings.append((name, seconds))
+        build_trace.current().complete('%s: %s' % (self.name, name),
+                                       time.time() - seconds, seconds, 'dialog')
+
+    def report(self):
+        """
+        Log the step timings.
+        """
+
+        total = sum(t for _, t in self.timings)
+        logger.info('%s timings:', self.name)
+        for name, seconds in self.timings:
+            logger.info('  %-30s %7.1f s', name, seconds)
+        logger.info('  %-30s %7.1f s', 'total', total)
+
+
+# Bytes sent ahead of the echo before waiting for the device to catch up.
+# Keeps well within the console input buffer of IOS XE and NX-OS.
+BULK_WINDOW = 256
+
+# How the CLI rejects a line
+CLI_ERRORS = re.compile(r'^% ?(Invalid input|Invalid command|Invalid parameter|'
+                        r'Incomplete command|Ambiguous command|Unknown command|'
+                        r'Error)[^\r\n]*', re.MULTILINE)
+
+
+class BulkPushError(Exception):
+    pass
+
+
+def _echo(line):
+    return re.escape(line) + r'\r*\n'
+
+
+def rejected_lines(transcript, lines):
+    """
+    Return (line, error) for every line the CLI rejected in transcript.
+
+    Every error is blamed on the last line echoed before it.
+    """
+
+    errors = []
+    pos = 0
+    echoes = []
+    for line in lines:
+        match = re.compile(_echo(line)).search(transcript, pos)
+        if match is None:
+            break
+        echoes.append((match.end(), line))
+        pos = match.end()
+
+    for error in CLI_ERRORS.finditer(transcript):
+        culprit = None
+        for end, line in echoes:
+            if end > error.start():
+                break
+            culprit = line
+        errors.append((culprit, error.group(0).strip()))
+    return errors
+
+
+def bulk_push(child, blocks, prompt, window=BULK_WINDOW):
+    """
+    Stream blocks of configuration lines to the console.
+
+    blocks is a list of (name, lines).  Lines are sent without waiting for
+    each echo and prompt; only when window bytes are outstanding do we wait
+    for the echo of the latest line.  At the end of each block we sync on
+    the prompt.  Afterwards the captured transcript is checked for rejected
+    lines, raising BulkPushError if there are any.
+
+    Returns stats: lines sent, round trips (blocking waits) taken, and the
+    round trips one echo and one prompt wait per line would have taken.
+    """
+
+    stats = {'lines': 0, 'round_trips': 0, 'line_by_line': 0}
+    transcript = []
+
+    def sync(pattern, count=1):
+        for _ in range(count):
+            child.expect(pattern)
+            transcript.append(child.before + child.after)
+        stats['round_trips'] += 1
+
+    for name, lines in blocks:
+        logger.info('Bulk push: %s (%d lines)', name, len(lines))
+        block_start = time.time()
+        pending = []
+        outstanding = 0
+        for line in lines:
+            child.sendline(line)
+            pending.append(line)
+            outstanding += len(line) + 1
+            if outstanding >= window:
+                # identical lines further up echo first
+                sync(_echo(line), pending.count(line))
+                pending = []
+                outstanding = 0
+        if pending:
+            sync(_echo(pending[-1]), pending.count(pending[-1]))
+        sync(prompt)
+        build_trace.current().complete('bulk push: %s' % name, block_start,
+                                       time.time() - block_start, 'dialog',
+                                       {'lines': len(lines)})
+        stats['lines'] += len(lines)
+        stats['line_by_line'] += 2 * len(lines)
+
+    errors = rejected_lines(''.join(_text(t) for t in transcript),
+                            [line for _, lines in blocks for line in lines])
+    if errors:
+        raise BulkPushError('Lines rejected by the device:\n' + '\n'.join(
+            '  %s: %s' % (line, error) for line, error in errors))
+
+    logger.info('Bulk push: %d lines in %d round trips instead of %d',
+                stats['lines'], stats['round_trips'], stats['line_by_line'])
+    return stats
+
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+def ssh_session(port, username, password, prompt, host='127.0.0.1',
+                timeout=180, retry=5):
+    """
+    Log into the device over SSH, e.g. through a NAT port forward.
+
+    The device may still be bringing up its management interface or SSH
+    server, so the login is retried until timeout.  Returns the pexpect
+    child sitting at the prompt.
+    """
+
+    cmd = ('ssh -p %d -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null '
+           '-o PubkeyAuthentication=no -o KexAlgorithms=+diffie-hellman-group14-sha1 '
+           '-o HostKeyAlgorithms=+ssh-rsa %s@%s' % (port, username, host))
+    deadline = time.time() + timeout
+    while True:
+        child = pexpect.spawn(cmd, timeout=30)
+        try:
+            child.expect(r'[Pp]assword:')
+            child.sendline(password)
+            child.expect(prompt)
+            logger.info('Logged in over SSH on port %d', port)
+            return child
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            child.close()
+            if time.time() + retry > deadline:
+                raise DialogTimeout('No SSH login on port %d within %s seconds'
+                                    % (port, timeout))
+            logger.debug('SSH on port %d not ready yet', port)
+            time.sleep(retry)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+'''
+Compressed, rotating console transcripts.
+
+The builders log the console of every build (with --verbose) through the
+logfile of the pexpect child, which writes every chunk read from and sent
+to the console right away.  ConsoleLog takes the place of that file: a
+write only queues the chunk, a background thread compresses it into
+<log>.gz, so the console dialogs don't wait for the disk.  A transcript
+that grows past max_bytes (uncompressed) is rotated to <log>.1.gz,
+<log>.2.gz, ... keeping backups of them, and so is an existing transcript
+of the same name when a new one is opened (the install boot and the
+configuration boot of a build both keep theirs).
+
+The compressed stream is synced every second, so zcat or zless show the
+transcript of a build that is still running.
+
+E.g.:
+    zless created_boxes/csr1000v-universalk9.16.07.01/csr1000v-universalk9.16.07.01-console.log.gz
+    python console_log.py created_boxes/csr1000v-universalk9.16.07.01/csr1000v-universalk9.16.07.01-console.log.gz
+'''
+
+from __future__ import print_function
+import sys
+import os
+import time
+import gzip
+import zlib
+import atexit
+import logging
+import argparse
+import threading
+import textwrap
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed bytes per transcript file before it's rotated
+MAX_BYTES = 64 * 1024 ** 2
+
+# Rotated transcripts kept
+BACKUPS = 3
+
+# Seconds between writes of what's queued, and between syncs of the
+# compressed stream
+BATCH_INTERVAL = 0.2
+SYNC_INTERVAL = 1.0
+
+
+def log_path(path):
+    """
+    Return the path of the compressed transcript for path: console.log ->
+    console.log.gz.
+    """
+
+    return path if path.endswith('.gz') else path + '.gz'
+
+
+def rotated_path(path, number):
+    """
+    console.log.gz, 1 -> console.log.1.gz
+    """
+
+    return '%s.%d.gz' % (path[:-3], number)
+
+
+def rotate(path, backups=BACKUPS):
+    """
+    Shift path to path.1.gz, path.1.gz to path.2.gz, ... dropping the
+    oldest.
+    """
+
+    if not os.path.exists(path):
+        return
+    if backups < 1:
+        os.remove(path)
+        return
+    for number in range(backups - 1, 0, -1):
+        if os.path.exists(rotated_path(path, number)):
+            os.rename(rotated_path(path, number), rotated_path(path, number + 1))
+    os.rename(path, rotated_path(path, 1))
+
+
+class ConsoleLog(object):
+    """
+    File-like transcript for pexpect's logfile: write() queues, a thread
+    compresses and rotates what's queued every BATCH_INTERVAL seconds.
+    """
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS, level=6):
+        self.path = log_path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.level = level
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        rotate(self.path, backups)
+        # appending to a deque needs no lock and wakes nobody up
+        self.queue = deque()
+        self.closing = threading.Event()
+        self.written = 0
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, name='console log')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        self.queue.append(data)
+
+    def flush(self):
+        # called by pexpect after every write: the writer thread syncs
+        pass
+
+    def close(self):
+        """
+        Write out what is queued and close the transcript.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        self.closing.set()
+        self.thread.join()
+
+    def _open(self):
+        return gzip.GzipFile(self.path, 'wb', self.level)
+
+    def _drain(self):
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.queue.popleft())
+            except IndexError:
+                return b''.join(chunks)
+
+    def _writer(self):
+        out = None
+        size = 0
+        try:
+            out = self._open()
+            synced = time.time()
+            unsynced = False
+            while True:
+                closing = self.closing.wait(BATCH_INTERVAL)
+                data = self._drain()
+                if data:
+                    out.write(data)
+                    size += len(data)
+                    self.written += len(data)
+                    unsynced = True
+                    if size >= self.max_bytes:
+                        out.close()
+                        rotate(self.path, self.backups)
+                        out = self._open()
+                        size = 0
+                if closing:
+                    break
+                if unsynced and time.time() - synced >= SYNC_INTERVAL:
+                    out.flush(zlib.Z_SYNC_FLUSH)
+                    synced = time.time()
+                    unsynced = False
+        except (IOError, OSError) as e:
+            # a transcript that can't be written doesn't fail the build
+            self.error = e
+            logger.warn('Console transcript %s: %s', self.path, e)
+        finally:
+            if out is not None:
+                try:
+                    out.close()
+                except (IOError, OSError):
+                    pass
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Print a console transcript, with its rotated parts, oldest first.
+        '''))
+    parser.add_argument('LOG', help='transcript, e.g. console.log.gz')
+    args = parser.parse_args(argv)
+
+    path = log_path(args.LOG)
+    parts = [rotated_path(path, number) for number in range(99, 0, -1)] + [path]
+    parts = [part for part in parts if os.path.exists(part)]
+    if not parts:
+        sys.exit('No transcript %s' % path)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    for part in parts:
+        f = gzip.open(part, 'rb')
+        try:
+            while True:
+                try:
+                    data = f.read(65536)
+                except (IOError, EOFError):
+                    # still being written
+                    break
+                if not data:
+                    break
+                out.write(data)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,642 @@
+#!/usr/bin/env python
+'''
+Console simulator of the devices the box builders configure.
+
+Serves the serial console of a simulated CSR 1000v (IOS XE) or Nexus 9000v
+(NX-OS) the way VirtualBox does: over TCP like a "tcpserver" uart, or over
+a unix socket like the "server" uart NX-OS is built with (/tmp/test).  So
+configure_xe() and configure_nx() can be run, timed and debugged without
+VirtualBox or a device image.
+
+On the first connection the simulator replays a recorded boot transcript
+(transcripts/<platform>_boot.log, or --transcript) over --boot-time
+seconds, up to the boot marker the builder waits for.  Then it answers the
+first boot dialog and the CLI: characters are echoed as they arrive (but
+not passwords), type-ahead waits until the CLI is done with the previous
+line, prompts follow the configuration modes and hostname, and guest shell
+activation comes back as a %VMAN syslog message a while later.  Device
+state and output nobody read yet survive a reconnect.
+
+Realism knobs:
+    --baud          serial speed, output is paced at baud / 10 bytes per second
+                    (0: as fast as the socket goes)
+    --line-latency  seconds the CLI takes to answer a line
+    --error-rate    share of commands rejected with "% Invalid input" (IOS XE)
+                    or "% Invalid command" (NX-OS), --seed makes it repeatable
+    --boot-repeat   replay the boot transcript this many times before the
+                    marker, for the output of a verbose or debug boot
+
+E.g.:
+    python console_sim.py iosxe tcp:65000 --baud 9600 --boot-time 30
+    python console_transport.py tcp:65000
+    python console_sim.py nxos unix:/tmp/test --line-latency 0.1 --error-rate 0.02
+'''
+
+from __future__ import print_function
+import sys
+import os
+import time
+import heapq
+import errno
+import random
+import select
+import socket
+import logging
+import argparse
+import threading
+import textwrap
+from collections import deque
+
+from console_transport import parse_address
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transcripts')
+
+
+class SimulatorError(Exception):
+    pass
+
+
+class Device(object):
+    """
+    CLI state machine of a simulated device.
+
+    line() takes one line typed on the console and returns what the device
+    prints in response; messages the device prints later by itself are
+    queued in later as (delay, text).
+    """
+
+    platform = None
+    marker = None
+    hostname = None
+    invalid = None
+    # (parent mode or None for any, command prefix) -> configuration sub-mode
+    submodes = {}
+    # states in which typed characters are not echoed
+    secret_states = ()
+
+    def __init__(self, error_rate=0.0, seed=None):
+        self.state = 'booting'
+        self.modes = []
+        self.enabled = False
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.later = []
+        self.commands = 0
+        self.rejected = 0
+
+    @property
+    def echo(self):
+        return self.state not in self.secret_states
+
+    def prompt(self):
+        if self.modes:
+            return '%s(%s)#' % (self.hostname, self.modes[-1])
+        return self.hostname + ('#' if self.enabled else '>')
+
+    def boot_done(self):
+        """
+        The boot marker went out, return what the device prints next.
+        """
+
+        raise NotImplementedError
+
+    def line(self, text):
+        return getattr(self, 'state_' + self.state)(text)
+
+    def state_exec(self, text):
+        cmd = text.strip()
+        if not cmd:
+            return self.prompt()
+        self.commands += 1
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.rejected += 1
+            return self.reject(text) + self.prompt()
+        out = self.command(cmd)
+        if self.state == 'exec':
+            out += self.prompt()
+        return out
+
+    def reject(self, text):
+        indent = len(self.prompt()) + len(text) - len(text.lstrip())
+        return ' ' * indent + '^\r\n' + self.invalid + '\r\n\r\n'
+
+    def command(self, cmd):
+        """
+        Run a command, return its output.  Commands the simulator doesn't
+        know are accepted silently.
+        """
+
+        words = cmd.split()
+        if cmd == 'end':
+            self.modes = []
+        elif cmd == 'exit':
+            if self.modes:
+                self.modes.pop()
+        elif words[0] in ('conf', 'configure') and len(words) == 2 \
+                and 'terminal'.startswith(words[1]):
+            self.modes = ['config']
+            return 'Enter configuration commands, one per line.  End with CNTL/Z.\r\n'
+        elif self.modes:
+            if words[0] == 'hostname' and len(words) == 2:
+                self.hostname = words[1]
+            for (parent, prefix), mode in sorted(self.submodes.items(),
+                                                  key=lambda item: item[0][0] is None):
+                if parent is None and cmd.startswith(prefix):
+                    self.modes = ['config', mode]
+                elif parent == self.modes[-1] and cmd.startswith(prefix):
+                    self.modes.append(mode)
+                else:
+                    continue
+                break
+        else:
+            return self.exec_command(cmd, words)
+        return ''
+
+    def exec_command(self, cmd, words):
+        return ''
+
+
+class IosXeDevice(Device):
+    """
+    CSR 1000v: "Press RETURN to get started!" after boot, user exec mode,
+    enable without password, copy run start asks for the destination.
+    """
+
+    platform = 'iosxe'
+    marker = '%CRYPTO-6-GDOI_ON_OFF: GDOI is OFF'
+    hostname = 'Router'
+    invalid = "% Invalid input detected at '^' marker."
+    submodes = {
+        (None, 'interface '): 'config-if',
+        (None, 'line '): 'config-line',
+        (None, 'router '): 'config-router',
+        (None, 'ip ssh pubkey-chain'): 'conf-ssh-pubkey',
+        ('conf-ssh-pubkey', 'username '): 'conf-ssh-pubkey-user',
+        ('conf-ssh-pubkey-user', 'key-string'): 'conf-ssh-pubkey-data',
+    }
+
+    def boot_done(self):
+        self.state = 'press_return'
+        return '\r\n\r\nPress RETURN to get started!\r\n\r\n\r\n'
+
+    def state_press_return(self, text):
+        self.state = 'exec'
+        return self.prompt()
+
+    def exec_command(self, cmd, words):
+        if cmd == 'enable':
+            self.enabled = True
+        elif cmd == 'disable':
+            self.enabled = False
+        elif words[0] == 'copy' and len(words) == 3 and 'startup-config'.startswith(words[2]):
+            self.state = 'destination'
+            return 'Destination filename [startup-config]? '
+        return ''
+
+    def state_destination(self, text):
+        self.state = 'exec'
+        return 'Building configuration...\r\n[OK]\r\n' + self.prompt()
+
+
+class NxosDevice(Device):
+    """
+    Nexus 9000v: POAP abort, admin password and basic configuration
+    dialog, login, then the CLI with a guest shell that takes
+    service_time seconds to activate or destroy.
+
+    show version names image unless show_image is off, dir bootflash:
+    lists images.
+    """
+
+    platform = 'nxos'
+    marker = '%POAP-2-POAP_DHCP_DISCOVER_START:'
+    hostname = 'switch'
+    invalid = "% Invalid command at '^' marker."
+    submodes = {
+        (None, 'interface '): 'config-if',
+        (None, 'line '): 'config-line',
+        (None, 'vrf context '): 'config-vrf',
+        (None, 'router '): 'config-router',
+    }
+    secret_states = ('password', 'confirm', 'login_password')
+    image = 'nxos.7.0.3.I7.1.bin'
+
+    def __init__(self, error_rate=0.0, seed=None, service_time=20.0):
+        Device.__init__(self, error_rate, seed)
+        self.enabled = True
+        self.service_time = service_time
+        self.show_image = True
+        self.images = [self.image]
+
+    def syslog(self, message):
+        return '%s %s %%$ VDC-1 %%$ %s\r\n' % (
+            time.strftime('%Y %b %d %H:%M:%S'), self.hostname, message)
+
+    def boot_done(self):
+        self.state = 'poap'
+        return ('\r\n\r\nAbort Power On Auto Provisioning [yes - continue with normal '
+                'setup, skip - bypass password and basic configuration, no - continue '
+                'with Power On Auto Provisioning] (yes/skip/no)[no]: ')
+
+    def state_poap(self, text):
+        self.state = 'secure'
+        return ('\r\n         ---- System Admin Account Setup ----\r\n\r\n\r\n'
+                'Do you want to enforce secure password standard (yes/no) [y]: ')
+
+    def state_secure(self, text):
+        self.state = 'password'
+        return '\r\n  Enter the password for "admin": '
+
+    def state_password(self, text):
+        if not text:
+            return '\r\n  Enter the password for "admin": '
+        self.state = 'confirm'
+        return '  Confirm the password for "admin": '
+
+    def state_confirm(self, text):
+        self.state = 'basic'
+        return ('\r\n\r\n         ---- Basic System Configuration Dialog VDC: 1 ----\r\n\r\n'
+                'This setup utility will guide you through the basic configuration of\r\n'
+                'the system. Setup configures only enough connectivity for management\r\n'
+                'of the system.\r\n\r\n'
+                'Would you like to enter the basic configuration dialog (yes/no): ')
+
+    def state_basic(self, text):
+        if not text.strip():
+            return 'Would you like to enter the basic configuration dialog (yes/no): '
+        self.state = 'login'
+        return '\r\n\r\nUser Access Verification\r\n%s login: ' % self.hostname
+
+    def state_login(self, text):
+        if not text.strip():
+            return '%s login: ' % self.hostname
+        self.state = 'login_password'
+        return 'Password: '
+
+    def state_login_password(self, text):
+        self.state = 'exec'
+        return ('\r\nCisco NX-OS Software\r\n'
+                'Copyright (c) 2002-2017, Cisco Systems, Inc. All rights reserved.\r\n'
+                + self.prompt())
+
+    def exec_command(self, cmd, words):
+        if cmd.startswith('copy r') and words[-1].startswith('start'):
+            return ('[########################################] 100%\r\n'
+                    'Copy complete, now saving to disk (please wait)...\r\n'
+                    'Copy complete.\r\n')
+        return ''
+
+    def show_version(self):
+        image = 'bootflash:///%s' % self.image if self.show_image else ''
+        return ('Cisco Nexus Operating System (NX-OS) Software\r\n'
+                'TAC support: http://www.cisco.com/tac\r\n'
+                'Copyright (C) 2002-2017, Cisco and/or its affiliates.\r\n'
+                'All rights reserved.\r\n'
+                '\r\n'
+                'Software\r\n'
+                '  BIOS: version \r\n'
+                '  NXOS: version 7.0(3)I7(1)\r\n'
+                '  BIOS compile time:  \r\n'
+                '  NXOS image file is: %s\r\n'
+                '  NXOS compile time:  8/31/2017 14:00:00 [08/31/2017 22:29:32]\r\n'
+                '\r\n'
+                'Hardware\r\n'
+                '  cisco Nexus9000 9000v Chassis \r\n'
+                '  Intel(R) Xeon(R) CPU E5-2670 0 @ 2.60GHz with 4041600 kB of memory.\r\n'
+                '\r\n'
+                '  Device name: %s\r\n'
+                '  bootflash:    3509454 kB\r\n'
+                'Kernel uptime is 0 day(s), 0 hour(s), 3 minute(s), 12 second(s)\r\n'
+                % (image, self.hostname))
+
+    def dir_bootflash(self):
+        lines = ['       4096    Sep 07 15:07:58 2017  .rpmstore/',
+                 '       4096    Sep 07 15:08:22 2017  .swtam/']
+        lines += ['  753387008    Sep 07 14:40:04 2017  %s' % image for image in self.images]
+        lines += ['       4096    Sep 07 15:08:35 2017  scripts/',
+                  '       4096    Sep 07 15:08:40 2017  virt_strg_pool_bf_vdc_1/',
+                  '',
+                  'Usage for bootflash://sup-local',
+                  ' 1474101248 bytes used',
+                  ' 2119540736 bytes free',
+                  ' 3593641984 bytes total']
+        return '\r\n'.join(lines) + '\r\n'
+
+    def command(self, cmd):
+        # show and dir work in configuration mode as well
+        if cmd == 'show version':
+            return self.show_version()
+        if cmd in ('dir', 'dir bootflash:'):
+            return self.dir_bootflash()
+        # guest shell commands work in any mode
+        if cmd == 'guestshell enable':
+            self.later.append((self.service_time, self.syslog(
+                "%VMAN-2-ACTIVATION_STATE: Successfully activated virtual service "
+                "'guestshell+'")))
+            return ''
+        if cmd.startswith('guestshell run ls /bootflash/nxos'):
+            return '/bootflash/%s\r\n' % self.image
+        if cmd == 'guestshell destroy':
+            self.state = 'destroy'
+            return ('You are about to destroy the guest shell and all of its contents. '
+                    'Be sure to save your work. Are you sure you want to continue? '
+                    '(y/n) [n] ')
+        return Device.command(self, cmd)
+
+    def state_destroy(self, text):
+        self.state = 'exec'
+        if text.strip().lower().startswith('y'):
+            self.later.append((self.service_time / 2.0, self.syslog(
+                "%VMAN-2-INSTALL_STATE: Successfully destroyed virtual service "
+                "'guestshell+'")))
+        return self.prompt()
+
+
+DEVICES = {'iosxe': IosXeDevice, 'nxos': NxosDevice}
+
+
+def boot_transcript(device, path=None, repeat=1):
+    """
+    Return the lines of the boot transcript of device, ending with its boot
+    marker, the lines in front of the marker repeat times.
+    """
+
+    path = path or os.path.join(TRANSCRIPTS, '%s_boot.log' % device.platform)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    for i, line in enumerate(lines):
+        if device.marker in line:
+            return lines[:i] * repeat + [line]
+    return lines * repeat + [device.marker]
+
+
+class ConsoleServer(threading.Thread):
+    """
+    Serve the console of device on address, one client at a time.
+
+    The socket is listening once the constructor returns; start() runs the
+    simulator in a daemon thread, stop() ends it.
+    """
+
+    def __init__(self, device, address, baud=0, line_latency=0.0, boot_time=0.0,
+                 transcript=None, boot_repeat=1):
+        threading.Thread.__init__(self, name='console %s' % address)
+        self.daemon = True
+        self.device = device
+        self.address = address
+        self.rate = baud / 10.0
+        self.line_latency = line_latency
+        self.boot_time = boot_time
+        self.transcript = boot_transcript(device, transcript, boot_repeat)
+        self.family, self.bind_address = parse_address(address)
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            os.unlink(self.bind_address)
+        self.listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.bind_address)
+        self.listener.listen(1)
+        self.client = None
+        self.booting = False
+        self.events = []
+        self.sequence = 0
+        self.out = deque()
+        self.next_send = 0.0
+        self.inbuf = bytearray()
+        self.typed = []
+        self.busy = False
+        self.last_cr = False
+        self.stopping = threading.Event()
+        self.connections = 0
+        self.lines = 0
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        self._drop()
+        self.listener.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            os.unlink(self.bind_address)
+
+    def _schedule(self, when, action, data):
+        self.sequence += 1
+        heapq.heappush(self.events, (when, self.sequence, action, data))
+
+    def _output(self, text):
+        if text:
+            self.out.append(text.encode('utf-8'))
+
+    def _boot(self):
+        """
+        Schedule the boot transcript over boot_time, switch the device to
+        its first boot dialog once the marker is out.
+        """
+
+        now = time.time()
+        step = self.boot_time / len(self.transcript)
+        for i, line in enumerate(self.transcript[:-1]):
+            self._schedule(now + step * (i + 1), 'out', line + '\r\n')
+        self._schedule(now + self.boot_time, 'out',
+                       lambda: self._booted(self.transcript[-1]))
+        logger.debug('Booting %s over %.1f s', self.device.platform, self.boot_time)
+
+    def _booted(self, marker):
+        # the device reads the console from the marker on: a client that
+        # answers as soon as the marker matches isn't ignored
+        text = marker + '\r\n' + self.device.boot_done()
+        self.out.appendleft(text.encode('utf-8'))
+
+    def _fire(self, now):
+        while self.events and self.events[0][0] <= now:
+            _, _, action, data = heapq.heappop(self.events)
+            if action == 'out':
+                self.out.append(data if callable(data) else data.encode('utf-8'))
+            else:
+                data()
+
+    def _consume(self):
+        """
+        Read typed characters until a line is complete, echoing them.
+        """
+
+        if self.device.state == 'booting':
+            # nobody reads the console yet
+            del self.inbuf[:]
+            return
+        while self.inbuf and not self.busy:
+            c = chr(self.inbuf.pop(0))
+            if c == '\n' and self.last_cr:
+                self.last_cr = False
+                continue
+            self.last_cr = c == '\r'
+            if c in '\r\n':
+                self._output('\r\n')
+                line = ''.join(self.typed)
+                self.typed = []
+                self.busy = True
+                self._schedule(time.time() + self.line_latency, 'call',
+                               lambda line=line: self._answer(line))
+            elif c in '\x08\x7f':
+                if self.typed:
+                    self.typed.pop()
+                    if self.device.echo:
+                        self._output('\x08 \x08')
+            else:
+                self.typed.append(c)
+                if self.device.echo:
+                    self._output(c)
+
+    def _answer(self, line):
+        self.lines += 1
+        self._output(self.device.line(line))
+        now = time.time()
+        for delay, text in self.device.later:
+            self._schedule(now + delay, 'out', text)
+        del self.device.later[:]
+        self.busy = False
+        self._consume()
+
+    def _accept(self):
+        sock, _ = self.listener.accept()
+        if self.client is not None:
+            sock.close()
+            return
+        self.client = sock
+        self.connections += 1
+        logger.debug('Console client connected (%d)', self.connections)
+        if not self.booting:
+            self.booting = True
+            self._boot()
+
+    def _drop(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+            logger.debug('Console client disconnected')
+
+    def _send(self, now):
+        while self.out and callable(self.out[0]):
+            self.out.popleft()()
+        if not self.out:
+            return
+        data = self.out.popleft()
+        if self.rate:
+            # at most 10 ms worth of characters at a time
+            size = max(1, int(self.rate / 100))
+            data, rest = data[:size], data[size:]
+        else:
+            rest = b''
+            while self.out and not callable(self.out[0]):
+                data += self.out.popleft()
+        try:
+            sent = self.client.send(data)
+        except socket.error as e:
+            self.out.appendleft(data + rest)
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._drop()
+            return
+        if sent < len(data) or rest:
+            self.out.appendleft(data[sent:] + rest)
+        if self.rate:
+            self.next_send = now + sent / self.rate
+
+    def run(self):
+        while not self.stopping.is_set():
+            now = time.time()
+            self._fire(now)
+            timeout = 0.1
+            if self.events:
+                timeout = min(timeout, self.events[0][0] - now)
+            readers = [self.listener]
+            writers = []
+            if self.client is not None:
+                readers.append(self.client)
+                if self.out:
+                    if now >= self.next_send:
+                        writers.append(self.client)
+                    else:
+                        timeout = min(timeout, self.next_send - now)
+            readable, writable, _ = select.select(readers, writers, [], max(0, timeout))
+            if self.listener in readable:
+                self._accept()
+            if self.client is not None and self.client in readable:
+                try:
+                    data = self.client.recv(4096)
+                except socket.error:
+                    data = b''
+                if not data:
+                    self._drop()
+                    continue
+                self.inbuf.extend(data)
+                self._consume()
+            if self.client is not None and self.client in writable:
+                self._send(time.time())
+
+
+def serve(platform, address, baud=0, line_latency=0.0, boot_time=0.0,
+          error_rate=0.0, seed=None, transcript=None, service_time=None, boot_repeat=1):
+    """
+    Start a simulator of platform on address, return the ConsoleServer.
+    """
+
+    if platform not in DEVICES:
+        raise SimulatorError('Unknown platform %s' % platform)
+    device = DEVICES[platform](error_rate, seed)
+    if service_time is not None and hasattr(device, 'service_time'):
+        device.service_time = service_time
+    server = ConsoleServer(device, address, baud, line_latency, boot_time, transcript,
+                           boot_repeat)
+    server.start()
+    return server
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Serve the console of a simulated IOS XE or NX-OS device.
+        '''))
+    parser.add_argument('PLATFORM', choices=sorted(DEVICES))
+    parser.add_argument('ADDRESS', help='tcp:PORT, tcp:HOST:PORT or unix:PATH')
+    parser.add_argument('--baud', type=int, default=9600,
+                        help='serial speed, 0 for unlimited (default: %(default)s)')
+    parser.add_argument('--line-latency', type=float, default=0.05,
+                        help='seconds to answer a line (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of commands rejected (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='seed of the error injection')
+    parser.add_argument('--boot-time', type=float, default=30.0,
+                        help='seconds to replay the boot transcript over (default: %(default)s)')
+    parser.add_argument('--transcript', help='boot transcript to replay '
+                        '(default: transcripts/<platform>_boot.log)')
+    parser.add_argument('--service-time', type=float,
+                        help='seconds the NX-OS guest shell takes to activate')
+    parser.add_argument('--boot-repeat', type=int, default=1,
+                        help='times to replay the boot transcript before the marker '
+                             '(default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="==> %(message)s")
+    try:
+        server = serve(args.PLATFORM, args.ADDRESS, args.baud, args.line_latency,
+                       args.boot_time, args.error_rate, args.seed, args.transcript,
+                       args.service_time, args.boot_repeat)
+    except (SimulatorError, ValueError, IOError, OSError, socket.error) as e:
+        sys.exit(str(e))
+    logger.info('Serving the %s console on %s, ^C to stop', args.PLATFORM, args.ADDRESS)
+    try:
+        while server.is_alive():
+            server.join(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    logger.info('%d lines answered, %d rejected', server.lines, server.device.rejected)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+'''
+Serial console transport straight to the VirtualBox uart socket.
+
+The builders used to reach the console through socat, a process and a pty
+per session ("socat TCP:localhost:65000 -,raw,echo=0,escape=0x1d" for
+IOS XE, "socat unix-connect:/tmp/test stdin" for NX-OS), every console
+byte copied through both.  ConsoleSpawn connects to the TCP or unix socket
+itself and is a pexpect child (expect, expect_exact, before/after,
+logfile, ... of pexpect's SpawnBase), so the console dialogs don't change.
+
+The uart socket goes away when the VM powers off or resets, and isn't
+there yet right after the VM starts: connecting is retried, and a console
+that is closed under the builder is reconnected within --reconnect
+seconds instead of ending the dialog with EOF.
+
+Run on its own it is an interactive console, ^] quits.
+
+E.g.:
+    python console_transport.py tcp:localhost:65000
+    python console_transport.py unix:/tmp/test
+'''
+
+from __future__ import print_function
+import sys
+import os
+import time
+import errno
+import select
+import socket
+import logging
+import argparse
+import textwrap
+
+import pexpect
+from pexpect.spawnbase import SpawnBase
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the uart socket to show up, or to come back
+CONNECT_TIMEOUT = 30
+RECONNECT_TIMEOUT = 60
+
+# Seconds between connection attempts
+RETRY = 0.5
+
+ESCAPE = b'\x1d'
+
+
+class ConsoleTransportError(pexpect.EOF):
+    pass
+
+
+def parse_address(address):
+    """
+    Return (family, address) of tcp:PORT, tcp:HOST:PORT, unix:PATH or PORT.
+    """
+
+    address = str(address)
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    if address.startswith('tcp:'):
+        address = address[4:]
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise ValueError('Not a console address: %s' % address)
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def connect(address, timeout=10):
+    """
+    Connect to a console, return the socket.
+    """
+
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(addr)
+    except socket.error:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    if family == socket.AF_INET:
+        # console lines are small, don't hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class ConsoleSpawn(SpawnBase):
+    """
+    pexpect child on the console socket at address.
+
+    reconnect_timeout is how long a closed console is retried before EOF
+    is raised, 0 raises EOF right away.
+    """
+
+    def __init__(self, address, timeout=30, maxread=4096, searchwindowsize=None,
+                 logfile=None, encoding=None, codec_errors='strict',
+                 connect_timeout=CONNECT_TIMEOUT, reconnect_timeout=RECONNECT_TIMEOUT):
+        SpawnBase.__init__(self, timeout, maxread, searchwindowsize, logfile,
+                           encoding=encoding, codec_errors=codec_errors)
+        self.address = address
+        self.name = '<console %s>' % address
+        self.reconnect_timeout = reconnect_timeout
+        self.reconnects = 0
+        self.sock = None
+        self.closed = True
+        self._connect(connect_timeout)
+
+    def _connect(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.sock = connect(self.address, max(1, timeout))
+                break
+            except socket.error as e:
+                if time.time() + RETRY > deadline:
+                    self.flag_eof = True
+                    raise ConsoleTransportError('No console on %s within %s seconds: %s'
+                                                % (self.address, timeout, e))
+                time.sleep(RETRY)
+        self.child_fd = self.sock.fileno()
+        self.closed = False
+
+    def _reconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+        if not self.reconnect_timeout:
+            self.flag_eof = True
+            raise ConsoleTransportError('Console %s closed' % self.address)
+        logger.warn('Console %s closed, reconnecting', self.address)
+        self._connect(self.reconnect_timeout)
+        self.reconnects += 1
+        logger.info('Console %s reconnected', self.address)
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        """
+        Read at most size bytes, waiting up to timeout seconds (-1: the
+        timeout of the child, None: forever) for them.
+        """
+
+        if self.closed:
+            raise ValueError('I/O operation on closed console')
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            try:
+                readable = select.select([self.sock], [], [], remaining)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            try:
+                data = self.sock.recv(size)
+            except socket.error as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                data = b''
+            if data:
+                break
+            self._reconnect()
+        data = self._decoder.decode(data, final=False)
+        self._log(data, 'read')
+        return data
+
+    def send(self, s):
+        """
+        Write s to the console, return the number of bytes written.
+        """
+
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        data = self._encoder.encode(s, final=False)
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self._reconnect()
+            self.sock.sendall(data)
+        return len(data)
+
+    def sendline(self, s=''):
+        s = self._coerce_send_string(s)
+        return self.send(s + self.linesep)
+
+    def write(self, s):
+        self.send(s)
+
+    def writelines(self, sequence):
+        for s in sequence:
+            self.write(s)
+
+    def isalive(self):
+        return not self.closed
+
+    def close(self, force=True):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.child_fd = -1
+        self.closed = True
+
+
+def interact(address, escape=ESCAPE):
+    """
+    Attach the terminal to the console until escape is typed.
+    """
+
+    import tty
+    import termios
+
+    console = ConsoleSpawn(address)
+    stdin = sys.stdin.fileno()
+    saved = termios.tcgetattr(stdin) if os.isatty(stdin) else None
+    try:
+        if saved is not None:
+            tty.setraw(stdin)
+        while True:
+            readable = select.select([stdin, console.sock], [], [])[0]
+            if console.sock in readable:
+                data = console.read_nonblocking(console.maxread, 0)
+                os.write(sys.stdout.fileno(), data)
+            if stdin in readable:
+                data = os.read(stdin, 1024)
+                if not data or escape in data:
+                    break
+                console.send(data)
+    finally:
+        if saved is not None:
+            termios.tcsetattr(stdin, termios.TCSADRAIN, saved)
+        console.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Connect the terminal to the serial console of a VM, ^] quits.
+        '''))
+    parser.add_argument('ADDRESS', help='tcp:PORT, tcp:HOST:PORT or unix:PATH')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+    logger.info('Connecting to %s, ^] to quit', args.ADDRESS)
+    try:
+        interact(args.ADDRESS)
+    except (ValueError, pexpect.EOF) as e:
+        sys.exit(str(e))
+    print()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
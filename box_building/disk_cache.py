@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+'''
+Cache of installed IOS XE disks, keyed by the SHA-256 of the ISO.
+
+Installing the ISO (create an empty disk, boot the DVD, wait for the install
+and the reboot) is the same for every build of the same ISO.  The first
+build of an ISO powers the VM off once the install is done and stores a
+clone of the disk here; later builds start from a clone of that disk and
+skip the install boot.
+
+The cache is a folder with one <sha256>.vdi and <sha256>.json per ISO.  When
+the disks take up more than the maximum size, the least recently used ones
+are removed.
+
+E.g.:
+    python disk_cache.py list
+    python disk_cache.py prune --max-size 20G
+'''
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import hashlib
+import argparse
+import logging
+import textwrap
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'vagrant_net_prog', 'disks')
+
+# 50 GB, an installed CSR disk is about 1.5 GB
+DEFAULT_MAX_SIZE = 50 * 1024 ** 3
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """
+    Return the SHA-256 hex digest of a file, read in chunks.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_size(size):
+    """
+    Parse sizes like 500M, 20G or 1T into bytes.
+    """
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fT' % size
+
+
+class DiskCache(object):
+    """
+    Folder of installed disks with LRU eviction.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def disk(self, sha):
+        return os.path.join(self.root, sha + '.vdi')
+
+    def meta(self, sha):
+        return os.path.join(self.root, sha + '.json')
+
+    def entries(self):
+        """
+        Return the metadata of all cached disks, least recently used first.
+        """
+
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            sha = name[:-len('.json')]
+            if not os.path.exists(self.disk(sha)):
+                continue
+            with open(self.meta(sha)) as f:
+                entry = json.load(f)
+            entry['sha256'] = sha
+            entry['size'] = os.path.getsize(self.disk(sha))
+            entries.append(entry)
+        return sorted(entries, key=lambda e: e['last_used'])
+
+    def _write_meta(self, sha, entry):
+        tmp = self.meta(sha) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f, indent=2)
+        os.rename(tmp, self.meta(sha))
+
+    def lookup(self, sha):
+        """
+        Return the cached disk for the ISO hash, or None.
+        """
+
+        if not os.path.exists(self.disk(sha)) or not os.path.exists(self.meta(sha)):
+            return None
+        with open(self.meta(sha)) as f:
+            entry = json.load(f)
+        entry['last_used'] = time.time()
+        self._write_meta(sha, entry)
+        return self.disk(sha)
+
+    def restore(self, sha, vdi, run):
+        """
+        Clone the cached disk to vdi, which gets a new UUID.
+        """
+
+        source = self.disk(sha)
+        run(['VBoxManage', 'clonemedium', 'disk', source, vdi, '--format', 'VDI'])
+        # cloning registered the cached disk with VirtualBox, let go of it
+        run(['VBoxManage', 'closemedium', 'disk', source], cont_on_error=True)
+
+    def store(self, sha, vdi, run, iso=None):
+        """
+        Store a clone of the installed disk vdi for the ISO hash.
+        """
+
+        target = self.disk(sha)
+        partial = os.path.join(self.root, sha + '.partial.vdi')
+        if os.path.exists(partial):
+            os.remove(partial)
+        run(['VBoxManage', 'clonemedium', 'disk', vdi, partial, '--format', 'VDI'])
+        run(['VBoxManage', 'closemedium', 'disk', partial], cont_on_error=True)
+        os.rename(partial, target)
+        now = time.time()
+        self._write_meta(sha, {'iso': iso and os.path.basename(iso),
+                               'created': now, 'last_used': now})
+        logger.info('Cached installed disk %s', target)
+        self.prune()
+
+    def remove(self, sha):
+        for path in (self.disk(sha), self.meta(sha)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def prune(self, max_size=None):
+        """
+        Remove least recently used disks until the cache fits max_size.
+
+        Returns the removed entries.
+        """
+
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        total = sum(e['size'] for e in entries)
+        removed = []
+        while entries and total > max_size:
+            entry = entries.pop(0)
+            logger.info('Evicting cached disk of %s (%s)', entry['iso'],
+                        format_size(entry['size']))
+            self.remove(entry['sha256'])
+            total -= entry['size']
+            removed.append(entry)
+        return removed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            List and prune the cache of installed IOS XE disks.
+        '''))
+    parser.add_argument('-d', '--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='cache folder (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='show the cached disks, least recently used first')
+    prune = commands.add_parser('prune', help='evict least recently used disks')
+    prune.add_argument('--max-size', default=format_size(DEFAULT_MAX_SIZE),
+                       help='size to shrink the cache to, e.g. 20G (default: %(default)s)')
+    commands.add_parser('clear', help='remove all cached disks')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+    cache = DiskCache(args.cache_dir)
+
+    if args.command == 'list':
+        entries = cache.entries()
+        for e in entries:
+            print('%s  %8s  %s  %s' % (
+                e['sha256'][:12], format_size(e['size']),
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_used'])),
+                e['iso']))
+        print('%d disks, %s' % (len(entries),
+                                format_size(sum(e['size'] for e in entries))))
+    elif args.command == 'prune':
+        cache.prune(parse_size(args.max_size))
+    elif args.command == 'clear':
+        cache.prune(0)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
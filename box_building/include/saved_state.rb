@@ -0,0 +1,116 @@
+# -*- mode: ruby -*-
+# vi: set ft=ruby :
+
+# Resume a box from the execution state saved at the end of its build
+# (box_building/saved_state.py, --saved-state of the builders).  The
+# embedded Vagrantfile of the box loads this file if the box has one.
+#
+# Right before VirtualBox boots a machine for the first time, after its
+# networks, forwarded ports and customizations are in place:
+#   - the VM settings the state depends on are compared with the build VM
+#     (include/saved-state.json), any difference means a cold boot
+#   - the network adapters get the MAC addresses of the build VM
+#   - the VM adopts a copy of include/saved-state.sav and resumes
+# A machine that fails to resume has its state discarded and boots cold.
+
+require 'json'
+require 'fileutils'
+
+unless defined?(SavedStateResume)
+  module SavedStateResume
+    STATE = 'saved-state.sav'
+    INFO = 'saved-state.json'
+
+    # Same as SETTINGS in saved_state.py
+    SETTINGS = /\A(memory|cpus|chipset|firmware|ioapic|pae|longmode|hpet|paravirtprovider|vram|graphicscontroller|audio|usb\w*|uart\d|nic\d|nictype\d|natnet\d|storagecontroller\w+)\z/
+
+    def self.unquote(text)
+      text.strip.sub(/\A"/, '').sub(/"\z/, '')
+    end
+
+    def self.machinereadable(output)
+      info = {}
+      output.each_line do |line|
+        key, sep, value = line.partition('=')
+        next if sep.empty?
+        info[unquote(key)] = unquote(value)
+      end
+      info
+    end
+
+    # Same as settings() in saved_state.py
+    def self.settings(info)
+      result = info.select { |key, _| key =~ SETTINGS }
+      controllers = info.select { |key, _| key.start_with?('storagecontrollername') }.values
+      info.each do |key, value|
+        match = /\A(.+)-(\d+)-(\d+)\z/.match(key)
+        next unless match && controllers.include?(match[1]) && value != 'none'
+        disk = %w(.vdi .vmdk).include?(File.extname(value).downcase)
+        result[key] = disk ? 'disk' : 'dvd'
+      end
+      result
+    end
+
+    class Middleware
+      def initialize(app, env)
+        @app = app
+      end
+
+      def call(env)
+        machine = env[:machine]
+        return @app.call(env) if machine.box.nil?
+        state = machine.box.directory.join('include', STATE)
+        checked = machine.data_dir.join('saved_state')
+        # only the first boot after the import: later ones have a disk of
+        # their own
+        return @app.call(env) if !state.file? || checked.exist?
+        File.open(checked.to_s, 'w') { |f| f.write("checked\n") }
+
+        driver = machine.provider.driver
+        saved = JSON.parse(File.read(machine.box.directory.join('include', INFO).to_s))
+        info = SavedStateResume.machinereadable(
+          driver.execute('showvminfo', machine.id, '--machinereadable'))
+        current = SavedStateResume.settings(info)
+        expected = saved['settings']
+        differences = (expected.keys | current.keys).sort.reject do |key|
+          expected[key] == current[key]
+        end
+        unless differences.empty?
+          env[:ui].info("Booting, the VM differs from the saved state of the box in: " +
+                        differences.join(', '))
+          return @app.call(env)
+        end
+
+        saved['macs'].each do |nic, mac|
+          driver.execute('modifyvm', machine.id, "--macaddress#{nic}", mac)
+        end
+        # VirtualBox deletes the state once the VM has resumed
+        copy = File.join(info['SnapFldr'], STATE)
+        FileUtils.mkdir_p(info['SnapFldr'])
+        FileUtils.cp(state.to_s, copy)
+        driver.execute('adoptstate', machine.id, copy)
+        env[:ui].info('Resuming from the saved state of the box')
+
+        begin
+          @app.call(env)
+        rescue Vagrant::Errors::VBoxManageError
+          vm_state = SavedStateResume.machinereadable(
+            driver.execute('showvminfo', machine.id, '--machinereadable'))['VMState']
+          # anything but a failed resume
+          raise unless %w(saved aborted).include?(vm_state)
+          env[:ui].warn('Resuming from the saved state failed, booting instead')
+          driver.execute('discardstate', machine.id) if vm_state == 'saved'
+          @app.call(env)
+        end
+      end
+    end
+
+    class Plugin < Vagrant.plugin('2')
+      name 'saved state resume'
+
+      action_hook(:saved_state_resume, :machine_action_up) do |hook|
+        hook.before(VagrantPlugins::ProviderVirtualBox::Action::Boot, Middleware)
+      end
+    end
+  end
+end
@@ -46,7 +46,8 @@ Vagrantfiles for more advanced multi-node topologies.
   . Starts the VM, then uses pexpect to configure XE for
     basic networking, with user name vagrant/vagrant and SSH key
   . Configures NETCONF and RESTCONF (config and operational data)
-  . Closes the VM down, once configured.
+  . Closes the VM down, once configured (or saves its state with
+    --saved-state, see saved_state.py).
 
 The resultant box image, will come up fully networked and ready for use
 with RESTCONF and NETCONF.
@@ -59,24 +60,189 @@ NOTE: If more than one interface in the resulting Vagrant box is required
 from __future__ import print_function
 import sys
 import os
-import time
 import subprocess
-import getpass
 import argparse
 import re
+import socket
 import logging
 from logging import StreamHandler
 import textwrap
+import atexit
 
 try:
     import pexpect
 except ImportError:
     sys.exit('The "pexpect" Python module is not installed. Please install it using pip or OS packaging.')
 
-
-# Telnet ports used to access IOS XE via socat
+import vboxmanage
+import disk_cache
+import build_cache
+import iso_fetch
+import iso_remaster
+import box_packer
+import box_catalog
+import saved_state
+import console_dialog
+import console_transport
+import console_log
+import build_trace
+import build_history
+from console_dialog import Step
+
+
+# Part of the build key of cached builds, bump when the box changes
+__version__ = '2.0'
+
+# Telnet ports used to access IOS XE (see console_transport.py)
 CONSOLE_PORT = 65000
 
+# Long time for full configuration, waiting for ip address etc
+CONSOLE_TIMEOUT = 600
+
+# Console prompt of any hostname and configuration mode
+XE_PROMPT = r'[\w-]+(\([\w-]+\))?[#>]'
+
+# Last message of the boot, the console is ready after it
+XE_BOOT_MARKER = r'CRYPTO-6-GDOI_ON_OFF: GDOI is OFF'
+
+# "Press RETURN to get started", keep pressing until there is a prompt
+XE_WAKE_DIALOG = [
+    Step('wake console', send=''),
+    Step('exec prompt', XE_PROMPT, nudge=2),
+]
+
+XE_SAVE_DIALOG = [
+    Step('save', send='copy run start'),
+    Step('destination', r'Destination filename \[startup-config\]\?', send=''),
+    Step('saved', r'\[OK\]'),
+    Step('save prompt', XE_PROMPT),
+]
+
+# Baseline configuration of the box: NETCONF, RESTCONF, vagrant user and the
+# insecure vagrant SSH key.  Each block can be pushed to the console in one go.
+XE_BASELINE_CONFIG = [
+    ('console', [
+        "term width 300",
+        # enable plus config mode
+        "enable",
+        "conf t",
+        # no TFTP config
+        "no logging console",
+        "no service config",
+    ]),
+    # NETCONF (odm == Operational Data)
+    ('netconf', [
+        "netconf-yang cisco-odm actions parse.showACL",
+        "netconf-yang cisco-odm actions parse.showBGP",
+        "netconf-yang cisco-odm actions parse.showArchive",
+        "netconf-yang cisco-odm actions parse.showIpRoute",
+        "netconf-yang cisco-odm actions parse.showInterfaces",
+        "netconf-yang cisco-odm actions parse.showEnvironment",
+        "netconf-yang cisco-odm actions parse.showFlowMonitor",
+        "netconf-yang cisco-odm actions parse.showBFDneighbors",
+        "netconf-yang cisco-odm actions parse.showBridgeDomain",
+        "netconf-yang cisco-odm actions parse.showProcessesCPU",
+        "netconf-yang cisco-odm actions parse.showEfpStatistics",
+        "netconf-yang cisco-odm actions parse.showLLDPneighbors",
+        "netconf-yang cisco-odm actions parse.showVirtualService",
+        "netconf-yang cisco-odm actions parse.showIPslaStatistics",
+        "netconf-yang cisco-odm actions parse.showMPLSldpNieghbor",
+        "netconf-yang cisco-odm actions parse.showProcessesMemory",
+        "netconf-yang cisco-odm actions parse.showMemoryStatistics",
+        "netconf-yang cisco-odm actions parse.showPlatformSoftware",
+        "netconf-yang cisco-odm actions parse.showMPLSstaticBinding",
+        "netconf-yang cisco-odm actions parse.showMPLSforwardingTable",
+        "netconf-yang cisco-odm actions parse.showIpOspfDatabaseRouter",
+        "netconf-yang cisco-odm actions parse.showEthernetCFMstatistics",
+        "netconf-yang cisco-odm polling-enable",
+        "netconf-yang",
+        # this is not needed according to Jason
+        # "netconf ssh",
+    ]),
+    ('users', [
+        # hostname / domain-name
+        "hostname csr1kv",
+        "ip domain-name dna.lab",
+        # key generation
+        # "crypto key generate rsa modulus 2048",
+        # passwords and username
+        "username vagrant priv 15 password vagrant",
+        "enable password cisco",
+        "enable secret cisco",
+        # line configuration
+        "line vty 0 4",
+        "login local",
+    ]),
+    # ssh vagrant insecure public key
+    ('ssh key', [
+        "ip ssh pubkey-chain",
+        "username vagrant",
+        "key-string",
+        "AAAAB3NzaC1yc2EAAAABIwAAAQEA6NF8iallvQVp22WDkTkyrtvp9eW",
+        "W6A8YVr+kz4TjGYe7gHzIw+niNltGEFHzD8+v1I2YJ6oXevct1YeS0o",
+        "9HZyN1Q9qgCgzUFtdOKLv6IedplqoPkcmF0aYet2PkEDo3MlTBckFXP",
+        "ITAMzF8dJSIFo9D8HfdOV0IAdx4O7PtixWKn5y2hMNG0zQPyUecp4pz",
+        "C6kivAIhyfHilFR61RGL+GPXQ2MWZWFYbAGjyiYJnAmCP3NOTd0jMZE",
+        "nDkbUvxhMmBYSdETk1rRgm+R4LOzFUGaHqHDLKLX+FIPKcF96hrucXz",
+        "cWyLbIbEgE98OHlnVYCzRdK8jlqm8tehUc9c9WhQ==",
+        "exit",
+    ]),
+    ('restconf', [
+        "ip http server",
+        "ip http secure-server",
+        "restconf",
+        "end",
+    ]),
+]
+
+# With --split only the minimum needed to reach the box over SSH goes over
+# the serial console ...  DHCP on GigabitEthernet1, the RSA key and SSH
+# version 2 stay in the box, unlike in a console only build.
+XE_BOOTSTRAP_CONFIG = [
+    ('console', [
+        "term width 300",
+        "enable",
+        "conf t",
+        "no logging console",
+        "no service config",
+    ]),
+    ('bootstrap', [
+        "hostname csr1kv",
+        "ip domain-name dna.lab",
+        "username vagrant priv 15 password vagrant",
+        "interface GigabitEthernet1",
+        "ip address dhcp",
+        "no shutdown",
+        "exit",
+        "crypto key generate rsa modulus 2048",
+        "ip ssh version 2",
+        "line vty 0 4",
+        "login local",
+        "transport input ssh",
+        "exit",
+        "netconf-yang",
+        "end",
+    ]),
+]
+
+# ... and the rest of the baseline follows in one SSH session.
+XE_REMOTE_CONFIG = [
+    ('netconf', ["conf t"] + [
+        line for line in dict(XE_BASELINE_CONFIG)['netconf'] if line != "netconf-yang"]),
+    ('passwords', [
+        "enable password cisco",
+        "enable secret cisco",
+    ]),
+    ('ssh key', dict(XE_BASELINE_CONFIG)['ssh key']),
+    # back to the vty transport of a console only build, the session stays
+    ('vty', [
+        "line vty 0 4",
+        "default transport input",
+        "exit",
+    ]),
+    ('restconf', dict(XE_BASELINE_CONFIG)['restconf']),
+]
+
 # The background is set with 40 plus the number of the color,
 # and the foreground with 30.
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
@@ -159,10 +325,11 @@ def run(cmd, hide_error=False, cont_on_error=False):
     s_cmd = ' '.join(cmd)
     logger.info("'%s'", s_cmd)
 
-    output = subprocess.Popen(cmd,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-    tup_output = output.communicate()
+    with build_trace.span(' '.join(cmd[:2]), 'run', cmd=s_cmd):
+        output = subprocess.Popen(cmd,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        tup_output = output.communicate()
 
     if output.returncode != 0:
         logger.error('Failed (%d):', output.returncode)
@@ -187,23 +354,35 @@ def cleanup_vmname(name, box_name):
     Cleanup and unregister (delete) our working box.
     """
 
+    state = vboxmanage.vm_state(name, run)
+
     # Power off VM if it is running
-    vms_list_running = run(['VBoxManage', 'list', 'runningvms'])
-    if name in vms_list_running:
-        logger.debug("'%s' is running, powering off...", name)
+    if state is not None and state not in vboxmanage.STOPPED:
+        logger.debug("'%s' is %s, powering off...", name, state)
         run(['VBoxManage', 'controlvm', name, 'poweroff'])
+        wait_for_state(name, vboxmanage.STOPPED)
 
     # Unregister and delete
-    vms_list = run(['VBoxManage', 'list', 'vms'])
-    if name in vms_list:
+    if state is not None:
         logger.debug("'%s' is registered, unregistering and deleting", name)
         run(['VBoxManage', 'unregistervm', box_name, '--delete'])
 
 
-def pause_to_debug():
+def wait_for_state(name, states, timeout=120):
+    """
+    Wait for the VM to reach one of states, quit if it doesn't.
+    """
+
+    try:
+        return vboxmanage.wait_for_state(name, states, run, timeout=timeout)
+    except vboxmanage.StateTimeout as e:
+        sys.exit(str(e))
+
+
+def pause_to_debug(console_port=CONSOLE_PORT):
     logger.critical("Pause before debug")
     logger.critical(
-        "Use: 'socat TCP:localhost:65000 -,raw,echo=0,escape=0x1d' to access the VM")
+        "Use: 'python console_transport.py tcp:localhost:%s' to access the VM", console_port)
     raw_input("Press Enter to continue.")
     # To debug post box creation, add the following line to Vagrantfile
     # config.vm.provider "virtualbox" do |v|
@@ -211,6 +390,18 @@ def pause_to_debug():
     # end
 
 
+def free_port():
+    """
+    Return a TCP port on localhost that is free right now.
+    """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
 def start_process(args):
     """
     Start vboxheadless process
@@ -219,20 +410,60 @@ def start_process(args):
     logger.debug('args: %s', args)
     with open(os.devnull, 'w') as fp:
         subprocess.Popen((args), stdout=fp)
-    time.sleep(2)
 
 
-def configure_xe(verbose=False, wait=True):
+def wait_for_boot(verbose=False, console_port=CONSOLE_PORT, logfile="console.log",
+                  console=None):
+    """
+    Wait until IOS XE is installed and booted, without configuring it.
+
+    console is a pexpect child already connected to the console, e.g. to
+    the simulator of console_sim.py, used instead of connecting to console_port.
+    """
+
+    logger.warn('Waiting for IOS XE to install and boot (may take 5 minutes or so)')
+    child = console or console_transport.ConsoleSpawn('tcp:localhost:%s' % console_port)
+    if verbose:
+        child.logfile = console_log.ConsoleLog(logfile)
+    dialog = console_dialog.Dialog('IOS XE install')
+    try:
+        dialog.run(child, [Step('install and boot', XE_BOOT_MARKER, timeout=CONSOLE_TIMEOUT,
+                                window=console_dialog.MARKER_WINDOW)])
+    finally:
+        if verbose:
+            child.logfile.close()
+            child.logfile = None
+    if console is None:
+        child.close()
+    dialog.report()
+    return dialog.timings
+
+
+def configure_xe(verbose=False, wait=True, console_port=CONSOLE_PORT,
+                 logfile="console.log", bulk=False, ssh_port=None, console=None):
     """
     Bring up XE and do some initial config.
-    Using socat to do the connection as telnet has an
-    odd double return on vbox
+    Connecting straight to the uart socket (console_transport.py) as
+    telnet has an odd double return on vbox
+
+    console_port and logfile allow several builds to run side by side,
+    each on its own uart and with its own console transcript.  In verbose
+    mode the transcript is compressed to logfile.gz (see console_log.py).
+
+    With bulk the baseline configuration is streamed to the console block
+    by block instead of waiting for echo and prompt after every line.
+
+    With ssh_port only XE_BOOTSTRAP_CONFIG goes over the console, the rest
+    is pushed over SSH through that NAT forwarded port.
+
+    console is a pexpect child already connected to the console, e.g. to
+    the simulator of console_sim.py, used instead of connecting to console_port.
     """
 
     logger.warn('Waiting for IOS XE to boot (may take 3 minutes or so)')
     localhost = 'localhost'
 
-    PROMPT = r'[\w-]+(\([\w-]+\))?[#>]'
+    PROMPT = XE_PROMPT
     # don't want to rely on specific hostname
     # PROMPT = r'(Router|csr1kv).*[#>]'
     CRLF = "\r\n"
@@ -250,109 +481,174 @@ def configure_xe(verbose=False, wait=True):
             send_line(c)
         child.expect(PROMPT)
 
+    dialog = console_dialog.Dialog('IOS XE')
+    transcript = None
+    session = None
+
     try:
-        child = pexpect.spawn("socat TCP:%s:%s -,raw,echo=0,escape=0x1d" % (localhost, CONSOLE_PORT))
+        child = console or console_transport.ConsoleSpawn(
+            'tcp:%s:%s' % (localhost, console_port))
 
         if verbose:
-            child.logfile = open("tmp.log", "w")
+            child.logfile = transcript = console_log.ConsoleLog(logfile)
 
         # Long time for full configuration, waiting for ip address etc
-        child.timeout = 600
+        child.timeout = CONSOLE_TIMEOUT
 
         # wait for indication that boot has gone through
         if (wait):
-            child.expect(r'CRYPTO-6-GDOI_ON_OFF: GDOI is OFF', child.timeout)
+            dialog.run(child, [Step('boot', XE_BOOT_MARKER, timeout=child.timeout,
+                                    window=console_dialog.MARKER_WINDOW)])
             logger.warn(
                 'Logging into Vagrant Virtualbox and configuring IOS XE')
 
-        send_line()
-        time.sleep(5)
-        send_line()
-        send_cmd("term width 300")
+        dialog.run(child, XE_WAKE_DIALOG)
+
+        with dialog.timed('console config'):
+            if ssh_port:
+                console_dialog.bulk_push(child, XE_BOOTSTRAP_CONFIG, PROMPT)
+            elif bulk:
+                console_dialog.bulk_push(child, XE_BASELINE_CONFIG, PROMPT)
+            else:
+                for _, lines in XE_BASELINE_CONFIG:
+                    for line in lines:
+                        send_cmd(line)
+
+        session = child
+        if ssh_port:
+            logger.warn('Configuring IOS XE over SSH')
+            with dialog.timed('ssh login'):
+                session = console_dialog.ssh_session(
+                    ssh_port, 'vagrant', 'vagrant', PROMPT)
+            if verbose:
+                session.logfile = child.logfile
+            with dialog.timed('ssh config'):
+                console_dialog.bulk_push(session, XE_REMOTE_CONFIG, PROMPT)
 
-        # enable plus config mode
-        send_cmd("enable")
-        send_cmd("conf t")
+        # done and save
+        dialog.run(session, XE_SAVE_DIALOG)
 
-        # no TFTP config
-        send_cmd("no logging console")
-        time.sleep(5)
-        send_cmd("no service config")
-
-        # NETCONF (odm == Operational Data)
-        send_cmd("netconf-yang cisco-odm actions parse.showACL")
-        send_cmd("netconf-yang cisco-odm actions parse.showBGP")
-        send_cmd("netconf-yang cisco-odm actions parse.showArchive")
-        send_cmd("netconf-yang cisco-odm actions parse.showIpRoute")
-        send_cmd("netconf-yang cisco-odm actions parse.showInterfaces")
-        send_cmd("netconf-yang cisco-odm actions parse.showEnvironment")
-        send_cmd("netconf-yang cisco-odm actions parse.showFlowMonitor")
-        send_cmd("netconf-yang cisco-odm actions parse.showBFDneighbors")
-        send_cmd("netconf-yang cisco-odm actions parse.showBridgeDomain")
-        send_cmd("netconf-yang cisco-odm actions parse.showProcessesCPU")
-        send_cmd("netconf-yang cisco-odm actions parse.showEfpStatistics")
-        send_cmd("netconf-yang cisco-odm actions parse.showLLDPneighbors")
-        send_cmd("netconf-yang cisco-odm actions parse.showVirtualService")
-        send_cmd("netconf-yang cisco-odm actions parse.showIPslaStatistics")
-        send_cmd("netconf-yang cisco-odm actions parse.showMPLSldpNieghbor")
-        send_cmd("netconf-yang cisco-odm actions parse.showProcessesMemory")
-        send_cmd("netconf-yang cisco-odm actions parse.showMemoryStatistics")
-        send_cmd("netconf-yang cisco-odm actions parse.showPlatformSoftware")
-        send_cmd("netconf-yang cisco-odm actions parse.showMPLSstaticBinding")
-        send_cmd("netconf-yang cisco-odm actions parse.showMPLSforwardingTable")
-        send_cmd("netconf-yang cisco-odm actions parse.showIpOspfDatabaseRouter")
-        send_cmd("netconf-yang cisco-odm actions parse.showEthernetCFMstatistics")
-        send_cmd("netconf-yang cisco-odm polling-enable")
-        send_cmd("netconf-yang")
-        # this is not needed according to Jason
-        # send_cmd("netconf ssh")
+    except pexpect.TIMEOUT:
+        raise pexpect.TIMEOUT('Timeout (%s) exceeded in read().' % str(child.timeout))
+    except console_dialog.BulkPushError as e:
+        sys.exit(str(e))
+    finally:
+        if session is not None and session is not child:
+            session.logfile = None
+            session.close()
+        if transcript is not None:
+            transcript.close()
+            child.logfile = None
 
-        # hostname / domain-name
-        send_cmd("hostname csr1kv")
-        send_cmd("ip domain-name dna.lab")
+    dialog.report()
+    return dialog.timings
 
-        # key generation
-        # send_cmd("crypto key generate rsa modulus 2048")
-        # time.sleep(5)
 
-        # passwords and username
-        send_line()
-        send_cmd("username vagrant priv 15 password vagrant")
-        send_cmd("enable password cisco")
-        send_cmd("enable secret cisco")
+def xe_vm_spec(vmname, ram, image_version_num, console_port, vdi=None, iso=None):
+    """
+    Describe the build VM: memory, display, NIC, serial ports and storage.
 
-        # line configuration
-        send_cmd("line vty 0 4")
-        send_cmd("login local")
-
-        # ssh vagrant insecure public key
-        send_cmd("ip ssh pubkey-chain")
-        send_cmd("username vagrant")
-        send_cmd("key-string")
-        send_cmd("AAAAB3NzaC1yc2EAAAABIwAAAQEA6NF8iallvQVp22WDkTkyrtvp9eW")
-        send_cmd("W6A8YVr+kz4TjGYe7gHzIw+niNltGEFHzD8+v1I2YJ6oXevct1YeS0o")
-        send_cmd("9HZyN1Q9qgCgzUFtdOKLv6IedplqoPkcmF0aYet2PkEDo3MlTBckFXP")
-        send_cmd("ITAMzF8dJSIFo9D8HfdOV0IAdx4O7PtixWKn5y2hMNG0zQPyUecp4pz")
-        send_cmd("C6kivAIhyfHilFR61RGL+GPXQ2MWZWFYbAGjyiYJnAmCP3NOTd0jMZE")
-        send_cmd("nDkbUvxhMmBYSdETk1rRgm+R4LOzFUGaHqHDLKLX+FIPKcF96hrucXz")
-        send_cmd("cWyLbIbEgE98OHlnVYCzRdK8jlqm8tehUc9c9WhQ==")
-        send_cmd("exit")
-
-        # restconf
-        send_cmd("ip http server")
-        send_cmd("ip http secure-server")
-        send_cmd("restconf")
+    Without vdi only the hardware is described, the disks can be attached
+    later with xe_attach_disks().
+    """
 
-        # done and save
-        send_cmd("end")
-        send_cmd(["copy run start", CRLF])
+    spec = vboxmanage.VMSpec(vmname)
 
-        # just to be sure
-        logger.warn('Waiting 10 seconds...')
-        time.sleep(10)
+    # Setup memory, display, cpus etc
+    spec.modify('--vram', 4)
+    spec.modify('--memory', ram)
+    spec.modify('--acpi', 'on')
+    # spec.modify('--cpus', 2)
 
-    except pexpect.TIMEOUT:
-        raise pexpect.TIMEOUT('Timeout (%s) exceeded in read().' % str(child.timeout))
+    # Setup networking - including ssh
+    # it seems to be totally irrelevant how many interfaces are provisioned into
+    # the inital box as the vagrant box create reduces the amount to 1 anyway.
+    # if one wants more interfaces for individiual boxes then those have to be
+    # added either in the vagrant file template or in the actual file inside the
+    # box (after vagrant init).
+    spec.modify('--nic1', 'nat')
+    if image_version_num >= 16.7:
+        spec.modify('--nictype1', 'virtio')
+    else:
+        spec.modify('--nictype1', '82540EM')
+    spec.modify('--cableconnected1', 'on')
+
+    # Add Serial ports
+    #
+    # 1. what kind of serial port the virtual machine should see by selecting
+    # an I/O base
+    # address and interrupt (IRQ). For these, we recommend to use the
+    # traditional values, which are:
+    # a) COM1: I/O base 0x3F8, IRQ 4
+    # b) COM2: I/O base 0x2F8, IRQ 3
+    # c) COM3: I/O base 0x3E8, IRQ 4
+    # d) COM4: I/O base 0x2E8, IRQ 3
+    # [--uartmode<1-N> disconnected|
+    #  server <pipe>|
+    #  client <pipe>|
+    #  tcpserver <port>|
+    #  tcpclient <hostname:port>|
+    #  file <file>|
+    #  <devicename>]
+
+    # Option 1: Output to a simple file: 'tail -f /tmp/serial' (no file?)
+    # VBoxManage modifyvm $VMNAME --uart1 0x3f8 4 --uartmode1 file /tmp/serial1
+
+    # Option 2: Connect straight to the socket (console_transport.py) as
+    # telnet has double echo issue
+    # console port
+    spec.modify('--uart1', '0x3f8', '4')
+    spec.modify('--uartmode1', 'tcpserver', console_port)
+    # aux port
+    spec.modify('--uart2', '0x2f8', '3')
+    spec.modify('--uartmode2', 'disconnected')
+
+    # Option 3: Connect via telnet
+    # VBoxManage modifyvm $VMNAME --uart1 0x3f8 4 --uartmode1 tcpserver 6000
+    # VBoxManage modifyvm $VMNAME --uart2 0x2f8 3 --uartmode2 tcpserver 6001
+
+    # Change boot order to hd then dvd
+    spec.modify('--boot1', 'disk')
+    spec.modify('--boot2', 'dvd')
+
+    # Setup storage
+    spec.storagectl('IDE_Controller', 'ide')
+    if vdi is not None:
+        xe_attach_disks(spec, vdi, iso)
+
+    return spec
+
+
+def xe_attach_disks(spec, vdi, iso=None):
+    """
+    Attach the hdd and the dvd to the spec (no dvd for an installed disk).
+    """
+
+    spec.attach('IDE_Controller', 0, 0, 'hdd', vdi)
+    if iso is not None:
+        spec.attach('IDE_Controller', 1, 0, 'dvddrive', iso)
+    return spec
+
+
+def show_next_steps(image_version, box_out, catalog=None):
+    """
+    Log how to add and use the box.
+    """
+
+    logger.warn('Add box to system:')
+    logger.warn('  vagrant box add --name iosxe/{version} {boxout} --force'.format(version=image_version, boxout=box_out))
+    logger.warn('Initialize environment:')
+    logger.warn('  vagrant init iosxe/{version}'.format(version=image_version))
+    if catalog:
+        logger.warn('Or add every version in the catalog, as the versioned box iosxe:')
+        logger.warn('  vagrant box add {catalog}'.format(catalog=catalog))
+        logger.warn('  vagrant init iosxe --box-version {version}'.format(version=image_version))
+    logger.warn('Bring up box:')
+    logger.warn('  vagrant up')
+
+    logger.warn('Note:')
+    logger.warn(
+        '  Both the XE SSH and NETCONF/RESTCONF username and password is vagrant/vagrant')
 
 
 def main(argv):
@@ -375,14 +671,62 @@ def main(argv):
                     %(prog)s csr1000v-universalk9.16.03.01.iso
                 box build with remote iso:
                     %(prog)s user@server:/myboxes/csr1000v-universalk9.16.03.01.iso
+                several builds at once (see build_farm.py):
+                    %(prog)s csr1000v-universalk9.16.07.01.iso -p 65001 -l csr-16.07.log
         '''))
 
     parser.add_argument('ISO_FILE',
                         help='local ISO filename or remote URI ISO filename')
     parser.add_argument('-o', '--create_ova', action='store_true',
-                        help='additionally use VBoxManage to export an OVA')
+                        help='additionally export an OVA, from the same pass as the box')
+    parser.add_argument('--qcow2', action='store_true',
+                        help='additionally write the disk as a qcow2 image (libvirt)')
     parser.add_argument('-d', '--debug', action='store_true',
-                        help='will exit with the VM in a running state. Use: socat TCP:localhost:65000 -,raw,echo=0,escape=0x1d to access')
+                        help='will exit with the VM in a running state. Use: python console_transport.py tcp:localhost:65000 to access')
+    parser.add_argument('-p', '--console-port', type=int, default=CONSOLE_PORT,
+                        help='host TCP port for the VM console uart (default: %(default)s)')
+    parser.add_argument('-b', '--base-dir', default=os.path.join(os.getcwd(), 'created_boxes'),
+                        help='folder for the VM and the created box (default: ./created_boxes)')
+    parser.add_argument('-l', '--log-file',
+                        help='console transcript written in verbose mode, compressed and rotated '
+                             '(default: <box folder>/<vm name>-console.log.gz)')
+    parser.add_argument('-m', '--memory', type=int, default=4096,
+                        help='VM memory in MB (default: %(default)s)')
+    parser.add_argument('-c', '--disk-cache', action='store_true',
+                        help='start from a cached installed disk of this ISO, or cache it')
+    parser.add_argument('--disk-cache-dir', default=disk_cache.DEFAULT_CACHE_DIR,
+                        help='folder of the disk cache (default: %(default)s)')
+    parser.add_argument('-i', '--image-cache', default=iso_fetch.DEFAULT_IMAGE_DIR,
+                        help='folder remote ISOs are fetched into (default: %(default)s)')
+    parser.add_argument('--iso-sha256',
+                        help='expected SHA-256 of the ISO, the build stops if it differs')
+    parser.add_argument('-s', '--serial', action='store_true',
+                        help='remaster the ISO to boot to the serial console (16.6 and 16.7 boot to VGA)')
+    parser.add_argument('-f', '--force-rebuild', action='store_true',
+                        help='build even if an identical box was built before')
+    parser.add_argument('--bulk', action='store_true',
+                        help='stream the configuration to the console block by block')
+    parser.add_argument('--split', action='store_true',
+                        help='bootstrap SSH over the console, then configure the rest over SSH')
+    parser.add_argument('--compression', choices=box_packer.COMPRESSIONS, default='gzip',
+                        help='box compression, on all cores (default: %(default)s)')
+    parser.add_argument('--vagrant-package', action='store_true',
+                        help='package the box with "vagrant package" (one core)')
+    parser.add_argument('--full-disk', action='store_true',
+                        help='export the whole disk instead of only its allocated data')
+    parser.add_argument('--saved-state', action='store_true',
+                        help='save the state of the configured VM with the box, so vagrant up '
+                             'resumes it instead of booting (see saved_state.py)')
+    parser.add_argument('--catalog-dir',
+                        help='add the box to the Vagrant catalog iosxe/metadata.json in this folder '
+                             '(default: the base folder)')
+    parser.add_argument('--history', default=build_history.DEFAULT_HISTORY,
+                        help='build history the timings are added to (default: %(default)s)')
+    parser.add_argument('--no-history', action='store_true',
+                        help='don\'t add this build to the build history')
+    parser.add_argument('-t', '--trace', action='store_true',
+                        help='write a Chrome trace (<box folder>/<vmname>-trace.json) and a '
+                             'summary of where the build time went')
     parser.add_argument('-n', '--nocolor', action='store_true',
                         help='don\'t use colors for logging')
     parser.add_argument('-v', '--verbose',
@@ -399,58 +743,52 @@ def main(argv):
     root_logger.addHandler(handler)
     logger = logging.getLogger("box-builder")
 
-    # PRE-CHECK: is socat installed?
-    logger.warn('Check whether "socat" is installed')
-    try:
-        run(['socat', '-V'])
-    except OSError:
-        sys.exit(
-            'The "socat" utility is not installed. Please install it prior to using this script.')
+    if args.trace:
+        tracer = build_trace.start(os.path.basename(args.ISO_FILE))
+    build_trace.phase('prepare')
 
     # Handle Input ISO (Local or URI)
-    if re.search(':/', args.ISO_FILE):
-        # URI Image
-        cmd_string = 'scp %s@%s .' % (getpass.getuser(), args.ISO_FILE)
-        logger.warn('Will attempt to scp the remote image to current working dir. You may be required to enter your password.')
-        logger.debug('%s\n', cmd_string)
-        subprocess.call(cmd_string, shell=True)
-        input_iso = os.path.basename(args.ISO_FILE)
+    # Remote images are streamed into the image cache in the background,
+    # local ones are hashed, while the VM gets defined.
+    if iso_fetch.parse_source(args.ISO_FILE)[0] == 'local':
+        if not os.path.exists(args.ISO_FILE):
+            sys.exit('%s does not exist' % args.ISO_FILE)
     else:
-        # Local image
-        input_iso = args.ISO_FILE
+        logger.warn('Fetching the remote image into %s. You may be required to enter your password.', args.image_cache)
+    acquisition = iso_fetch.acquire(args.ISO_FILE, args.image_cache,
+                                    args.iso_sha256)
+    iso_name = iso_fetch.image_name(args.ISO_FILE)
 
     # if debug flag then set the logger to debug
     if args.debug:
         args.verbose = logging.DEBUG
 
-    if not os.path.exists(input_iso):
-        sys.exit('%s does not exist' % input_iso)
-
     # Set Virtualbox VM name from the input ISO
-    vmname = os.path.basename(os.path.splitext(input_iso)[0])
-    logger.warn('Input ISO is %s', input_iso)
+    vmname = os.path.splitext(iso_name)[0]
+    logger.warn('Input ISO is %s', args.ISO_FILE)
 
     # playing it safe, should be OK in 3G / 3072
-    ram = 4096
+    ram = args.memory
     logger.warn('Creating VirtualBox VM')
 
     version = run(['VBoxManage', '-v'])
     logger.info('Virtual Box Manager Version: %s', version)
 
     # Variables
-    image_version = input_iso[input_iso.find(".")+1:len(input_iso)-4]
+    image_version = iso_name[iso_name.find(".")+1:len(iso_name)-4]
     ver_parts = image_version.split(".")
     ver_major = int(ver_parts[0])
     ver_minor = int(ver_parts[1])
     image_version_num = float("{major}.{minor}".format(major = ver_major, minor = ver_minor))
 
     # Set up paths
-    base_dir = os.path.join(os.getcwd(), 'created_boxes')
+    base_dir = os.path.abspath(args.base_dir)
     box_dir = os.path.join(base_dir, vmname)
     vbox = os.path.join(box_dir, vmname + '.vbox')
     vdi = os.path.join(box_dir, vmname + '.vdi')
     box_out = os.path.join(box_dir, vmname + '.box')
     ova_out = os.path.join(box_dir, vmname + '.ova')
+    qcow2_out = os.path.join(box_dir, vmname + '.qcow2')
     pathname = os.path.abspath(os.path.dirname(sys.argv[0]))
 
     logger.debug('pathname: %s', pathname)
@@ -466,6 +804,91 @@ def main(argv):
     if not os.path.exists(box_dir):
         os.makedirs(box_dir)
 
+    if args.log_file is None:
+        args.log_file = os.path.join(box_dir, vmname + '-console.log')
+
+    if args.trace:
+        trace_out = os.path.join(box_dir, vmname + '-trace.json')
+
+        def write_trace():
+            logger.warn('Build trace: %s\n%s', trace_out, tracer.write(trace_out))
+        # on sys.exit too, a failed build is worth a look as well
+        atexit.register(write_trace)
+
+    # Add the embedded Vagrantfile
+    if image_version_num >= 16.7:
+        vagrantfile_pathname = os.path.join(
+            pathname, 'include', 'embedded_vagrantfile_xe_virtio')
+    else:
+        vagrantfile_pathname = os.path.join(
+            pathname, 'include', 'embedded_vagrantfile_xe')
+
+    # Clean up existing vm's
+    build_trace.phase('vm create')
+    cleanup_vmname(vmname, vbox)
+
+    # Create and register a new VirtualBox VM with all of its hardware
+    # settings in as few VBoxManage calls as possible, the disks follow
+    # once the ISO is there
+    logger.debug('Create VM')
+    spec = xe_vm_spec(vmname, ram, image_version_num, args.console_port)
+    ssh_port = None
+    if args.split:
+        # forward a free local port to SSH for the build
+        ssh_port = free_port()
+        spec.modify('--natpf1', 'build-ssh,tcp,127.0.0.1,%d,,22' % ssh_port)
+    spec.create(run, base_dir)
+
+    build_trace.phase('iso wait')
+    if acquisition.is_alive():
+        logger.warn('Waiting for the ISO')
+    try:
+        input_iso, iso_sha = acquisition.result()
+    except iso_fetch.FetchError as e:
+        cleanup_vmname(vmname, vbox)
+        sys.exit(str(e))
+    logger.debug('ISO %s, SHA-256 %s', input_iso, iso_sha)
+    # the remastered ISO installs a different disk
+    install_sha = iso_sha + '-serial' if args.serial else iso_sha
+
+    # Was this exact box built before?  The console port and the paths
+    # don't end up in the box, so the key uses fixed ones.
+    if args.split:
+        config = XE_BOOTSTRAP_CONFIG + XE_REMOTE_CONFIG
+    else:
+        config = XE_BASELINE_CONFIG
+    key_spec = xe_vm_spec(vmname, ram, image_version_num, CONSOLE_PORT,
+                          'disk.vdi', 'install.iso')
+    vm_key = key_spec.key()
+    if args.saved_state:
+        # the execution state goes into the box as well
+        vm_key['saved_state'] = True
+    # the packer decides the bytes of the box
+    if args.vagrant_package:
+        vm_key['packer'] = {'mode': 'vagrant package'}
+    else:
+        vm_key['packer'] = {'mode': 'box_packer', 'compression': args.compression,
+                            'full_disk': args.full_disk}
+    build_key = build_cache.build_key(install_sha, vagrantfile_pathname, config,
+                                      vm_key, __version__)
+    manifest = build_cache.BuildManifest(
+        os.path.join(base_dir, build_cache.MANIFEST_NAME))
+    wanted = ['box'] + (['ova'] if args.create_ova else []) + \
+        (['qcow2'] if args.qcow2 else [])
+    catalog_dir = args.catalog_dir or base_dir
+    logger.debug('Build key: %s', build_key)
+    artifacts = manifest.lookup(build_key, wanted)
+    if artifacts and not args.force_rebuild:
+        logger.warn('Identical box built before, nothing to do (use --force-rebuild to build anyway)')
+        cleanup_vmname(vmname, vbox)
+        for name in wanted:
+            logger.warn('Created: %s', artifacts[name]['path'])
+        catalog = box_catalog.add_box(catalog_dir, 'iosxe', image_version,
+                                      artifacts['box']['path'],
+                                      artifacts['box']['sha256'])
+        show_next_steps(image_version, artifacts['box']['path'], catalog)
+        return
+
     # Delete existing Box
     if os.path.exists(box_out):
         os.remove(box_out)
@@ -476,187 +899,186 @@ def main(argv):
         os.remove(ova_out)
         logger.debug('Found and deleted previous %s', ova_out)
 
-    # Clean up existing vm's
-    cleanup_vmname(vmname, vbox)
+    # Delete existing qcow2 image
+    if os.path.exists(qcow2_out) and args.qcow2:
+        os.remove(qcow2_out)
+        logger.debug('Found and deleted previous %s', qcow2_out)
 
     # Remove stale SSH entry
     # logger.debug('Removing stale SSH entries')
     # run(['ssh-keygen', '-R', '[localhost]:2222'])
     # run(['ssh-keygen', '-R', '[localhost]:2223'])
 
-    # Create and register a new VirtualBox VM
-    logger.debug('Create VM')
-    run(['VBoxManage', 'createvm', '--name', vmname,
-         '--ostype', 'Linux26_64', '--basefolder', base_dir])
-
-    logger.debug('Register VM')
-    run(['VBoxManage', 'registervm', vbox])
-
-    # Setup memory, display, cpus etc
-    logger.debug('VRAM 4')
-    run(['VBoxManage', 'modifyvm', vmname, '--vram', '4'])
-
-    logger.debug('Add ACPI')
-    run(['VBoxManage', 'modifyvm', vmname, '--memory', str(ram), '--acpi', 'on'])
-
-    # logger.debug('Add two CPUs')
-    # run(['VBoxManage', 'modifyvm', vmname, '--cpus', '2'])
-
-    # Setup networking - including ssh
-    # it seems to be totally irrelevant how many interfaces are provisioned into
-    # the inital box as the vagrant box create reduces the amount to 1 anyway.
-    # if one wants more interfaces for individiual boxes then those have to be
-    # added either in the vagrant file template or in the actual file inside the
-    # box (after vagrant init).
-    logger.debug('Create NICs')
-    if image_version_num >= 16.7:
-        run(['VBoxManage', 'modifyvm', vmname, '--nic1', 'nat', '--nictype1', 'virtio'])
-    else:
-        run(['VBoxManage', 'modifyvm', vmname, '--nic1', 'nat', '--nictype1', '82540EM'])
-    run(['VBoxManage', 'modifyvm', vmname, '--cableconnected1', 'on'])
-
-    # Add Serial ports
-    #
-    # 1. what kind of serial port the virtual machine should see by selecting
-    # an I/O base
-    # address and interrupt (IRQ). For these, we recommend to use the
-    # traditional values, which are:
-    # a) COM1: I/O base 0x3F8, IRQ 4
-    # b) COM2: I/O base 0x2F8, IRQ 3
-    # c) COM3: I/O base 0x3E8, IRQ 4
-    # d) COM4: I/O base 0x2E8, IRQ 3
-    # [--uartmode<1-N> disconnected|
-    #  server <pipe>|
-    #  client <pipe>|
-    #  tcpserver <port>|
-    #  tcpclient <hostname:port>|
-    #  file <file>|
-    #  <devicename>]
-
-    # Option 1: Output to a simple file: 'tail -f /tmp/serial' (no file?)
-    # VBoxManage modifyvm $VMNAME --uart1 0x3f8 4 --uartmode1 file /tmp/serial1
-
-    # Option 2: Connect via socat as telnet has double echo issue)
-    # But can still use telnet in conjunction with socat
-    logger.debug('Add a console port')
-    run(['VBoxManage', 'modifyvm', vmname, '--uart1', '0x3f8',
-         '4', '--uartmode1', 'tcpserver', str(CONSOLE_PORT)])
-
-    logger.debug('Add an aux port')
-    run(['VBoxManage', 'modifyvm', vmname, '--uart2', '0x2f8',
-         '3', '--uartmode2', 'disconnected'])
-
-    # Option 3: Connect via telnet
-    # VBoxManage modifyvm $VMNAME --uart1 0x3f8 4 --uartmode1 tcpserver 6000
-    # VBoxManage modifyvm $VMNAME --uart2 0x2f8 3 --uartmode2 tcpserver 6001
+    # Installed disk from an earlier build of the same ISO?
+    build_trace.phase('disk')
+    cache = None
+    cached_disk = None
+    if args.disk_cache:
+        cache = disk_cache.DiskCache(args.disk_cache_dir)
+        logger.warn('Looking up installed disk in the cache')
+        cached_disk = cache.lookup(install_sha)
 
     # Setup storage
-    logger.debug('Create a HDD')
-    run(['VBoxManage', 'createhd', '--filename', vdi, '--size', '8192'])
-
-    logger.debug('Add IDE Controller')
-    run(['VBoxManage', 'storagectl', vmname,
-         '--name', 'IDE_Controller', '--add', 'ide'])
-
-    logger.debug('Attach HDD')
-    run(['VBoxManage', 'storageattach', vmname, '--storagectl', 'IDE_Controller',
-         '--port', '0', '--device', '0', '--type', 'hdd', '--medium', vdi])
-
-    logger.debug('VM HD info: ')
-    run(['VBoxManage', 'showhdinfo', vdi])
-
-    logger.debug('Add DVD drive')
-    run(['VBoxManage', 'storageattach', vmname, '--storagectl', 'IDE_Controller',
-         '--port', '1', '--device', '0', '--type', 'dvddrive', '--medium', input_iso])
-
-    # Change boot order to hd then dvd
-    logger.debug('Boot order disk first')
-    run(['VBoxManage', 'modifyvm', vmname, '--boot1', 'disk'])
-
-    logger.debug('Boot order DVD second')
-    run(['VBoxManage', 'modifyvm', vmname, '--boot2', 'dvd'])
+    if cached_disk:
+        logger.warn('Using installed disk from cache, skipping ISO install')
+        cache.restore(install_sha, vdi, run)
+    else:
+        logger.debug('Create a HDD')
+        run(['VBoxManage', 'createhd', '--filename', vdi, '--size', '8192'])
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('VM HD info: ')
+        run(['VBoxManage', 'showhdinfo', vdi])
+
+    # Boot to the serial console, patching only the GRUB menu in a copy
+    install_iso = input_iso
+    if args.serial and not cached_disk:
+        install_iso = os.path.join(box_dir, 'serial-' + iso_name)
+        logger.warn('Remastering ISO to boot to the serial console')
+        build_trace.phase('remaster')
+        try:
+            iso_remaster.remaster(input_iso, install_iso)
+        except iso_remaster.IsoError as e:
+            cleanup_vmname(vmname, vbox)
+            sys.exit('%s: %s' % (input_iso, e))
+
+    # Attach the disks - hdd and dvd (for an install from the ISO)
+    xe_attach_disks(vboxmanage.VMSpec(vmname), vdi,
+                    None if cached_disk else install_iso).apply(run, current=None)
 
     # Start the VM for installation of ISO - must be started as a sub process
+    build_trace.phase('start vm')
     logger.warn('Starting VM...')
     start_process(['VBoxHeadless', '--startvm', vmname])
-
-    while True:
-        vms_list = run(['VBoxManage', 'showvminfo', vmname])
-        if 'running (since' in vms_list:
-            logger.warn('Successfully started to boot VM disk image')
-            break
-        else:
-            logger.warning('Failed to install VM disk image\n')
-            time.sleep(5)
-            continue
+    wait_for_state(vmname, vboxmanage.RUNNING, timeout=60)
+    logger.warn('Successfully started to boot VM disk image')
+
+    if cache is not None and not cached_disk:
+        # Keep the freshly installed disk for the next build of this ISO
+        build_trace.phase('install')
+        wait_for_boot(args.verbose < logging.WARN, args.console_port,
+                      args.log_file)
+        build_trace.phase('cache disk')
+        logger.warn('Caching installed disk')
+        run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
+        wait_for_state(vmname, vboxmanage.STOPPED)
+        cache.store(install_sha, vdi, run, iso=install_iso)
+        start_process(['VBoxHeadless', '--startvm', vmname])
+        wait_for_state(vmname, vboxmanage.RUNNING, timeout=60)
 
     # Configure IOS XE
     # do print steps for logging set to DEBUG and INFO
     # DEBUG also prints the I/O with the device on the console
     # default is WARN
-    configure_xe(args.verbose < logging.WARN)
+    build_trace.phase('boot and configure')
+    configure_xe(args.verbose < logging.WARN,
+                 console_port=args.console_port, logfile=args.log_file,
+                 bulk=args.bulk, ssh_port=ssh_port)
 
     # Good place to stop and take a look if --debug was entered
     if args.debug:
-        pause_to_debug()
+        pause_to_debug(args.console_port)
 
     logger.warn('Powering down and generating Vagrant VirtualBox')
 
     # Powerdown VM prior to exporting
-    logger.warn('Waiting for machine to shutdown')
-    run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
-
-    while True:
-        vms_list_running = run(['VBoxManage', 'list', 'runningvms'])
-        if vmname in vms_list_running:
-            logger.debug('Still shutting down')
-            continue
-        else:
-            logger.debug('Successfully shut down')
-            break
+    build_trace.phase('shutdown')
+    include = []
+    if args.saved_state:
+        logger.warn('Saving the state of the machine')
+        try:
+            include = saved_state.save(vmname, box_dir, run)
+        except (vboxmanage.StateTimeout, saved_state.SavedStateError) as e:
+            sys.exit(str(e))
+    else:
+        logger.warn('Waiting for machine to shutdown')
+        run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
+        wait_for_state(vmname, vboxmanage.STOPPED)
+    logger.debug('Successfully shut down')
 
     # Disable uart before exporting
     logger.debug('Remove serial uarts before exporting')
-    run(['VBoxManage', 'modifyvm', vmname, '--uart1', 'off'])
-    run(['VBoxManage', 'modifyvm', vmname, '--uart2', 'off'])
+    uarts_off = vboxmanage.VMSpec(vmname).modify('--uart1', 'off').modify(
+        '--uart2', 'off')
+    if ssh_port:
+        # vagrant sets up its own port forwards
+        uarts_off.modify('--natpf1', 'delete', 'build-ssh')
+    uarts_off.apply(run, current=None)
 
     # Shrink the VM
+    build_trace.phase('compact')
     logger.warn('Compact VDI')
     run(['VBoxManage', 'modifymedium', '--compact', vdi])
 
+    build_trace.phase('package')
     logger.warn('Building Vagrant box')
 
-    # Add the embedded Vagrantfile
-    if image_version_num >= 16.7:
-        vagrantfile_pathname = os.path.join(
-            pathname, 'include', 'embedded_vagrantfile_xe_virtio')
+    # SHA-256 of the artifacts hashed while they were written
+    checksums = {}
+    if args.vagrant_package:
+        run(['vagrant', 'package', '--base', vmname, '--vagrantfile',
+             vagrantfile_pathname, '--output', box_out] +
+            (['--include', ','.join(include)] if include else []))
+        logger.warn('Created: %s', box_out)
+
+        # Create OVA
+        if args.create_ova is True:
+            logger.warn('Creating OVA %s', ova_out)
+            run(['VBoxManage', 'export', vmname, '--output', ova_out])
+            logger.debug('Created OVA %s', ova_out)
+        if args.qcow2:
+            box_packer.write_qcow2(vdi, qcow2_out)
     else:
-        vagrantfile_pathname = os.path.join(
-            pathname, 'include', 'embedded_vagrantfile_xe')
-
-    run(['vagrant', 'package', '--base', vmname, '--vagrantfile',
-         vagrantfile_pathname, '--output', box_out])
-    logger.warn('Created: %s', box_out)
-
-    # Create OVA
+        # One export of the VM for the box, the OVA and the qcow2 image
+        try:
+            stats = box_packer.package(vmname, box_out, run, vagrantfile_pathname,
+                                       args.compression, sparse=not args.full_disk,
+                                       ova=ova_out if args.create_ova else None,
+                                       qcow2=qcow2_out if args.qcow2 else None,
+                                       include=include)
+        except box_packer.PackError as e:
+            sys.exit(str(e))
+        checksums['box'] = stats['sha256']
+        if args.create_ova is True:
+            checksums['ova'] = stats['ova_sha256']
+        logger.warn('Created: %s', box_out)
     if args.create_ova is True:
-        logger.warn('Creating OVA %s', ova_out)
-        run(['VBoxManage', 'export', vmname, '--output', ova_out])
-        logger.debug('Created OVA %s', ova_out)
+        logger.warn('Created: %s', ova_out)
+    if args.qcow2:
+        logger.warn('Created: %s', qcow2_out)
 
     # Clean up VM used to generate box
+    build_trace.phase('cleanup')
     cleanup_vmname(vmname, vbox)
+    saved_state.remove(box_dir)
+    if install_iso != input_iso:
+        os.remove(install_iso)
 
-    logger.warn('Add box to system:')
-    logger.warn('  vagrant box add --name iosxe/{version} {boxout} --force'.format(version=image_version, boxout=box_out))
-    logger.warn('Initialize environment:')
-    logger.warn('  vagrant init iosxe/{version}'.format(version=image_version))
-    logger.warn('Bring up box:')
-    logger.warn('  vagrant up')
-
-    logger.warn('Note:')
-    logger.warn(
-        '  Both the XE SSH and NETCONF/RESTCONF username and password is vagrant/vagrant')
+    # Remember which build key produced the box
+    build_trace.phase('record')
+    built = {'box': box_out}
+    if args.create_ova is True:
+        built['ova'] = ova_out
+    if args.qcow2:
+        built['qcow2'] = qcow2_out
+    entry = manifest.record(build_key, built, inputs={
+        'iso': os.path.basename(input_iso), 'iso_sha256': iso_sha,
+        'serial': args.serial, 'saved_state': args.saved_state,
+        'vagrantfile': os.path.basename(vagrantfile_pathname),
+        'version': __version__}, checksums=checksums)
+
+    catalog = box_catalog.add_box(catalog_dir, 'iosxe', image_version, box_out,
+                                  entry['artifacts']['box']['sha256'])
+    if not args.no_history:
+        build_history.record_build(args.history, 'iosxe', image_version, built,
+                                   version, options={
+                                       'serial': args.serial, 'bulk': args.bulk,
+                                       'split': args.split,
+                                       'cached_disk': bool(cached_disk),
+                                       'compression': args.compression,
+                                       'saved_state': args.saved_state,
+                                       'vagrant_package': args.vagrant_package})
+    show_next_steps(image_version, box_out, catalog)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+'''
+Acquire device images (ISOs) for the box building scripts.
+
+Remote images are streamed into a local image cache.  The SHA-256 is
+computed while the bytes arrive, an interrupted transfer resumes where it
+stopped, and every image is kept once per host: by source, so the same
+image isn't fetched again, and by hash, so the same image from another
+source is stored only once.
+
+Sources:
+    image.iso, /path/image.iso            local file, used in place
+    http://host/image.iso, https://...    HTTP(S), resumed with Range requests
+    [user@]host:/path/image.iso           SSH (the scp syntax), resumed with tail -c
+    scp://[user@]host/path/image.iso      same
+    sftp://[user@]host/path/image.iso     same
+
+The cache is a folder with index.json (source -> hash), <sha256>/<name> per
+image and partial/ for interrupted transfers.
+
+Acquisition runs in a thread, so the builder can define the VM while the
+image is still downloading.
+
+E.g.:
+    python iso_fetch.py list
+    python iso_fetch.py fetch user@server:/myboxes/csr1000v-universalk9.16.07.01.iso
+'''
+
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import time
+import getpass
+import hashlib
+import logging
+import argparse
+import threading
+import subprocess
+import textwrap
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlparse
+    from shlex import quote
+except ImportError:
+    from urllib2 import Request, urlopen
+    from urlparse import urlparse
+    from pipes import quote
+
+import build_trace
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMAGE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'vagrant_net_prog', 'images')
+
+CHUNK_SIZE = 1024 * 1024
+
+# Log progress every this many bytes
+PROGRESS_STEP = 100 * 1024 * 1024
+
+
+class FetchError(Exception):
+    pass
+
+
+def parse_source(uri):
+    """
+    Return (kind, location) for an image source.
+
+    kind is 'local', 'http' or 'ssh'.  location is the path for local
+    files, the URL for HTTP(S) and (user@host, port, path) for SSH, port
+    being None for the default one.
+    """
+
+    if re.match(r'https?://', uri):
+        return 'http', uri
+    if re.match(r'(scp|sftp)://', uri):
+        parsed = urlparse(uri)
+        return 'ssh', ('%s@%s' % (parsed.username or getpass.getuser(),
+                                  parsed.hostname), parsed.port, parsed.path)
+    if re.search(':/', uri):
+        host, path = uri.split(':', 1)
+        if '@' not in host:
+            host = '%s@%s' % (getpass.getuser(), host)
+        return 'ssh', (host, None, path)
+    return 'local', uri
+
+
+def image_name(uri):
+    """
+    Return the file name of the image, e.g. csr1000v-universalk9.16.07.01.iso.
+    """
+
+    kind, location = parse_source(uri)
+    if kind == 'http':
+        return os.path.basename(urlparse(location).path)
+    if kind == 'ssh':
+        return os.path.basename(location[2])
+    return os.path.basename(location)
+
+
+def hash_file(path, digest=None):
+    """
+    Feed the file into digest (a new SHA-256 by default) and return it.
+    """
+
+    if digest is None:
+        digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def _open_http(url, offset):
+    """
+    Return (stream, offset, total) for url from offset on.
+
+    offset is 0 if the server ignored the range request.  total is None
+    if the server didn't send a length.
+    """
+
+    request = Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+    response = urlopen(request, timeout=60)
+    status = response.getcode()
+    if offset and status != 206:
+        logger.info('Server ignored the range request, starting over')
+        offset = 0
+    total = None
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        total = int(total) if total.isdigit() else None
+    elif response.headers.get('Content-Length'):
+        total = offset + int(response.headers.get('Content-Length'))
+    return response, offset, total
+
+
+def _open_ssh(host, port, path, offset):
+    """
+    Return the ssh process streaming path from offset on.
+
+    tail -c +N starts at byte N, counting from 1.
+    """
+
+    cmd = ['ssh', host]
+    if port:
+        cmd += ['-p', str(port)]
+    cmd.append('tail -c +%d %s' % (offset + 1, quote(path)))
+    logger.debug('%s', ' '.join(cmd))
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+
+def _copy(stream, out, digest, done, total):
+    """
+    Copy stream into out, updating digest, return the bytes written.
+    """
+
+    logged = done
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        out.write(chunk)
+        digest.update(chunk)
+        done += len(chunk)
+        if done - logged >= PROGRESS_STEP:
+            logged = done
+            logger.info('Fetched %d MB%s', done // 1024 ** 2,
+                        ' of %d MB' % (total // 1024 ** 2) if total else '')
+    return done
+
+
+class ImageCache(object):
+    """
+    Folder of fetched images, indexed by source and by hash.
+    """
+
+    def __init__(self, root=DEFAULT_IMAGE_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock = threading.Lock()
+        partial = os.path.join(root, 'partial')
+        if not os.path.exists(partial):
+            os.makedirs(partial)
+
+    def index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _add(self, uri, sha, path):
+        with self.lock:
+            index = self.index()
+            index[uri] = {'sha256': sha, 'path': path,
+                          'size': os.path.getsize(path), 'fetched': time.time()}
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.index_path)
+
+    def lookup(self, uri):
+        """
+        Return (path, sha256) of the image fetched from uri, or None.
+        """
+
+        entry = self.index().get(uri)
+        if entry is None or not os.path.exists(entry['path']) or \
+                os.path.getsize(entry['path']) != entry['size']:
+            return None
+        return entry['path'], entry['sha256']
+
+    def partial(self, uri):
+        name = hashlib.sha256(uri.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.root, 'partial', name + '.part')
+
+    def fetch(self, uri, expected_sha256=None):
+        """
+        Return (path, sha256) of the image, fetching it if needed.
+
+        Local files are used in place, only hashed.
+        """
+
+        kind, location = parse_source(uri)
+        if kind == 'local':
+            if not os.path.exists(location):
+                raise FetchError('%s does not exist' % location)
+            sha = hash_file(location).hexdigest()
+            self._check(uri, sha, expected_sha256)
+            return location, sha
+
+        cached = self.lookup(uri)
+        if cached:
+            logger.info('%s is in the image cache', uri)
+            self._check(uri, cached[1], expected_sha256)
+            return cached
+
+        part = self.partial(uri)
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part):
+            # resume: the hash has to cover what is already there
+            hash_file(part, digest)
+            offset = os.path.getsize(part)
+            logger.info('Resuming %s at %d MB', uri, offset // 1024 ** 2)
+
+        if kind == 'http':
+            stream, start, total = _open_http(location, offset)
+            if start != offset:
+                digest = hashlib.sha256()
+                offset = start
+            with open(part, 'r+b' if offset else 'wb') as out:
+                out.seek(offset)
+                out.truncate()
+                done = _copy(stream, out, digest, offset, total)
+            stream.close()
+            if total is not None and done != total:
+                raise FetchError('%s: got %d of %d bytes, run again to resume'
+                                 % (uri, done, total))
+        else:
+            proc = _open_ssh(location[0], location[1], location[2], offset)
+            with open(part, 'ab') as out:
+                _copy(proc.stdout, out, digest, offset, None)
+            if proc.wait() != 0:
+                raise FetchError('%s: ssh exited with %d, run again to resume'
+                                 % (uri, proc.returncode))
+
+        sha = digest.hexdigest()
+        try:
+            self._check(uri, sha, expected_sha256)
+        except FetchError:
+            os.remove(part)
+            raise
+
+        target_dir = os.path.join(self.root, sha)
+        target = os.path.join(target_dir, image_name(uri))
+        if os.path.exists(target):
+            # same image from another source
+            logger.info('%s is already in the image cache', image_name(uri))
+            os.remove(part)
+        else:
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+            os.rename(part, target)
+        self._add(uri, sha, target)
+        return target, sha
+
+    def _check(self, uri, sha, expected_sha256):
+        if expected_sha256 and sha != expected_sha256.lower():
+            raise FetchError('%s: SHA-256 is %s, expected %s'
+                             % (uri, sha, expected_sha256))
+
+
+class Acquisition(threading.Thread):
+    """
+    Fetch an image in the background.
+    """
+
+    def __init__(self, uri, cache, expected_sha256=None):
+        threading.Thread.__init__(self, name='fetch %s' % image_name(uri))
+        self.daemon = True
+        self.uri = uri
+        self.cache = cache
+        self.expected_sha256 = expected_sha256
+        self.path = None
+        self.sha256 = None
+        self.error = None
+
+    def run(self):
+        try:
+            with build_trace.span('fetch', 'fetch', uri=self.uri):
+                self.path, self.sha256 = self.cache.fetch(self.uri, self.expected_sha256)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        """
+        Wait for the image, return (path, sha256).  Raises FetchError.
+        """
+
+        self.join()
+        if self.error is not None:
+            if isinstance(self.error, FetchError):
+                raise self.error
+            raise FetchError('%s: %s' % (self.uri, self.error))
+        return self.path, self.sha256
+
+
+def acquire(uri, cache_dir=DEFAULT_IMAGE_DIR, expected_sha256=None):
+    """
+    Start fetching uri in the background, return the Acquisition.
+    """
+
+    acquisition = Acquisition(uri, ImageCache(cache_dir), expected_sha256)
+    acquisition.start()
+    return acquisition
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Fetch device images into the image cache and list them.
+        '''))
+    parser.add_argument('-d', '--cache-dir', default=DEFAULT_IMAGE_DIR,
+                        help='cache folder (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    fetch = commands.add_parser('fetch', help='fetch an image into the cache')
+    fetch.add_argument('URI', help='image source, see the module description')
+    fetch.add_argument('--sha256', help='expected SHA-256 of the image')
+    commands.add_parser('list', help='show the fetched images')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+    cache = ImageCache(args.cache_dir)
+
+    if args.command == 'fetch':
+        try:
+            path, sha = cache.fetch(args.URI, args.sha256)
+        except FetchError as e:
+            sys.exit(str(e))
+        print('%s  %s' % (sha, path))
+    elif args.command == 'list':
+        for uri, entry in sorted(cache.index().items()):
+            print('%s  %6d MB  %s' % (entry['sha256'][:12],
+                                     entry['size'] // 1024 ** 2, uri))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
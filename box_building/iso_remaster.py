@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+'''
+Remaster an IOS XE ISO to boot to the serial console, without root.
+
+The 16.6 and 16.7 CSR 1000v ISOs boot to VGA by default.  csr_iso_modify.sh
+loop mounts the ISO with sudo, copies every file, flips the GRUB default in
+boot/grub/menu.lst and builds a whole new image with mkisofs.
+
+The change doesn't alter the length of menu.lst, so the image layout stays
+the same: this module finds the file by reading the ISO9660 directory
+records, clones the ISO (a copy-on-write reflink where the file system
+supports it, otherwise a plain copy) and rewrites only the sectors that
+changed.
+
+E.g.:
+    python iso_remaster.py csr1000v-universalk9.16.07.01.iso
+    (creates serial-csr1000v-universalk9.16.07.01.iso)
+'''
+
+from __future__ import print_function
+import sys
+import os
+import re
+import struct
+import shutil
+import logging
+import argparse
+import subprocess
+import textwrap
+
+logger = logging.getLogger(__name__)
+
+SECTOR = 2048
+
+# First volume descriptor, after the 16 sectors of system area
+VOLUME_DESCRIPTORS = 16
+
+GRUB_MENU = '/boot/grub/menu.lst'
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class IsoError(Exception):
+    pass
+
+
+def _record(data, pos):
+    """
+    Parse the directory record at pos, return (name, lba, size, is_dir).
+    """
+
+    lba, = struct.unpack_from('<I', data, pos + 2)
+    size, = struct.unpack_from('<I', data, pos + 10)
+    flags = data[pos + 25:pos + 26]
+    name_len = ord(data[pos + 32:pos + 33])
+    name = data[pos + 33:pos + 33 + name_len]
+    return name, lba, size, bool(ord(flags) & 2)
+
+
+def _normalize(name):
+    """
+    MENU.LST;1 -> menu.lst, the ISO9660 form of a name as written by mkisofs.
+    """
+
+    if isinstance(name, bytes):
+        name = name.decode('ascii', 'replace')
+    return name.split(';')[0].rstrip('.').lower()
+
+
+def root_record(f):
+    """
+    Return (lba, size) of the root directory from the primary volume
+    descriptor.
+    """
+
+    sector = VOLUME_DESCRIPTORS
+    while True:
+        f.seek(sector * SECTOR)
+        descriptor = f.read(SECTOR)
+        if len(descriptor) < SECTOR or descriptor[1:6] != b'CD001':
+            raise IsoError('not an ISO9660 image')
+        kind = ord(descriptor[0:1])
+        if kind == 1:
+            _, lba, size, _ = _record(descriptor, 156)
+            return lba, size
+        if kind == 255:
+            raise IsoError('no primary volume descriptor')
+        sector += 1
+
+
+def directory(f, lba, size):
+    """
+    Yield (name, lba, size, is_dir) for the entries of a directory.
+    """
+
+    f.seek(lba * SECTOR)
+    data = f.read(size)
+    pos = 0
+    while pos < len(data):
+        length = ord(data[pos:pos + 1])
+        if length == 0:
+            # records don't span sectors, the rest of this one is padding
+            pos = (pos // SECTOR + 1) * SECTOR
+            continue
+        name, entry_lba, entry_size, is_dir = _record(data, pos)
+        if name not in (b'\x00', b'\x01'):
+            yield name, entry_lba, entry_size, is_dir
+        pos += length
+
+
+def find(f, path):
+    """
+    Return (lba, size) of the file at path, e.g. /boot/grub/menu.lst.
+    """
+
+    lba, size = root_record(f)
+    for part in [p for p in path.split('/') if p]:
+        for name, entry_lba, entry_size, _ in directory(f, lba, size):
+            if _normalize(name) == part.lower():
+                lba, size = entry_lba, entry_size
+                break
+        else:
+            raise IsoError('%s not found in the image' % path)
+    return lba, size
+
+
+def serial_console_default(menu):
+    """
+    The edit of csr_iso_modify.sh (sed '/^default/s/0/1/'): boot the second
+    GRUB entry, the serial console, by default.
+    """
+
+    return re.sub(br'(?m)^(default[^\n0]*)0', br'\g<1>1', menu, count=1)
+
+
+def clone(source, target):
+    """
+    Copy source to target, sharing the data blocks if the file system
+    supports it.  Returns how: 'reflink', 'clonefile' or 'copy'.
+    """
+
+    if os.path.exists(target):
+        os.remove(target)
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(source, 'rb') as src:
+            with open(target, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return 'reflink'
+                except (IOError, OSError):
+                    pass
+    elif sys.platform == 'darwin':
+        # APFS clones with cp -c
+        if subprocess.call(['cp', '-c', source, target],
+                           stderr=open(os.devnull, 'w')) == 0:
+            return 'clonefile'
+    shutil.copyfile(source, target)
+    return 'copy'
+
+
+def remaster(iso, output, path=GRUB_MENU, edit=serial_console_default):
+    """
+    Write a copy of iso to output with the file at path changed by edit.
+
+    edit takes and returns the file content and must not change its
+    length.  Returns stats: how the ISO was cloned, the sectors rewritten
+    and whether the file changed at all.
+    """
+
+    with open(iso, 'rb') as f:
+        lba, size = find(f, path)
+        f.seek(lba * SECTOR)
+        content = f.read(size)
+
+    patched = edit(content)
+    if len(patched) != len(content):
+        raise IsoError('%s would change its length, the image would have to be rebuilt'
+                       % path)
+
+    method = clone(iso, output)
+    stats = {'clone': method, 'sectors': 0, 'changed': patched != content}
+    with open(output, 'r+b') as out:
+        for first in range(0, size, SECTOR):
+            old = content[first:first + SECTOR]
+            new = patched[first:first + SECTOR]
+            if old != new:
+                out.seek(lba * SECTOR + first)
+                out.write(new)
+                stats['sectors'] += 1
+    logger.info('Remastered %s: %s, %d sector(s) rewritten', output, method,
+                stats['sectors'])
+    return stats
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Make an IOS XE ISO boot to the serial console by default.
+        '''))
+    parser.add_argument('ISO_FILE', help='ISO image to remaster')
+    parser.add_argument('-o', '--output',
+                        help='remastered ISO (default: serial-<ISO_FILE> in the current folder)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+    output = args.output or 'serial-' + os.path.basename(args.ISO_FILE)
+    try:
+        stats = remaster(args.ISO_FILE, output)
+    except (IsoError, IOError, OSError) as e:
+        sys.exit(str(e))
+    if not stats['changed']:
+        logger.warn('%s already boots to the serial console', args.ISO_FILE)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
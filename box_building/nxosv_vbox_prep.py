@@ -54,7 +54,8 @@ Vagrantfiles for more advanced multi-node topologies.
   . Starts the VM, then uses pexpect to configure NX-OS for
     basic networking, with user name vagrant/vagrant and SSH key
   . Enables NX-API
-  . Closes the VM down, once configured.
+  . Closes the VM down, once configured (or saves its state with
+    --saved-state, see saved_state.py).
 
 The resultant box image, will come up fully networked and ready for use
 with NX-API.  Other programmability features of NX-OS can be enabled
@@ -73,23 +74,143 @@ import subprocess
 import getpass
 import argparse
 import re
+import json
+import base64
+import socket
 import logging
 from logging import StreamHandler
 import textwrap
+import atexit
+import shutil
+import tempfile
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError
+except ImportError:
+    from urllib2 import Request, urlopen, URLError
 
 try:
     import pexpect
 except ImportError:
     sys.exit('The "pexpect" Python module is not installed. Please install it using pip or OS packaging.')
 
+import vboxmanage
+import box_packer
+import box_catalog
+import saved_state
+import console_dialog
+import console_transport
+import console_log
+import build_trace
+import build_history
+from console_dialog import Step
+
 # The background is set with 40 plus the number of the color,
 # and the foreground with 30.
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 
-# Telnet ports used to access IOS XE via socat
+# Telnet ports used to access IOS XE (see console_transport.py)
 CONSOLE_PORT = 65000
 CONSOLE_SOCKET = "/tmp/test"
 
+# Long time for full configuration, waiting for ip address etc
+CONSOLE_TIMEOUT = 600
+
+# Console prompt of any hostname and configuration mode
+NX_PROMPT = r'[\w-]+(\([\w-]+\))?[#>]'
+
+# POAP starts once NX-OS is up, the first boot dialog follows
+NX_BOOT_MARKER = r'%POAP-2-POAP_DHCP_DISCOVER_START:'
+
+# First boot dialog of NX-OS, up to the first exec prompt
+NX_SETUP_DIALOG = [
+    # Abort POAP, the question went by while POAP started up
+    Step('abort POAP', send='y'),
+    # Disable Secure Password Enforcement
+    Step('secure password', r'enforce secure password standard', send='n'),
+    # Set admin password
+    Step('admin password', r'Enter the password for', send='admin'),
+    Step('confirm password', r'Confirm the password', send='admin'),
+    # Disable Basic System Configuration
+    Step('basic config dialog',
+         r'Would you like to enter the basic configuration dialog',
+         send='no', nudge=5),
+    # Login as admin
+    Step('login', r'login:', send='admin', nudge=5),
+    Step('password', r'Password:', send='admin'),
+    Step('exec prompt', NX_PROMPT),
+]
+
+# "  NXOS image file is: bootflash:///nxos.7.0.3.I7.1.bin" of show version
+# ("system image file is:" on older releases)
+NX_IMAGE_FILE = re.compile(r'image file is:\s*bootflash:/*([^\s/]+\.bin)\s*$',
+                           re.IGNORECASE | re.MULTILINE)
+
+# "  753387008    Sep 07 14:40:04 2017  nxos.7.0.3.I7.1.bin" of dir bootflash:
+NX_BOOTFLASH_IMAGE = re.compile(r'^\s*\d+\s+\w{3}\s+\d+\s+[\d:]+\s+\d{4}\s+([^\s/]+\.bin)\s*$',
+                                re.MULTILINE)
+
+# Enable Guest Shell - needed because running with 4G Ram and not auto-installed
+# Used to set boot variable correctly when show version and dir bootflash:
+# don't tell the image
+NX_GUESTSHELL_ENABLE_DIALOG = [
+    Step('guestshell enable', send='guestshell enable'),
+    # wait for indication that guestshell is ready
+    Step('guestshell activated',
+         r"%VMAN-2-ACTIVATION_STATE: Successfully activated virtual service 'guestshell",
+         send='', timeout=CONSOLE_TIMEOUT, window=console_dialog.MARKER_WINDOW),
+    Step('guestshell prompt', NX_PROMPT),
+]
+
+# Disable Guest Shell to save resources in base box
+NX_GUESTSHELL_DESTROY_DIALOG = [
+    Step('guestshell destroy', send='guestshell destroy'),
+    Step('confirm destroy', r'\(y/n\)', send='y'),
+    # wait for indication that guestshell is destroyed
+    Step('guestshell destroyed',
+         r"%VMAN-2-INSTALL_STATE: Successfully destroyed virtual service 'guestshell",
+         send='', timeout=CONSOLE_TIMEOUT, window=console_dialog.MARKER_WINDOW),
+    Step('destroy prompt', NX_PROMPT),
+]
+
+NX_SAVE_DIALOG = [
+    Step('save', send='copy run start'),
+    Step('saved', r'Copy complete'),
+    Step('save prompt', NX_PROMPT),
+]
+
+# Baseline configuration of the box: management over DHCP, vagrant user with
+# the insecure vagrant SSH key and NX-API
+NX_BASELINE_CONFIG = [
+    "hostname n9kv1",
+    "interface mgmt 0",
+    "ip address dhcp ",
+    "no shut",
+    "exit",
+    "username vagrant password vagrant role network-admin",
+    "username vagrant sshkey ssh-rsa AAAAB3NzaC1yc2EAAAABIwAAAQEA6NF8iallvQVp22WDkTkyrtvp9eWW6A8YVr+kz4TjGYe7gHzIw+niNltGEFHzD8+v1I2YJ6oXevct1YeS0o9HZyN1Q9qgCgzUFtdOKLv6IedplqoPkcmF0aYet2PkEDo3MlTBckFXPITAMzF8dJSIFo9D8HfdOV0IAdx4O7PtixWKn5y2hMNG0zQPyUecp4pzC6kivAIhyfHilFR61RGL+GPXQ2MWZWFYbAGjyiYJnAmCP3NOTd0jMZEnDkbUvxhMmBYSdETk1rRgm+R4LOzFUGaHqHDLKLX+FIPKcF96hrucXzcWyLbIbEgE98OHlnVYCzRdK8jlqm8tehUc9c9WhQ== vagrant insecure public key",
+    # Enable Features
+    "feature nxapi",
+]
+
+# With --split only the minimum needed to reach NX-API goes over the serial
+# console ...
+NX_BOOTSTRAP_CONFIG = [
+    "interface mgmt 0",
+    "ip address dhcp ",
+    "no shut",
+    "exit",
+    "username vagrant password vagrant role network-admin",
+    "feature nxapi",
+]
+
+# ... and the rest is sent in one NX-API request.
+NX_REMOTE_CONFIG = [
+    "hostname n9kv1",
+    "username vagrant sshkey ssh-rsa AAAAB3NzaC1yc2EAAAABIwAAAQEA6NF8iallvQVp22WDkTkyrtvp9eWW6A8YVr+kz4TjGYe7gHzIw+niNltGEFHzD8+v1I2YJ6oXevct1YeS0o9HZyN1Q9qgCgzUFtdOKLv6IedplqoPkcmF0aYet2PkEDo3MlTBckFXPITAMzF8dJSIFo9D8HfdOV0IAdx4O7PtixWKn5y2hMNG0zQPyUecp4pzC6kivAIhyfHilFR61RGL+GPXQ2MWZWFYbAGjyiYJnAmCP3NOTd0jMZEnDkbUvxhMmBYSdETk1rRgm+R4LOzFUGaHqHDLKLX+FIPKcF96hrucXzcWyLbIbEgE98OHlnVYCzRdK8jlqm8tehUc9c9WhQ== vagrant insecure public key",
+]
+
 logger = logging.getLogger(__name__)
 
 
@@ -166,10 +287,11 @@ def run(cmd, hide_error=False, cont_on_error=False):
     s_cmd = ' '.join(cmd)
     logger.info("'%s'", s_cmd)
 
-    output = subprocess.Popen(cmd,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-    tup_output = output.communicate()
+    with build_trace.span(' '.join(cmd[:2]), 'run', cmd=s_cmd):
+        output = subprocess.Popen(cmd,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        tup_output = output.communicate()
 
     if output.returncode != 0:
         logger.error('Failed (%d):', output.returncode)
@@ -189,10 +311,21 @@ def run(cmd, hide_error=False, cont_on_error=False):
     return tup_output[0]
 
 
-def pause_to_debug():
+def wait_for_state(name, states, timeout=120):
+    """
+    Wait for the VM to reach one of states, quit if it doesn't.
+    """
+
+    try:
+        return vboxmanage.wait_for_state(name, states, run, timeout=timeout)
+    except vboxmanage.StateTimeout as e:
+        sys.exit(str(e))
+
+
+def pause_to_debug(console_socket=CONSOLE_SOCKET):
     logger.critical("Pause before debug")
     logger.critical(
-        "Use: 'socat unix-connect:/tmp/test stdin' to access the VM")
+        "Use: 'python console_transport.py unix:%s' to access the VM", console_socket)
     raw_input("Press Enter to continue.")
     # To debug post box creation, add the following line to Vagrantfile
     # config.vm.provider "virtualbox" do |v|
@@ -208,16 +341,62 @@ def cleanup_box():
     run(["vagrant", "destroy", "-f"], cont_on_error=True)
 
 
-def configure_nx(verbose=False, wait=True):
+def boot_image_name(listing):
+    """
+    Return the NX-OS image named in a listing of /bootflash, quit if there
+    is none.
+    """
+
+    if isinstance(listing, bytes):
+        listing = listing.decode('utf-8', 'replace')
+    match = re.search(r'nxos[\w.-]*\.bin', listing)
+    if match is None:
+        sys.exit('No NX-OS image in /bootflash: %s' % listing.strip())
+    return match.group(0)
+
+
+def boot_image_from_cli(version, listing):
+    """
+    Return the NX-OS image to boot, from the output of "show version" and
+    "dir bootflash:", or None if they don't name one for sure.
+
+    The running image counts if it is on the bootflash (or the listing has
+    no images in a format we know), otherwise the only image on the
+    bootflash.
+    """
+
+    if isinstance(version, bytes):
+        version = version.decode('utf-8', 'replace')
+    if isinstance(listing, bytes):
+        listing = listing.decode('utf-8', 'replace')
+    images = NX_BOOTFLASH_IMAGE.findall(listing)
+    running = NX_IMAGE_FILE.search(version)
+    if running is not None and (not images or running.group(1) in images):
+        return running.group(1)
+    if running is None and len(images) == 1:
+        return images[0]
+    return None
+
+
+def configure_nx(verbose=False, wait=True, nxapi_port=None,
+                 console_socket=CONSOLE_SOCKET, logfile="console.log", console=None):
     """
     Bring up NX-OS and do some initial config.
-    Using socat to do the connection as telnet has an
-    odd double return on vbox
+    Connecting straight to the uart socket (console_transport.py) as
+    telnet has an odd double return on vbox
+
+    With nxapi_port only NX_BOOTSTRAP_CONFIG and the boot image go over the
+    console, the rest is sent to NX-API through that forwarded port.
+
+    In verbose mode the console transcript is compressed to logfile.gz
+    (see console_log.py).
+
+    console is a pexpect child already connected to the console, e.g. to
+    the simulator of console_sim.py, used instead of connecting to console_socket.
     """
     logger.warn('Waiting for NX-OS to boot (may take 3 minutes or so)')
-    localhost = 'localhost'
 
-    PROMPT = r'[\w-]+(\([\w-]+\))?[#>]'
+    PROMPT = NX_PROMPT
     # don't want to rely on specific hostname
     # PROMPT = r'(Router|csr1kv).*[#>]'
     CRLF = "\r\n"
@@ -237,132 +416,144 @@ def configure_nx(verbose=False, wait=True):
             child.expect(PROMPT)
 
 
+    dialog = console_dialog.Dialog('NX-OS')
+    transcript = None
+
     try:
-        #child = pexpect.spawn("socat TCP:%s:%s -,raw,echo=0,escape=0x1d" % (localhost, CONSOLE_PORT))
-        child = pexpect.spawn("socat unix-connect:%s stdin" % (CONSOLE_SOCKET))
+        child = console or console_transport.ConsoleSpawn('unix:%s' % console_socket)
 
         if verbose:
-            child.logfile = open("tmp.log", "w")
+            child.logfile = transcript = console_log.ConsoleLog(logfile)
 
         # Long time for full configuration, waiting for ip address etc
-        child.timeout = 600
+        child.timeout = CONSOLE_TIMEOUT
 
         # wait for indication that boot has gone through
         if (wait):
-            child.expect(r'%POAP-2-POAP_DHCP_DISCOVER_START:', child.timeout)
+            dialog.run(child, [Step('boot', NX_BOOT_MARKER, timeout=child.timeout,
+                                    window=console_dialog.MARKER_WINDOW)])
             logger.warn(
                 'Logging into Vagrant Virtualbox and configuring NX-OS')
 
-        # Abort POAP
-        logger.warn("Aborting POAP")
-        send_cmd("y", expect_prompt=False)
-        time.sleep(1)
-
-        # Disable Secure Password Enforcement
-        logger.warn("Disable Secure Password")
-        send_cmd("n", expect_prompt=False)
-        time.sleep(1)
-
-        # Set admin password
-        logger.warn("Setting Admin Password")
-        if (wait):
-            child.expect(r'Enter the password for', child.timeout)
-        send_cmd("admin", expect_prompt=False)
-        time.sleep(2)
-        if (wait):
-            child.expect(r'Confirm the password', child.timeout)
-        logger.warn("Confirming Admin Password")
-        send_cmd("admin", expect_prompt=False)
-        time.sleep(3)
-        send_line()
-        time.sleep(2)
-        send_line()
-        time.sleep(1)
-
-        # wait for indication next step is ready
-        if (wait):
-            child.expect(r'Would you like to enter the basic configuration dialog', child.timeout)
-        # Disable Basic System Configuration
-        logger.warn("Disable Basic Sys Config")
-        send_cmd("no", expect_prompt=False)
-        # time.sleep(10)
-
-        # wait for indication next step is ready
-        if (wait):
-            child.expect(r'User Access Verification', child.timeout)
-
-        # Login as admin
-        logger.warn("Logging in as admin")
-        send_cmd("admin", expect_prompt=False)
-        time.sleep(1)
-        send_cmd("admin", expect_prompt=False)
-        time.sleep(1)
+        logger.warn("Completing initial setup dialog")
+        dialog.run(child, NX_SETUP_DIALOG)
         send_cmd("term width 300")
+        send_cmd("terminal length 0")
 
         # enable plus config mode
         logger.warn("Deploying Baseline configuration.")
-        send_cmd("enable")
-        send_cmd("conf t")
-
-        # Perform basic Vagrant Configuration
-        send_cmd("hostname n9kv1")
-        send_cmd("interface mgmt 0")
-        send_cmd("ip address dhcp ")
-        send_cmd("no shut")
-        send_cmd("exit")
-        send_cmd("username vagrant password vagrant role network-admin")
-        send_cmd("username vagrant sshkey ssh-rsa AAAAB3NzaC1yc2EAAAABIwAAAQEA6NF8iallvQVp22WDkTkyrtvp9eWW6A8YVr+kz4TjGYe7gHzIw+niNltGEFHzD8+v1I2YJ6oXevct1YeS0o9HZyN1Q9qgCgzUFtdOKLv6IedplqoPkcmF0aYet2PkEDo3MlTBckFXPITAMzF8dJSIFo9D8HfdOV0IAdx4O7PtixWKn5y2hMNG0zQPyUecp4pzC6kivAIhyfHilFR61RGL+GPXQ2MWZWFYbAGjyiYJnAmCP3NOTd0jMZEnDkbUvxhMmBYSdETk1rRgm+R4LOzFUGaHqHDLKLX+FIPKcF96hrucXzcWyLbIbEgE98OHlnVYCzRdK8jlqm8tehUc9c9WhQ== vagrant insecure public key")
-
-        # Enable Features
-        send_cmd("feature nxapi")
-
-        # Enable Guest Shell - needed because running with 4G Ram and not auto-installed
-        # Used to set boot variable correctly
-        send_cmd("guestshell enable")
-        time.sleep(1)
-        # wait for indication that guestshell is ready
-        if (wait):
-            child.expect(r"%VMAN-2-ACTIVATION_STATE: Successfully activated virtual service 'guestshell", child.timeout)
-            logger.info('Guest Shell Enabled')
-        time.sleep(5)
+        with dialog.timed('console config'):
+            send_cmd("enable")
+            send_cmd("conf t")
+            for line in NX_BOOTSTRAP_CONFIG if nxapi_port else NX_BASELINE_CONFIG:
+                send_cmd(line)
 
         # Set Boot Variable
         logger.warn("Setting boot image")
-        send_cmd("guestshell run ls /bootflash/nxos*")
-        boot_image = child.before.split("/")[4].strip()
-        send_cmd("boot nxos bootflash:/{}".format(boot_image))
-
-
-        # Disable Guest Shell to save resources in base box
-        send_cmd("guestshell destroy", expect_prompt=False)
-        time.sleep(1)
-        send_cmd("y")
-        time.sleep(1)
-        # wait for indication that guestshell is destroyed
-        if (wait):
-            child.expect(r"%VMAN-2-INSTALL_STATE: Successfully destroyed virtual service 'guestshell", child.timeout)
+        with dialog.timed('boot image: show version'):
+            send_cmd("show version")
+            version = child.before
+            send_cmd("dir bootflash:")
+            boot_image = boot_image_from_cli(version, child.before)
+
+        if boot_image is None:
+            logger.warn("Boot image not found with show version and dir, using the Guest Shell")
+            dialog.run(child, NX_GUESTSHELL_ENABLE_DIALOG)
+            logger.info('Guest Shell Enabled')
+            with dialog.timed('boot image: guestshell'):
+                send_cmd("guestshell run ls /bootflash/nxos*")
+                boot_image = boot_image_name(child.before)
+            dialog.run(child, NX_GUESTSHELL_DESTROY_DIALOG)
             logger.info('Guest Shell Destroyed')
 
+        logger.info('Boot image: %s', boot_image)
+        send_cmd("boot nxos bootflash:/{}".format(boot_image))
 
         # done and save
         logger.warn("Finishing Config and Saving to Startup-Config")
         send_cmd("end")
-        send_cmd(["copy run start", CRLF])
-
-        # just to be sure
-        logger.warn('Waiting 10 seconds...')
-        time.sleep(10)
-
+        if nxapi_port:
+            logger.warn("Configuring NX-OS over NX-API")
+            with dialog.timed('nxapi config'):
+                nxapi_cli(nxapi_port, NX_REMOTE_CONFIG +
+                          ["copy running-config startup-config"])
+        else:
+            dialog.run(child, NX_SAVE_DIALOG)
 
     except pexpect.TIMEOUT:
         raise pexpect.TIMEOUT('Timeout (%s) exceeded in read().' % str(child.timeout))
+    finally:
+        if transcript is not None:
+            transcript.close()
+            child.logfile = None
+
+    dialog.report()
+    return dialog.timings
 
 
-def create_Vagrantfile(boxname, vmmemory="4096"):
+def nxapi_cli(port, commands, username='admin', password='admin', timeout=120):
+    """
+    Send commands in one NX-API JSON-RPC request.
+
+    NX-API needs a moment after "feature nxapi", so connection errors are
+    retried until timeout.  Quits if the switch rejects a command.
+    """
+
+    payload = [{"jsonrpc": "2.0", "method": "cli",
+                "params": {"cmd": cmd, "version": 1}, "id": i + 1}
+               for i, cmd in enumerate(commands)]
+    auth = base64.b64encode(('%s:%s' % (username, password)).encode()).decode()
+    request = Request('http://127.0.0.1:%d/ins' % port,
+                      data=json.dumps(payload).encode(),
+                      headers={'Content-Type': 'application/json-rpc',
+                               'Authorization': 'Basic ' + auth})
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            response = urlopen(request, timeout=60)
+            break
+        except (URLError, socket.error) as e:
+            if time.time() > deadline:
+                sys.exit('NX-API on port %d not reachable: %s' % (port, e))
+            logger.debug('NX-API not ready yet: %s', e)
+            time.sleep(2)
+
+    results = json.loads(response.read().decode())
+    if isinstance(results, dict):
+        results = [results]
+    errors = ['%s: %s' % (commands[r['id'] - 1], r['error'].get('data', r['error']))
+              for r in results if 'error' in r]
+    if errors:
+        sys.exit('NX-API rejected commands:\n  ' + '\n  '.join(errors))
+    for cmd in commands:
+        logger.info('NX-API Config: %s' % cmd)
+
+
+def free_port():
+    """
+    Return a TCP port on localhost that is free right now.
+    """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def create_Vagrantfile(boxname, vmmemory="4096", nxapi_port=None):
     """
     Create a Basic Vagrantfile.
+
+    With nxapi_port, NX-API (guest port 80) is forwarded to that port.
     """
 
+    forwards = ""
+    if nxapi_port:
+        forwards = ("config.vm.network :forwarded_port, guest: 80, "
+                    "host: {port}, host_ip: '127.0.0.1', id: 'build-nxapi'").format(port=nxapi_port)
+
     template = """# -*- mode: ruby -*-\n# vi: set ft=ruby :
                   Vagrant.configure("2") do |config|
                     config.vm.box = "{boxname}"
@@ -370,6 +561,7 @@ def create_Vagrantfile(boxname, vmmemory="4096"):
                     config.ssh.insert_key = false
                     config.vm.boot_timeout = 400
                     config.vm.guest = :other
+                    {forwards}
                     # turn off the check if the plugin is installed
                     if Vagrant.has_plugin?("vagrant-vbguest")
                       config.vbguest.auto_update = false
@@ -379,7 +571,8 @@ def create_Vagrantfile(boxname, vmmemory="4096"):
                     end
                   end
                   """
-    vagrantfile_contents = template.format(boxname=boxname, vmmemory=vmmemory)
+    vagrantfile_contents = template.format(boxname=boxname, vmmemory=vmmemory,
+                                           forwards=forwards)
     logger.info("Contents of Vagrantfile to be used")
     logger.info(vagrantfile_contents)
     logger.warn("Creating Vagrantfile")
@@ -412,6 +605,112 @@ def vagrant_up(cont_on_error=False):
     run(["vagrant", "up"], cont_on_error=cont_on_error)
 
 
+def vagrant_create(box_name, input_box, vmname_base, nxapi_port=None):
+    """
+    Bring the source box up with Vagrant in the current folder, return the
+    name of its VM.
+    """
+
+    # Destroy any existing vagrant environment
+    cleanup_box()
+    logger.warn("  Note: An error may occur if the Vagrant environment isn't initialized, not problem")
+
+    # Create Vagrantfile
+    create_Vagrantfile(box_name, nxapi_port=nxapi_port)
+
+    # Add Box to Vagrant Inventory
+    box_add(box_name, input_box)
+
+    # Bring up Environment
+    build_trace.phase('vagrant up')
+    vagrant_up(cont_on_error=True)
+
+    # Determine VM Name from Virtual Box
+    vms_list_running = vboxmanage._text(run(['VBoxManage', 'list', 'runningvms'])).split("\n")
+    possible_vms = [vm for vm in vms_list_running if vmname_base in vm]
+    if len(possible_vms) == 1:
+        # Extract just the VM Name from the output: "name" {uuid}
+        vmname = re.match(r'\s*"(.*)"', possible_vms[0]).group(1)
+        logger.warn("Found VirtualBox VM: {}".format(vmname))
+    else:
+        sys.exit("Could not determine the VM Name.")
+    return vmname
+
+
+def vagrant_cleanup(box_name):
+    """
+    Destroy the Vagrant environment, remove the source box from the
+    Vagrant inventory and the Vagrantfile.
+    """
+
+    cleanup_box()
+    box_remove(box_name)
+
+    # Delete Vagrantfile used to build box
+    os.remove("Vagrantfile")
+
+
+def unpack_box(box_file, directory):
+    """
+    Extract a box (a tar archive, compressed or not) into directory, return
+    the path of its OVF.
+    """
+
+    try:
+        return box_packer.unpack(box_file, directory)
+    except box_packer.PackError as e:
+        sys.exit(str(e))
+
+
+def cleanup_vm(vmname, console_socket=None):
+    """
+    Power off and delete the build VM, if it's there, and its console socket.
+    """
+
+    state = vboxmanage.vm_state(vmname, run)
+    if state is not None and state not in vboxmanage.STOPPED:
+        logger.debug("'%s' is %s, powering off...", vmname, state)
+        run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
+        wait_for_state(vmname, vboxmanage.STOPPED)
+    if state is not None:
+        logger.debug("'%s' is registered, unregistering and deleting", vmname)
+        run(['VBoxManage', 'unregistervm', vmname, '--delete'])
+    if console_socket and os.path.exists(console_socket):
+        os.remove(console_socket)
+
+
+def import_box(box_file, vmname, basefolder, console_socket, nxapi_port=None,
+               vmmemory=4096):
+    """
+    Import the source box as VM vmname into basefolder, with its console on
+    console_socket, instead of "vagrant box add" and "vagrant up".
+
+    Neither the Vagrant box inventory nor the current folder are touched,
+    and a VM left over by a failed build of the same box is replaced.
+    """
+
+    cleanup_vm(vmname, console_socket)
+    unpack_dir = tempfile.mkdtemp(prefix='unpack_', dir=basefolder)
+    try:
+        logger.warn('Importing %s as %s', box_file, vmname)
+        ovf = unpack_box(box_file, unpack_dir)
+        run(['VBoxManage', 'import', ovf, '--vsys', '0', '--vmname', vmname,
+             '--basefolder', basefolder, '--memory', str(vmmemory)])
+    finally:
+        # the import copied the disk into the VM folder
+        shutil.rmtree(unpack_dir)
+    spec = vboxmanage.VMSpec(vmname)
+    spec.modify('--uart1', '0x3f8', 4)
+    spec.modify('--uartmode1', 'server', console_socket)
+    # the embedded Vagrantfile adds the second uart, a saved state needs
+    # the same devices
+    spec.modify('--uart2', '0x2f8', 3)
+    spec.modify('--uartmode2', 'disconnected')
+    if nxapi_port:
+        spec.modify('--natpf1', 'build-nxapi,tcp,127.0.0.1,%d,,80' % nxapi_port)
+    spec.apply(run, current=None)
+
+
 
 def main(argv):
     input_box = ''
@@ -435,12 +734,39 @@ def main(argv):
 
     parser.add_argument('BOX_FILE',
                         help='local Base Box filename')
-#     parser.add_argument('-o', '--create_ova', action='store_true',
-#                         help='additionally use VBoxManage to export an OVA')
+    parser.add_argument('-o', '--create_ova', action='store_true',
+                        help='additionally export an OVA, from the same pass as the box')
+    parser.add_argument('--qcow2', action='store_true',
+                        help='additionally write the disk as a qcow2 image (libvirt)')
     parser.add_argument('-d', '--debug', action='store_true',
-                        help='will pause with the VM in a running state. Use: socat unix-connect:/tmp/test stdin to access')
+                        help='will pause with the VM in a running state, and show how to reach its console')
+    parser.add_argument('--compression', choices=box_packer.COMPRESSIONS, default='gzip',
+                        help='box compression, on all cores (default: %(default)s)')
+    parser.add_argument('--vagrant-package', action='store_true',
+                        help='package the box with "vagrant package" (one core)')
+    parser.add_argument('--vagrant-up', action='store_true',
+                        help='bring the source box up with "vagrant box add" and "vagrant up" '
+                             'in the current folder, instead of importing it straight into '
+                             'VirtualBox')
+    parser.add_argument('--full-disk', action='store_true',
+                        help='export the whole disk instead of only its allocated data')
+    parser.add_argument('--saved-state', action='store_true',
+                        help='save the state of the configured VM with the box, so vagrant up '
+                             'resumes it instead of booting (see saved_state.py)')
+    parser.add_argument('--catalog-dir',
+                        help='add the box to the Vagrant catalog nxos/metadata.json in this folder '
+                             '(default: ./created_boxes)')
     parser.add_argument('-n', '--nocolor', action='store_true',
                         help='don\'t use colors for logging')
+    parser.add_argument('--split', action='store_true',
+                        help='bootstrap NX-API over the console, then configure the rest over NX-API')
+    parser.add_argument('--history', default=build_history.DEFAULT_HISTORY,
+                        help='build history the timings are added to (default: %(default)s)')
+    parser.add_argument('--no-history', action='store_true',
+                        help='don\'t add this build to the build history')
+    parser.add_argument('-t', '--trace', action='store_true',
+                        help='write a Chrome trace (<box folder>/nxos_<version>-trace.json) and a '
+                             'summary of where the build time went')
     parser.add_argument('-v', '--verbose',
                         action='store_const', const=logging.INFO,
                         default=logging.WARN, help='turn on verbose messages')
@@ -455,13 +781,9 @@ def main(argv):
     root_logger.addHandler(handler)
     logger = logging.getLogger("box-builder")
 
-    # PRE-CHECK: is socat installed?
-    logger.warn('Check whether "socat" is installed')
-    try:
-        run(['socat', '-V'])
-    except OSError:
-        sys.exit(
-            'The "socat" utility is not installed. Please install it prior to using this script.')
+    if args.trace:
+        tracer = build_trace.start(os.path.basename(args.BOX_FILE))
+    build_trace.phase('prepare')
 
     # Get source Box name and determine key details for script
     input_box = args.BOX_FILE
@@ -481,11 +803,12 @@ def main(argv):
     base_dir = os.path.join(os.getcwd(), 'created_boxes')
     box_dir = os.path.join(base_dir, output_box)
     box_out = os.path.join(box_dir, output_box + '.box')
+    ova_out = os.path.join(box_dir, output_box + '.ova')
+    qcow2_out = os.path.join(box_dir, output_box + '.qcow2')
     pathname = os.path.abspath(os.path.dirname(sys.argv[0]))
 
 #     vbox = os.path.join(box_dir, vmname + '.vbox')
 #     vdi = os.path.join(box_dir, vmname + '.vdi')
-#     ova_out = os.path.join(box_dir, vmname + '.ova')
 
     logger.debug('Input Box is %s', input_box)
     logger.debug('pathname: %s', pathname)
@@ -502,6 +825,14 @@ def main(argv):
     if not os.path.exists(box_dir):
         os.makedirs(box_dir)
 
+    if args.trace:
+        trace_out = os.path.join(box_dir, output_box + '-trace.json')
+
+        def write_trace():
+            logger.warn('Build trace: %s\n%s', trace_out, tracer.write(trace_out))
+        # on sys.exit too, a failed build is worth a look as well
+        atexit.register(write_trace)
+
     # Delete existing Box
     if os.path.exists(box_out):
         os.remove(box_out)
@@ -513,60 +844,118 @@ def main(argv):
 #         logger.debug('Found and deleted previous %s', ova_out)
 
 
-    # Destroy any existing vagrant environment
-    cleanup_box()
-    logger.warn("  Note: An error may occur if the Vagrant environment isn't initialized, not problem")
-
-    # Create Vagrantfile
-    create_Vagrantfile(box_name)
-
-    # Add Box to Vagrant Inventory
-    box_add(box_name, input_box)
-
-    # Bring up Environment
-    vagrant_up(cont_on_error=True)
-
-    # Determine VM Name from Virtual Box
-    vms_list_running = run(['VBoxManage', 'list', 'runningvms']).split("\n")
-    possible_vms = [vm for vm in vms_list_running if vmname_base in vm]
-    if len(possible_vms) == 1:
-        # Extract just the VM Name from the output
-        vmname = possible_vms[0].split()[0][1:len(possible_vms[0].split()[0])-2]
-        logger.warn("Found VirtualBox VM: {}".format(vmname))
+    build_trace.phase('vm create')
+    nxapi_port = free_port() if args.split else None
+    if args.vagrant_up:
+        console_socket = CONSOLE_SOCKET
+        vmname = vagrant_create(box_name, input_box, vmname_base, nxapi_port)
     else:
-        sys.exit("Could not determine the VM Name.")
+        # Straight into VirtualBox, under a name of its own
+        vmname = output_box + '-build'
+        console_socket = os.path.join(tempfile.gettempdir(), vmname + '.console')
+        import_box(input_box, vmname, box_dir, console_socket, nxapi_port)
+        build_trace.phase('start vm')
+        run(['VBoxManage', 'startvm', vmname, '--type', 'headless'])
+    wait_for_state(vmname, vboxmanage.RUNNING, timeout=60)
 
     # Complete Startup
     # Configure NX-OS
     # do print steps for logging set to DEBUG and INFO
     # DEBUG also prints the I/O with the device on the console
     # default is WARN
-    configure_nx(args.verbose < logging.WARN)
+    build_trace.phase('boot and configure')
+    configure_nx(args.verbose < logging.WARN, nxapi_port=nxapi_port,
+                 console_socket=console_socket,
+                 logfile=os.path.join(box_dir, output_box + '-console.log'))
 
     # Good place to stop and take a look if --debug was entered
     if args.debug:
-        pause_to_debug()
+        pause_to_debug(console_socket)
 
 
     # Export as new box
     logger.warn('Powering down and generating new Vagrant VirtualBox')
-    logger.warn('Waiting for machine to shutdown')
-    run(["vagrant", "halt", "-f"])
+    build_trace.phase('shutdown')
+    include = []
+    if args.saved_state:
+        logger.warn('Saving the state of the machine')
+        try:
+            include = saved_state.save(vmname, box_dir, run)
+        except (vboxmanage.StateTimeout, saved_state.SavedStateError) as e:
+            sys.exit(str(e))
+    elif args.vagrant_up:
+        logger.warn('Waiting for machine to shutdown')
+        run(["vagrant", "halt", "-f"])
+        wait_for_state(vmname, vboxmanage.STOPPED)
+    else:
+        logger.warn('Waiting for machine to shutdown')
+        run(['VBoxManage', 'controlvm', vmname, 'poweroff'])
+        wait_for_state(vmname, vboxmanage.STOPPED)
+    if not args.vagrant_up:
+        # the console of the box is disconnected by default
+        run(['VBoxManage', 'modifyvm', vmname, '--uartmode1', 'disconnected'])
 
     # Add the embedded Vagrantfile
     vagrantfile_pathname = os.path.join(pathname, 'include', 'embedded_vagrantfile_nx')
 
+    build_trace.phase('package')
     logger.warn("Exporting new box file.  (may take 3 minutes or so)")
-    run(["vagrant", "package", "--vagrantfile", vagrantfile_pathname, "--output", box_out])
+    checksum = None
+    if args.vagrant_package:
+        if args.qcow2:
+            disks = box_packer.hard_disks(vboxmanage.showvminfo(vmname, run))
+            box_packer.write_qcow2(disks[0][3], qcow2_out)
+        if args.create_ova:
+            run(['VBoxManage', 'export', vmname, '--output', ova_out])
+        extra = ["--include", ",".join(include)] if include else []
+        if args.vagrant_up:
+            run(["vagrant", "package", "--vagrantfile", vagrantfile_pathname, "--output", box_out] +
+                extra)
+        else:
+            run(["vagrant", "package", "--base", vmname,
+                 "--vagrantfile", vagrantfile_pathname, "--output", box_out] + extra)
+    else:
+        # One export of the VM for the box, the OVA and the qcow2 image
+        try:
+            stats = box_packer.package(vmname, box_out, run, vagrantfile_pathname,
+                                       args.compression, sparse=not args.full_disk,
+                                       ova=ova_out if args.create_ova else None,
+                                       qcow2=qcow2_out if args.qcow2 else None,
+                                       include=include)
+        except box_packer.PackError as e:
+            sys.exit(str(e))
+        checksum = stats['sha256']
     logger.warn('New Vagrant Box Created: %s', box_out)
+    if args.create_ova:
+        logger.warn('Created: %s', ova_out)
+    if args.qcow2:
+        logger.warn('Created: %s', qcow2_out)
 
     # Destroy original Source Box
+    build_trace.phase('cleanup')
     logger.warn("Cleaning up build resources.")
-    cleanup_box()
-    box_remove(box_name)
-
-    # Delete Vagrantfile used to build box
-    os.remove("Vagrantfile")
+    if args.vagrant_up:
+        vagrant_cleanup(box_name)
+    else:
+        cleanup_vm(vmname, console_socket)
+    saved_state.remove(box_dir)
+
+    build_trace.phase('record')
+    catalog = box_catalog.add_box(args.catalog_dir or base_dir, 'nxos', version,
+                                  box_out, checksum)
+    if not args.no_history:
+        built = {'box': box_out}
+        if args.create_ova:
+            built['ova'] = ova_out
+        if args.qcow2:
+            built['qcow2'] = qcow2_out
+        build_history.record_build(args.history, 'nxos', version, built,
+                                   run(['VBoxManage', '-v']), options={
+                                       'split': args.split,
+                                       'compression': args.compression,
+                                       'saved_state': args.saved_state,
+                                       'vagrant_package': args.vagrant_package,
+                                       'vagrant_up': args.vagrant_up})
 
     logger.warn('Completed!')
     logger.warn(" ")
@@ -580,6 +969,9 @@ def main(argv):
     logger.warn("  cd my_project")
     logger.warn('Initialize Project Vagrant Environment:')
     logger.warn('  vagrant init nxos/{version}'.format(version=version))
+    logger.warn('Or add every version in the catalog, as the versioned box nxos:')
+    logger.warn('  vagrant box add {catalog}'.format(catalog=catalog))
+    logger.warn('  vagrant init nxos --box-version {version}'.format(version=version))
     logger.warn('Bring up box:')
     logger.warn('  vagrant up')
     logger.warn('')
@@ -0,0 +1,127 @@
+'''
+Saved execution state for "instant boot" boxes.
+
+Every "vagrant up" of a box is a cold boot of IOS XE or NX-OS, 3-5 minutes
+(hence boot_timeout = 400 in the embedded Vagrantfiles).  With --saved-state
+the builders save the configured VM with "VBoxManage controlvm savestate"
+instead of powering it off, and the box carries that state in its include
+folder:
+
+    include/saved-state.sav    the execution state of the build VM
+    include/saved-state.json   the VM settings the state depends on, and
+                               the MAC addresses of the network adapters
+    include/saved_state.rb     the Vagrant hook that resumes from it
+
+The state is discarded from the build VM again before it's exported, the
+disk of the box is the disk as it was when the state was saved.
+
+The embedded Vagrantfiles load saved_state.rb when it's in the box.  On
+the first "vagrant up" of a machine, right before VirtualBox boots it and
+after all networks, forwarded ports and customizations are in place, the
+hook compares the VM with saved-state.json:
+
+  . settings the state depends on (memory, CPUs, chipset, serial ports,
+    network adapters, storage controllers and attachments, ...) must be
+    the same, otherwise the machine boots cold
+  . the network adapters get the MAC addresses of the build VM, the guest
+    resumes with those in its registers anyway; an adapter beyond the NAT
+    one that is attached to a network is a difference (every machine of
+    the box would use the same MAC on it), so labs with private networks
+    boot cold
+  . forwarded ports are set up by the NAT on the host, they may differ
+    from the build VM, the NAT network itself (natnet1) may not
+
+Then the VM adopts a copy of the state and the boot resumes the device in
+seconds.  If resuming fails anyway, the state is discarded and the machine
+boots cold.  Later boots of the machine are cold boots, as always.
+'''
+
+import os
+import re
+import json
+import glob
+import shutil
+import logging
+
+import vboxmanage
+
+logger = logging.getLogger(__name__)
+
+SAVED_STATE = 'saved-state.sav'
+SAVED_STATE_INFO = 'saved-state.json'
+
+# The Vagrant hook, packaged next to the embedded Vagrantfile
+RESUME_HOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'include', 'saved_state.rb')
+
+# showvminfo --machinereadable settings a saved state depends on, the
+# storage attachments are added by settings(); saved_state.rb uses the same
+SETTINGS = re.compile(r'^(memory|cpus|chipset|firmware|ioapic|pae|longmode|hpet|'
+                      r'paravirtprovider|vram|graphicscontroller|audio|usb\w*|'
+                      r'uart\d|nic\d|nictype\d|natnet\d|storagecontroller\w+)$')
+
+
+class SavedStateError(Exception):
+    pass
+
+
+def settings(info):
+    """
+    Return the settings of a VM a saved state depends on, from its machine
+    readable info.  Attachments only count as disk or DVD, their paths
+    differ on every host.
+    """
+
+    result = dict((key, value) for key, value in info.items() if SETTINGS.match(key))
+    controllers = [value for key, value in info.items()
+                   if key.startswith('storagecontrollername')]
+    for key, value in info.items():
+        match = re.match(r'^(.+)-(\d+)-(\d+)$', key)
+        if match and match.group(1) in controllers and value != 'none':
+            disk = os.path.splitext(value)[1].lower() in ('.vdi', '.vmdk')
+            result[key] = 'disk' if disk else 'dvd'
+    return result
+
+
+def save(vmname, directory, run, timeout=120):
+    """
+    Save the execution state of the running VM into directory and leave
+    the VM powered off, ready to be exported.
+
+    Returns the files for the include folder of the box.
+    """
+
+    run(['VBoxManage', 'controlvm', vmname, 'savestate'])
+    vboxmanage.wait_for_state(vmname, ('saved',), run, timeout)
+    info = vboxmanage.showvminfo(vmname, run)
+
+    states = glob.glob(os.path.join(info.get('SnapFldr', ''), '*.sav'))
+    if not states:
+        raise SavedStateError("No saved state of '%s' in %s"
+                              % (vmname, info.get('SnapFldr')))
+    state = max(states, key=os.path.getmtime)
+    state_out = os.path.join(directory, SAVED_STATE)
+    info_out = os.path.join(directory, SAVED_STATE_INFO)
+    logger.warn('Keeping saved state (%d MB)', os.path.getsize(state) // 1024 ** 2)
+    shutil.copyfile(state, state_out)
+    macs = dict((key[len('nic'):], info['macaddress' + key[len('nic'):]])
+                for key, value in info.items()
+                if re.match(r'^nic\d$', key) and value != 'none' and
+                'macaddress' + key[len('nic'):] in info)
+    with open(info_out, 'w') as f:
+        json.dump({'vm': vmname, 'settings': settings(info), 'macs': macs}, f,
+                  indent=2, sort_keys=True)
+
+    # the disk stays as it was when the state was saved
+    run(['VBoxManage', 'discardstate', vmname])
+    return [state_out, info_out, RESUME_HOOK]
+
+
+def remove(directory):
+    """
+    Remove the saved state kept in directory, once it's in the box.
+    """
+
+    for name in (SAVED_STATE, SAVED_STATE_INFO):
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+'''
+Read dynamic VirtualBox disks by their block map and export only the data.
+
+A dynamic VDI (what "createhd" makes) or sparse VMDK (what an imported box
+gets) of 8 GB holds perhaps 1.5 GB, the rest was never written.  Reading it
+as a flat stream means reading and compressing gigabytes of zeros.  The
+readers here walk the block map instead: unallocated blocks are skipped
+without touching the file, and allocated blocks that hold only zeros are
+dropped as well.
+
+StreamOptimizedWriter writes the result as a streamOptimized VMDK, the disk
+format of OVF/OVA files and Vagrant boxes: only the non-zero grains, each
+one deflated, on several threads.  Qcow2Writer writes a qcow2 image for
+libvirt hosts.  export_disk() reads the disk once and feeds every writer.
+
+Supported disks:
+    VDI    normal and fixed images (no differencing images)
+    VMDK   monolithic sparse and streamOptimized extents
+
+E.g.:
+    python sparse_disk.py info csr1000v-universalk9.16.07.01.vdi
+    python sparse_disk.py vmdk csr1000v-universalk9.16.07.01.vdi box-disk001.vmdk
+    python sparse_disk.py qcow2 csr1000v-universalk9.16.07.01.vdi csr.qcow2
+'''
+
+from __future__ import print_function
+import sys
+import os
+import zlib
+import uuid
+import random
+import struct
+import logging
+import argparse
+import threading
+import textwrap
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+SECTOR = 512
+
+# VMDK grains are 64 KB
+GRAIN_SECTORS = 128
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR
+GTES_PER_GT = 512
+
+VDI_SIGNATURE = 0xbeda107f
+VDI_BLOCK_FREE = 0xffffffff
+VDI_BLOCK_ZERO = 0xfffffffe
+VDI_TYPE_DIFF = 4
+
+VMDK_MAGIC = b'KDMV'
+VMDK_COMPRESSED = 1 << 16
+VMDK_MARKERS = 1 << 17
+VMDK_GD_AT_END = 0xffffffffffffffff
+VMDK_HEADER = struct.Struct('<4sIIQQQQIQQQBccccH433s')
+
+MARKER_EOS, MARKER_GT, MARKER_GD, MARKER_FOOTER = 0, 1, 2, 3
+
+
+class DiskError(Exception):
+    pass
+
+
+class VDIReader(object):
+    """
+    VirtualBox disk image: a block map of 1 MB blocks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        header = self.f.read(512)
+        signature, version = struct.unpack_from('<II', header, 64)
+        if signature != VDI_SIGNATURE:
+            raise DiskError('%s is not a VDI image' % path)
+        if version >> 16 != 1:
+            raise DiskError('%s: VDI version %x not supported' % (path, version))
+        image_type, = struct.unpack_from('<I', header, 76)
+        if image_type == VDI_TYPE_DIFF:
+            raise DiskError('%s is a differencing image' % path)
+        self.blocks_offset, self.data_offset = struct.unpack_from('<II', header, 340)
+        self.size, self.block_size, self.block_extra, self.block_count = \
+            struct.unpack_from('<QIII', header, 368)
+        self.f.seek(self.blocks_offset)
+        self.block_map = struct.unpack('<%dI' % self.block_count,
+                                       self.f.read(4 * self.block_count))
+        self.allocated = self.block_size * sum(
+            1 for b in self.block_map if b not in (VDI_BLOCK_FREE, VDI_BLOCK_ZERO))
+
+    def extents(self):
+        """
+        Yield (offset, data) for the allocated blocks, in order.
+        """
+
+        for number, block in enumerate(self.block_map):
+            if block in (VDI_BLOCK_FREE, VDI_BLOCK_ZERO):
+                continue
+            self.f.seek(self.data_offset + block * (self.block_size + self.block_extra) +
+                        self.block_extra)
+            yield number * self.block_size, self.f.read(self.block_size)
+
+    def close(self):
+        self.f.close()
+
+
+class VMDKReader(object):
+    """
+    Hosted sparse VMDK extent: grain directory, grain tables, grains.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        header = self._header(self.f.read(SECTOR))
+        if header['gd_offset'] == VMDK_GD_AT_END:
+            # streamOptimized: the real header is the footer
+            self.f.seek(-2 * SECTOR, os.SEEK_END)
+            header = self._header(self.f.read(SECTOR))
+        self.flags = header['flags']
+        self.size = header['capacity'] * SECTOR
+        self.grain_size = header['grain_sectors'] * SECTOR
+        grains = (header['capacity'] + header['grain_sectors'] - 1) // header['grain_sectors']
+        tables = (grains + header['gtes_per_gt'] - 1) // header['gtes_per_gt']
+        self.f.seek(header['gd_offset'] * SECTOR)
+        directory = struct.unpack('<%dI' % tables, self.f.read(4 * tables))
+        self.grains = []
+        for table, gt_sector in enumerate(directory):
+            if gt_sector == 0:
+                continue
+            self.f.seek(gt_sector * SECTOR)
+            entries = struct.unpack('<%dI' % header['gtes_per_gt'],
+                                    self.f.read(4 * header['gtes_per_gt']))
+            for number, sector in enumerate(entries):
+                # 0: unallocated, 1: zero grain
+                if sector > 1:
+                    grain = table * header['gtes_per_gt'] + number
+                    self.grains.append((grain * self.grain_size, sector))
+        self.allocated = len(self.grains) * self.grain_size
+
+    def _header(self, data):
+        fields = VMDK_HEADER.unpack(data)
+        if fields[0] != VMDK_MAGIC:
+            raise DiskError('%s is not a sparse VMDK extent' % self.path)
+        return {'flags': fields[2], 'capacity': fields[3], 'grain_sectors': fields[4],
+                'gtes_per_gt': fields[7], 'gd_offset': fields[9]}
+
+    def extents(self):
+        """
+        Yield (offset, data) for the allocated grains, in order.
+        """
+
+        for offset, sector in sorted(self.grains):
+            self.f.seek(sector * SECTOR)
+            if self.flags & VMDK_COMPRESSED:
+                _, length = struct.unpack('<QI', self.f.read(12))
+                data = zlib.decompress(self.f.read(length))
+            else:
+                data = self.f.read(self.grain_size)
+            yield offset, data
+
+    def close(self):
+        self.f.close()
+
+
+def open_disk(path):
+    """
+    Return a reader for the VDI or sparse VMDK at path.
+    """
+
+    with open(path, 'rb') as f:
+        start = f.read(72)
+    if start[:4] == VMDK_MAGIC:
+        return VMDKReader(path)
+    if len(start) >= 68 and struct.unpack_from('<I', start, 64)[0] == VDI_SIGNATURE:
+        return VDIReader(path)
+    raise DiskError('%s: not a VDI or sparse VMDK disk' % path)
+
+
+def grains(reader):
+    """
+    Yield (offset, data) of the non-zero 64 KB grains of the disk.
+    """
+
+    zero = b'\x00' * GRAIN_SIZE
+    for offset, data in reader.extents():
+        for start in range(0, len(data), GRAIN_SIZE):
+            grain = data[start:start + GRAIN_SIZE]
+            if offset + start >= reader.size:
+                break
+            if grain != zero[:len(grain)]:
+                yield offset + start, grain
+
+
+def ordered_map(func, items, threads):
+    """
+    Like map(func, items), on threads, results in order.
+
+    At most two items per thread are in flight, so memory stays bounded.
+    """
+
+    jobs = queue.Queue()
+
+    def work():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            try:
+                job['result'] = func(job['item'])
+            except Exception as e:
+                job['error'] = e
+            job['done'].set()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    pending = deque()
+
+    def next_result():
+        job = pending.popleft()
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['result']
+
+    try:
+        for item in items:
+            job = {'item': item, 'done': threading.Event(), 'result': None,
+                   'error': None}
+            pending.append(job)
+            jobs.put(job)
+            while len(pending) > 2 * threads:
+                yield next_result()
+        while pending:
+            yield next_result()
+    finally:
+        for _ in workers:
+            jobs.put(None)
+
+
+def _pad(data):
+    return data + b'\x00' * (-len(data) % SECTOR)
+
+
+def _marker(value, kind):
+    return struct.pack('<QII', value, 0, kind).ljust(SECTOR, b'\x00')
+
+
+class StreamOptimizedWriter(object):
+    """
+    Write a streamOptimized VMDK: header, descriptor, deflated grains, then
+    grain tables, grain directory, footer and end of stream marker.
+    """
+
+    def __init__(self, fileobj, size, name='disk.vmdk', adapter='ide', level=6):
+        self.fileobj = fileobj
+        self.capacity = (size + SECTOR - 1) // SECTOR
+        self.level = level
+        grain_count = (self.capacity + GRAIN_SECTORS - 1) // GRAIN_SECTORS
+        self.table_count = (grain_count + GTES_PER_GT - 1) // GTES_PER_GT
+        self.table = [0] * (self.table_count * GTES_PER_GT)
+        self.sector = 0
+
+        descriptor = _pad(self._descriptor(name, adapter).encode('ascii'))
+        self.descriptor_sectors = len(descriptor) // SECTOR
+        self._write(self._header(VMDK_GD_AT_END))
+        self._write(descriptor)
+
+    def _descriptor(self, name, adapter):
+        cylinders = min(self.capacity // (16 * 63), 16383)
+        return textwrap.dedent('''\
+            # Disk DescriptorFile
+            version=1
+            CID=%08x
+            parentCID=ffffffff
+            createType="streamOptimized"
+
+            # Extent description
+            RW %d SPARSE "%s"
+
+            # The disk Data Base
+            #DDB
+
+            ddb.adapterType = "%s"
+            ddb.geometry.cylinders = "%d"
+            ddb.geometry.heads = "16"
+            ddb.geometry.sectors = "63"
+            ddb.uuid.image = "%s"
+            ddb.virtualHWVersion = "4"
+            ''') % (random.getrandbits(32), self.capacity, name, adapter,
+                    cylinders, uuid.uuid4())
+
+    def _header(self, gd_offset):
+        return VMDK_HEADER.pack(
+            VMDK_MAGIC, 3, 1 | VMDK_COMPRESSED | VMDK_MARKERS, self.capacity,
+            GRAIN_SECTORS, 1, self.descriptor_sectors,
+            GTES_PER_GT, 0, gd_offset, 1 + self.descriptor_sectors,
+            0, b'\n', b' ', b'\r', b'\n', 1, b'')
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.sector += len(data) // SECTOR
+
+    def add_grain(self, offset, deflated):
+        """
+        Write a grain deflated by compress_grain(), in increasing offset
+        order.
+        """
+
+        self.table[offset // GRAIN_SIZE] = self.sector
+        self._write(_pad(struct.pack('<QI', offset // SECTOR, len(deflated)) +
+                         deflated))
+
+    def close(self):
+        directory = []
+        for number in range(self.table_count):
+            self._write(_marker(GTES_PER_GT * 4 // SECTOR, MARKER_GT))
+            directory.append(self.sector)
+            entries = self.table[number * GTES_PER_GT:(number + 1) * GTES_PER_GT]
+            self._write(struct.pack('<%dI' % GTES_PER_GT, *entries))
+        self._write(_marker(len(_pad(b'\x00' * 4 * len(directory))) // SECTOR,
+                            MARKER_GD))
+        gd_offset = self.sector
+        self._write(_pad(struct.pack('<%dI' % len(directory), *directory)))
+        self._write(_marker(1, MARKER_FOOTER))
+        self._write(self._header(gd_offset))
+        self._write(_marker(0, MARKER_EOS))
+
+
+def compress_grain(grain, level=6):
+    """
+    (offset, data) -> (offset, data, deflated data), for add_grain().
+    """
+
+    offset, data = grain
+    if len(data) < GRAIN_SIZE:
+        data = data.ljust(GRAIN_SIZE, b'\x00')
+    return offset, data, zlib.compress(data, level)
+
+
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+QCOW2_COPIED = 1 << 63
+
+# qcow2 clusters are as large as VMDK grains
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+
+
+def _clusters(size):
+    return (size + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+
+
+class Qcow2Writer(object):
+    """
+    Write a qcow2 (version 2) image: header and L1 table, the data clusters
+    as they come, then the L2 tables and the refcounts.  fileobj has to be
+    seekable, the L1 table and the header are filled in last.
+    """
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.size = size
+        self.l2_entries = CLUSTER_SIZE // 8
+        self.l1_size = (size + CLUSTER_SIZE * self.l2_entries - 1) // \
+            (CLUSTER_SIZE * self.l2_entries)
+        self.l1_offset = CLUSTER_SIZE
+        self.next_cluster = 1 + max(_clusters(8 * self.l1_size), 1)
+        self.tables = {}
+        fileobj.write(b'\x00' * CLUSTER_SIZE * self.next_cluster)
+
+    def _append(self, data):
+        self.fileobj.write(data.ljust(CLUSTER_SIZE, b'\x00'))
+        self.next_cluster += 1
+        return (self.next_cluster - 1) * CLUSTER_SIZE
+
+    def add_grain(self, offset, data):
+        """
+        Write a cluster of data at offset (cluster aligned), in increasing
+        offset order.
+        """
+
+        cluster = offset // CLUSTER_SIZE
+        table = self.tables.setdefault(cluster // self.l2_entries,
+                                       [0] * self.l2_entries)
+        table[cluster % self.l2_entries] = self._append(data) | QCOW2_COPIED
+
+    def close(self):
+        l1 = [0] * self.l1_size
+        for index in sorted(self.tables):
+            l1[index] = self._append(struct.pack(
+                '>%dQ' % self.l2_entries, *self.tables[index])) | QCOW2_COPIED
+
+        # every cluster is used once, including the refcount clusters
+        per_block = CLUSTER_SIZE // 2
+        blocks = table_clusters = 0
+        while True:
+            total = self.next_cluster + blocks + table_clusters
+            needed = (total + per_block - 1) // per_block
+            if (needed, _clusters(8 * needed)) == (blocks, table_clusters):
+                break
+            blocks, table_clusters = needed, _clusters(8 * needed)
+        block_offsets = []
+        for block in range(blocks):
+            used = min(max(total - block * per_block, 0), per_block)
+            block_offsets.append(self._append(
+                struct.pack('>%dH' % used, *([1] * used))))
+        table_offset = self.next_cluster * CLUSTER_SIZE
+        self.fileobj.write(struct.pack('>%dQ' % blocks, *block_offsets).ljust(
+            table_clusters * CLUSTER_SIZE, b'\x00'))
+
+        self.fileobj.seek(self.l1_offset)
+        self.fileobj.write(struct.pack('>%dQ' % self.l1_size, *l1))
+        self.fileobj.seek(0)
+        self.fileobj.write(QCOW2_HEADER.pack(
+            QCOW2_MAGIC, 2, 0, 0, CLUSTER_BITS, self.size, 0, self.l1_size,
+            self.l1_offset, table_offset, table_clusters, 0, 0))
+
+
+_DONE = object()
+
+
+def fan_out(items, consumers, depth=16):
+    """
+    Hand every item to each of the consumers, each one on its own thread,
+    so a slow writer doesn't hold up the others.
+    """
+
+    queues = [queue.Queue(depth) for _ in consumers]
+    errors = []
+
+    def drain(items, consume):
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if errors:
+                continue
+            try:
+                consume(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=drain, args=(q, consume))
+               for q, consume in zip(queues, consumers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for item in items:
+            if errors:
+                break
+            for q in queues:
+                q.put(item)
+    finally:
+        for q in queues:
+            q.put(_DONE)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def export_disk(path, vmdk=None, qcow2=None, threads=1, name='disk.vmdk',
+                adapter='ide'):
+    """
+    Read the disk at path once and write it to every output given: vmdk
+    (a streamOptimized VMDK named name) and qcow2, both file objects.
+
+    Returns stats: logical size, allocated bytes, non-zero bytes written.
+    """
+
+    reader = open_disk(path)
+    stats = {'logical': reader.size, 'allocated': reader.allocated, 'data': 0}
+    writers = []
+    consumers = []
+
+    def count(grain):
+        stats['data'] += len(grain[1])
+    consumers.append(count)
+
+    if vmdk is not None:
+        writers.append(StreamOptimizedWriter(vmdk, reader.size, name, adapter))
+        consumers.append(lambda grain, w=writers[-1]: w.add_grain(grain[0], grain[2]))
+        prepare = compress_grain
+    else:
+        prepare = lambda grain: grain
+    if qcow2 is not None:
+        writers.append(Qcow2Writer(qcow2, reader.size))
+        consumers.append(lambda grain, w=writers[-1]: w.add_grain(grain[0], grain[1]))
+
+    try:
+        fan_out(ordered_map(prepare, grains(reader), threads), consumers)
+        for writer in writers:
+            writer.close()
+    finally:
+        reader.close()
+    logger.info('%s: %d MB logical, %d MB allocated, %d MB data', path,
+                stats['logical'] // 1024 ** 2, stats['allocated'] // 1024 ** 2,
+                stats['data'] // 1024 ** 2)
+    return stats
+
+
+def export_vmdk(path, fileobj, threads=1, name='disk.vmdk', adapter='ide'):
+    """
+    Write the disk at path as a streamOptimized VMDK named name to fileobj.
+    """
+
+    return export_disk(path, vmdk=fileobj, threads=threads, name=name,
+                       adapter=adapter)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Show how much of a dynamic disk is in use, or export it as a
+            streamOptimized VMDK or qcow2 image.
+        '''))
+    commands = parser.add_subparsers(dest='command')
+    info = commands.add_parser('info', help='logical, allocated and data bytes')
+    info.add_argument('DISK')
+    vmdk = commands.add_parser('vmdk', help='write a streamOptimized VMDK')
+    vmdk.add_argument('DISK')
+    vmdk.add_argument('VMDK')
+    vmdk.add_argument('-j', '--threads', type=int, default=1,
+                      help='compression threads (default: %(default)s)')
+    qcow2 = commands.add_parser('qcow2', help='write a qcow2 image')
+    qcow2.add_argument('DISK')
+    qcow2.add_argument('QCOW2')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="==> %(message)s")
+    try:
+        if args.command == 'info':
+            reader = open_disk(args.DISK)
+            data = sum(len(g) for _, g in grains(reader))
+            print('logical:   %8d MB' % (reader.size // 1024 ** 2))
+            print('allocated: %8d MB' % (reader.allocated // 1024 ** 2))
+            print('data:      %8d MB' % (data // 1024 ** 2))
+            reader.close()
+        elif args.command == 'vmdk':
+            with open(args.VMDK, 'wb') as f:
+                export_vmdk(args.DISK, f, args.threads,
+                            os.path.basename(args.VMDK))
+        elif args.command == 'qcow2':
+            with open(args.QCOW2, 'wb') as f:
+                export_disk(args.DISK, qcow2=f)
+        else:
+            parser.print_help()
+    except DiskError as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,81 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import box_catalog
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'iosxe', 'metadata.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def box(self, name, data=b'box'):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_save_round_trip(self):
+        catalog = box_catalog.Catalog(self.path)
+        os.makedirs(os.path.dirname(self.path))
+        for metadata in [
+                {'versions': []},
+                {'versions': [{'version': '16.07.01', 'providers': []}]},
+                {'name': 'iosxe', 'description': 'CSR 1000v',
+                 'versions': [{'version': '16.08.01', 'providers': []},
+                              {'version': '16.07.01', 'providers': []}]}]:
+            catalog._save(metadata)
+            with open(self.path) as f:
+                self.assertEqual(json.load(f), metadata)
+            self.assertEqual(catalog.load(), metadata)
+
+    def test_add_keeps_versions_sorted(self):
+        for version in ('16.9.1', '16.10.1', '16.07.01'):
+            box_catalog.add_box(self.dir, 'iosxe', version, self.box(version + '.box'))
+        catalog = box_catalog.Catalog(self.path)
+        self.assertEqual(catalog.versions(), ['16.10.1', '16.9.1', '16.07.01'])
+        metadata = catalog.load()
+        self.assertEqual(metadata['name'], 'iosxe')
+        provider = metadata['versions'][0]['providers'][0]
+        self.assertEqual(provider['name'], 'virtualbox')
+        self.assertEqual(provider['checksum'], hashlib.sha256(b'box').hexdigest())
+        self.assertTrue(provider['url'].startswith('file://'))
+
+    def test_add_replaces_provider_of_version(self):
+        box = self.box('a.box')
+        box_catalog.add_box(self.dir, 'iosxe', '16.07.01', box, 'old')
+        box_catalog.add_box(self.dir, 'iosxe', '16.07.01', box, 'new')
+        versions = box_catalog.Catalog(self.path).load()['versions']
+        self.assertEqual(len(versions), 1)
+        self.assertEqual([p['checksum'] for p in versions[0]['providers']], ['new'])
+
+    def test_remove(self):
+        box = self.box('a.box')
+        box_catalog.add_box(self.dir, 'iosxe', '16.07.01', box, 'a')
+        box_catalog.add_box(self.dir, 'iosxe', '16.08.01', box, 'b')
+        catalog = box_catalog.Catalog(self.path)
+        self.assertTrue(catalog.remove('16.07.01'))
+        self.assertFalse(catalog.remove('16.07.01'))
+        self.assertEqual(catalog.versions(), ['16.08.01'])
+        # the last version leaves a catalog that still loads
+        self.assertTrue(catalog.remove('16.08.01'))
+        self.assertEqual(catalog.versions(), [])
+        box_catalog.add_box(self.dir, 'iosxe', '16.09.01', box, 'c')
+        self.assertEqual(catalog.versions(), ['16.09.01'])
+
+    def test_version_key(self):
+        self.assertLess(box_catalog.version_key('16.9.1'), box_catalog.version_key('16.10.1'))
+        self.assertLess(box_catalog.version_key('7.0.3.I7.1'),
+                        box_catalog.version_key('7.0.3.I7.2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
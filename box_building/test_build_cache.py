@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import build_cache
+
+
+class BuildManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, build_cache.MANIFEST_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def artifact(self, name, data=b'box'):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_concurrent_builds_keep_their_entries(self):
+        # both builds read the manifest before either has finished
+        first = build_cache.BuildManifest(self.path)
+        second = build_cache.BuildManifest(self.path)
+        first.record('a', {'box': self.artifact('a.box')})
+        second.record('b', {'box': self.artifact('b.box')})
+
+        manifest = build_cache.BuildManifest(self.path)
+        self.assertIsNotNone(manifest.lookup('a'))
+        self.assertIsNotNone(manifest.lookup('b'))
+
+    def test_rebuild_replaces_entry_of_same_path(self):
+        box = self.artifact('a.box')
+        build_cache.BuildManifest(self.path).record('old', {'box': box})
+        build_cache.BuildManifest(self.path).record('new', {'box': box})
+
+        manifest = build_cache.BuildManifest(self.path)
+        self.assertEqual(list(manifest.entries), ['new'])
+
+    def test_changed_artifact_misses(self):
+        box = self.artifact('a.box')
+        build_cache.BuildManifest(self.path).record('a', {'box': box})
+        self.artifact('a.box', b'other box')
+        self.assertIsNone(build_cache.BuildManifest(self.path).lookup('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
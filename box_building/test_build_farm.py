@@ -0,0 +1,39 @@
+import unittest
+
+import build_farm
+
+
+class FarmAdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.host_memory = build_farm.host_memory
+        # this host is almost out of memory
+        build_farm.host_memory = lambda: (8192, 1024)
+
+    def tearDown(self):
+        build_farm.host_memory = self.host_memory
+
+    def running_farm(self, **kwargs):
+        builds = [build_farm.Build('csr-%d.iso' % n, 65000 + n, '/tmp/csr-%d' % n, 4096)
+                  for n in range(3)]
+        farm = build_farm.Farm(builds, max_jobs=4, reserve=2048, **kwargs)
+        # whatever the CPUs of this host
+        farm.max_jobs = 4
+        builds[0].started = 1
+        return farm, builds
+
+    def test_live_memory_holds_back(self):
+        farm, builds = self.running_farm(host_total=None)
+        farm.budget = 16384
+        self.assertFalse(farm.can_admit(builds[1]))
+
+    def test_host_memory_override_plans_without_live_memory(self):
+        farm, builds = self.running_farm(host_total=32768)
+        self.assertTrue(farm.can_admit(builds[1]))
+        builds[1].started = 1
+        builds[2].memory = 32768
+        self.assertFalse(farm.can_admit(builds[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
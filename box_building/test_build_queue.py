@@ -0,0 +1,158 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import build_farm
+import build_queue
+
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue = build_queue.JobQueue(os.path.join(self.dir, 'queue.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def job(self, job_id):
+        return [j for j in self.queue.jobs() if j['id'] == job_id][0]
+
+
+class LeaseTest(QueueTest):
+
+    def test_oldest_job_first(self):
+        first = self.queue.submit('iosxe', '/isos/csr-1.iso')
+        second = self.queue.submit('nxos', '/boxes/nxosv-final.7.0.3.I7.1.box')
+        self.assertEqual(self.queue.lease('a')['id'], first)
+        self.assertEqual(self.queue.lease('b')['id'], second)
+        self.assertIsNone(self.queue.lease('c'))
+        self.assertEqual(self.job(second)['name'], 'nxos_7.0.3.I7.1')
+
+    def test_expired_lease_is_leased_again(self):
+        job_id = self.queue.submit('iosxe', '/isos/csr-1.iso')
+        self.queue.lease('a', lease_time=0.05)
+        self.assertIsNone(self.queue.lease('b'))
+        time.sleep(0.1)
+        self.assertEqual(self.queue.lease('b')['id'], job_id)
+        job = self.job(job_id)
+        self.assertEqual((job['worker'], job['attempts']), ('b', 2))
+        # the old worker has lost the job
+        self.assertFalse(self.queue.heartbeat(job_id, 'a'))
+
+    def test_expired_lease_without_attempts_fails(self):
+        job_id = self.queue.submit('iosxe', '/isos/csr-1.iso', max_attempts=1)
+        self.queue.lease('a', lease_time=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.queue.lease('b'))
+        self.assertEqual(self.job(job_id)['state'], 'failed')
+
+    def test_heartbeat_extends_lease(self):
+        job_id = self.queue.submit('iosxe', '/isos/csr-1.iso')
+        self.queue.lease('a', lease_time=0.05)
+        self.assertTrue(self.queue.heartbeat(job_id, 'a', lease_time=60))
+        time.sleep(0.1)
+        self.assertIsNone(self.queue.lease('b'))
+
+    def test_heartbeat_thread_notices_lost_lease(self):
+        job_id = self.queue.submit('iosxe', '/isos/csr-1.iso')
+        self.queue.lease('a', lease_time=0.05)
+        time.sleep(0.1)
+        self.queue.lease('b')
+        heartbeat = build_queue.Heartbeat(self.queue, job_id, 'a', interval=0.01)
+        heartbeat.start()
+        heartbeat.join(5)
+        self.assertTrue(heartbeat.lost)
+
+
+class FinishTest(QueueTest):
+
+    def test_failed_job_is_queued_while_it_has_attempts(self):
+        job_id = self.queue.submit('iosxe', '/isos/csr-1.iso', max_attempts=2)
+        self.queue.lease('a')
+        self.queue.finish(job_id, 'a', False, 'build failed')
+        self.assertEqual(self.job(job_id)['state'], 'queued')
+        self.assertEqual(self.queue.lease('b')['id'], job_id)
+        self.queue.finish(job_id, 'b', False, 'build failed')
+        self.assertEqual(self.job(job_id)['state'], 'failed')
+        self.assertEqual(self.queue.pending(), 0)
+
+    def test_finish_of_a_lost_job_is_ignored(self):
+        job_id = self.queue.submit('iosxe', '/isos/csr-1.iso')
+        self.queue.lease('a', lease_time=0.05)
+        time.sleep(0.1)
+        self.queue.lease('b')
+        self.queue.finish(job_id, 'a', True, '/boxes/a.box')
+        self.assertEqual(self.job(job_id)['state'], 'leased')
+
+
+class PublishTest(QueueTest):
+
+    def test_publish_renames_complete_box(self):
+        box = os.path.join(self.dir, 'built.box')
+        with open(box, 'wb') as f:
+            f.write(b'box' * 1000)
+        publish_dir = os.path.join(self.dir, 'published')
+        target = build_queue.publish(box, publish_dir, 'csr-1')
+        self.assertEqual(target, os.path.join(publish_dir, 'csr-1', 'csr-1.box'))
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'box' * 1000)
+        self.assertEqual(os.listdir(os.path.dirname(target)), ['csr-1.box'])
+
+
+class WorkTest(QueueTest):
+
+    def setUp(self):
+        super(WorkTest, self).setUp()
+        self.saved = (build_farm.run_build, build_farm.host_memory,
+                      build_farm.host_cpus, build_farm.SCHEDULE_INTERVAL)
+        build_farm.host_memory = lambda: (16384, 16384)
+        build_farm.host_cpus = lambda: 4
+        build_farm.SCHEDULE_INTERVAL = 0.05
+        build_farm.run_build = self.run_build
+        self.ports = []
+
+    def tearDown(self):
+        (build_farm.run_build, build_farm.host_memory,
+         build_farm.host_cpus, build_farm.SCHEDULE_INTERVAL) = self.saved
+        super(WorkTest, self).tearDown()
+
+    def run_build(self, build, builder_args):
+        # the first build of csr-bad.iso fails
+        self.ports.append(build.console_port)
+        build.started = time.time()
+        if not os.path.exists(build.build_dir):
+            os.makedirs(build.build_dir)
+        # long enough for the next build to start meanwhile
+        time.sleep(1.5)
+        failed = build.box + '.failed'
+        if 'bad' in build.iso and not os.path.exists(failed):
+            open(failed, 'w').close()
+            build.returncode = 1
+        else:
+            with open(build.box, 'w') as f:
+                f.write(build.iso)
+            build.returncode = 0
+        build.finished = time.time()
+
+    def test_worker_builds_and_publishes(self):
+        good = self.queue.submit('iosxe', '/isos/csr-good.iso')
+        bad = self.queue.submit('iosxe', '/isos/csr-bad.iso')
+        publish_dir = os.path.join(self.dir, 'published')
+        build_queue.work(self.queue, 'w', os.path.join(self.dir, 'work'),
+                         publish_dir, once=True, max_jobs=2, host_total=16384)
+
+        self.assertEqual(self.job(good)['state'], 'done')
+        self.assertEqual(self.job(good)['result'],
+                         os.path.join(publish_dir, 'csr-good', 'csr-good.box'))
+        # the failed build was queued again and built on the next attempt
+        self.assertEqual((self.job(bad)['state'], self.job(bad)['attempts']), ('done', 2))
+        self.assertTrue(os.path.exists(os.path.join(publish_dir, 'csr-bad', 'csr-bad.box')))
+        # builds running at the same time got their own console ports
+        self.assertNotEqual(self.ports[0], self.ports[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pexpect
+from pexpect import fdpexpect
+
+import console_dialog
+import console_sim
+import console_transport
+from console_dialog import Step
+
+PROMPT = r'[\w-]+(\([\w-]+\))?[#>]'
+
+CONFIG = [
+    ('console', ['enable', 'conf t']),
+    ('users', [
+        'hostname csr1kv',
+        'username vagrant priv 15 password vagrant',
+        'line vty 0 4',
+        'login local',
+        'exit',
+    ] + ['ip access-list extended lab-%d' % n for n in range(40)] + ['end']),
+]
+
+
+class SimulatorTest(unittest.TestCase):
+    """
+    A simulated CSR 1000v console, booted and at the exec prompt.
+    """
+
+    boot_repeat = 1
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        address = 'unix:' + os.path.join(self.dir, 'console')
+        self.server = console_sim.serve('iosxe', address, boot_repeat=self.boot_repeat)
+        self.child = console_transport.ConsoleSpawn(address, timeout=10)
+
+    def tearDown(self):
+        self.child.close()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def wake(self):
+        console_dialog.Dialog('test').run(self.child, [
+            Step('boot', console_sim.IosXeDevice.marker),
+            Step('wake console', send=''),
+            Step('exec prompt', PROMPT, nudge=1),
+        ])
+
+
+class RejectedLinesTest(unittest.TestCase):
+
+    def test_error_blamed_on_last_echo(self):
+        transcript = ('csr1kv(config)#hostname lab\r\n'
+                      'lab(config)#bogus command\r\n'
+                      '              ^\r\n'
+                      "% Invalid input detected at '^' marker.\r\n"
+                      'lab(config)#end\r\n')
+        self.assertEqual(
+            console_dialog.rejected_lines(transcript, ['hostname lab', 'bogus command', 'end']),
+            [('bogus command', "% Invalid input detected at '^' marker.")])
+
+    def test_clean_transcript(self):
+        transcript = 'csr1kv(config)#hostname lab\r\nlab(config)#end\r\nlab#'
+        self.assertEqual(console_dialog.rejected_lines(transcript, ['hostname lab', 'end']), [])
+
+
+class BulkPushTest(SimulatorTest):
+
+    def test_configures_device(self):
+        self.wake()
+        stats = console_dialog.bulk_push(self.child, CONFIG, PROMPT)
+        lines = sum(len(lines) for _, lines in CONFIG)
+        self.assertEqual(stats['lines'], lines)
+        self.assertEqual(stats['line_by_line'], 2 * lines)
+        self.assertLess(stats['round_trips'], lines)
+        device = self.server.device
+        self.assertEqual((device.hostname, device.modes, device.rejected), ('csr1kv', [], 0))
+        self.assertEqual(device.commands, lines)
+
+    def test_rejected_lines_fail(self):
+        self.wake()
+        console_dialog.bulk_push(self.child, CONFIG[:1], PROMPT)
+        self.server.device.error_rate = 1.0
+        with self.assertRaises(console_dialog.BulkPushError) as raised:
+            console_dialog.bulk_push(self.child, [('bad', ['hostname lab', 'end'])], PROMPT)
+        self.assertIn('hostname lab: % Invalid input', str(raised.exception))
+
+
+class ExpectWindowTest(SimulatorTest):
+
+    boot_repeat = 50
+
+    def test_marker_after_long_boot(self):
+        marker = console_sim.IosXeDevice.marker
+        self.assertEqual(console_dialog.expect_window(self.child, [marker], window=256), 0)
+        self.assertEqual(self.child.after, marker.encode('utf-8'))
+        # older output went a line at a time
+        longest = max(len(line) for line in self.server.transcript) + 2
+        self.assertLessEqual(len(self.child.before), 256 + longest)
+        # the output after the marker is still there for the next step
+        self.assertEqual(self.child.expect(r'Press RETURN to get started'), 0)
+
+    def test_timeout_keeps_output(self):
+        marker = console_sim.IosXeDevice.marker
+        with self.assertRaises(pexpect.TIMEOUT):
+            console_dialog.expect_window(self.child, [r'no such marker'], timeout=0.5)
+        self.assertEqual(console_dialog.expect_window(self.child, [marker]), 0)
+
+    def test_marker_split_across_reads(self):
+        read, write = os.pipe()
+        child = fdpexpect.fdspawn(read, timeout=5)
+
+        def later():
+            time.sleep(0.2)
+            os.write(write, b'GDOI is OFF\r\nPress RETURN')
+        os.write(write, b'boot line\r\n' * 100 + b'%CRYPTO-6-GDOI_ON_OFF: ')
+        thread = threading.Thread(target=later)
+        thread.start()
+        try:
+            index = console_dialog.expect_window(
+                child, [r'no such marker', r'CRYPTO-6-GDOI_ON_OFF: GDOI is OFF'], window=64)
+        finally:
+            thread.join()
+            os.close(write)
+            child.close()
+        self.assertEqual(index, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
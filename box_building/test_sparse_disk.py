@@ -0,0 +1,126 @@
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+
+import sparse_disk
+from box_bench import make_test_vdi
+
+
+def disk_grains(path):
+    reader = sparse_disk.open_disk(path)
+    try:
+        return reader.size, dict(sparse_disk.grains(reader))
+    finally:
+        reader.close()
+
+
+def qcow2_grains(path):
+    """
+    Read a qcow2 image: return its size, its non-zero clusters by offset
+    and the refcount of every cluster in the file.
+    """
+
+    offset_mask = 0x00fffffffffffe00
+    with open(path, 'rb') as f:
+        (magic, version, _, _, cluster_bits, size, _, l1_size, l1_offset,
+         refcount_offset, refcount_clusters, _, _) = sparse_disk.QCOW2_HEADER.unpack(
+             f.read(sparse_disk.QCOW2_HEADER.size))
+        assert (magic, version) == (sparse_disk.QCOW2_MAGIC, 2)
+        cluster = 1 << cluster_bits
+        l2_entries = cluster // 8
+        f.seek(l1_offset)
+        l1 = struct.unpack('>%dQ' % l1_size, f.read(8 * l1_size))
+        grains = {}
+        for index, l2_offset in enumerate(l1):
+            if not l2_offset:
+                continue
+            f.seek(l2_offset & offset_mask)
+            l2 = struct.unpack('>%dQ' % l2_entries, f.read(cluster))
+            for number, data_offset in enumerate(l2):
+                if data_offset:
+                    f.seek(data_offset & offset_mask)
+                    grains[(index * l2_entries + number) * cluster] = f.read(cluster)
+        f.seek(refcount_offset)
+        blocks = [b for b in struct.unpack('>%dQ' % (refcount_clusters * l2_entries),
+                                           f.read(refcount_clusters * cluster)) if b]
+        refcounts = []
+        for block in blocks:
+            f.seek(block)
+            refcounts.extend(struct.unpack('>%dH' % (cluster // 2), f.read(cluster)))
+        f.seek(0, os.SEEK_END)
+        clusters = f.tell() // cluster
+    return size, grains, refcounts[:clusters], clusters
+
+
+class SparseDiskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vdi = os.path.join(self.dir, 'disk.vdi')
+        # 64 MB disk, 8 MB allocated, a quarter of that zeroed
+        make_test_vdi(self.vdi, 64, 8)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class VMDKTest(SparseDiskTest):
+
+    def test_vmdk_round_trip(self):
+        vmdk = os.path.join(self.dir, 'disk.vmdk')
+        with open(vmdk, 'wb') as f:
+            stats = sparse_disk.export_vmdk(self.vdi, f, threads=2, name='disk.vmdk')
+
+        size, grains = disk_grains(self.vdi)
+        self.assertEqual(disk_grains(vmdk), (size, grains))
+        self.assertEqual(stats, {'logical': 64 * 1024 ** 2, 'allocated': 8 * 1024 ** 2,
+                                 'data': 6 * 1024 ** 2})
+        # zero and unallocated blocks aren't in the VMDK
+        self.assertLess(os.path.getsize(vmdk), 6 * 1024 ** 2)
+
+    def test_vmdk_descriptor(self):
+        vmdk = os.path.join(self.dir, 'disk.vmdk')
+        with open(vmdk, 'wb') as f:
+            sparse_disk.export_vmdk(self.vdi, f, name='box-disk001.vmdk')
+        with open(vmdk, 'rb') as f:
+            head = f.read(4096)
+        self.assertIn(b'createType="streamOptimized"', head)
+        self.assertIn(b'RW 131072 SPARSE "box-disk001.vmdk"', head)
+
+    def test_not_a_disk(self):
+        other = os.path.join(self.dir, 'other.img')
+        with open(other, 'wb') as f:
+            f.write(b'\x00' * 4096)
+        with self.assertRaises(sparse_disk.DiskError):
+            sparse_disk.open_disk(other)
+
+
+class Qcow2Test(SparseDiskTest):
+
+    def test_qcow2_round_trip(self):
+        qcow2 = os.path.join(self.dir, 'disk.qcow2')
+        with open(qcow2, 'wb') as f:
+            sparse_disk.export_disk(self.vdi, qcow2=f, threads=2)
+
+        size, grains = disk_grains(self.vdi)
+        qcow2_size, qcow2_data, refcounts, clusters = qcow2_grains(qcow2)
+        self.assertEqual((qcow2_size, qcow2_data), (size, grains))
+        # every cluster of the file is in use exactly once
+        self.assertEqual(refcounts, [1] * clusters)
+
+    def test_vmdk_and_qcow2_from_one_read(self):
+        vmdk = os.path.join(self.dir, 'disk.vmdk')
+        qcow2 = os.path.join(self.dir, 'disk.qcow2')
+        with open(vmdk, 'wb') as v, open(qcow2, 'wb') as q:
+            stats = sparse_disk.export_disk(self.vdi, v, q, threads=2)
+
+        size, grains = disk_grains(self.vdi)
+        self.assertEqual(disk_grains(vmdk), (size, grains))
+        self.assertEqual(qcow2_grains(qcow2)[:2], (size, grains))
+        self.assertEqual(stats['data'], sum(len(g) for g in grains.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+import vboxmanage
+
+
+class FakeConstants(object):
+    VBoxEventType_OnMachineStateChanged = 32
+
+    # MachineState of the VirtualBox API, with its range markers
+    MachineState = {
+        'Null': 0, 'PoweredOff': 1, 'Saved': 2, 'Teleported': 3, 'Aborted': 4,
+        'Running': 5, 'Paused': 6, 'Stuck': 7, 'Teleporting': 8,
+        'LiveSnapshotting': 9, 'Starting': 10, 'Stopping': 11, 'Saving': 12,
+        'Restoring': 13, 'TeleportingPausedVM': 14, 'TeleportingIn': 15,
+        'DeletingSnapshotOnline': 17, 'DeletingSnapshotPaused': 18,
+        'FirstOnline': 5, 'LastOnline': 18, 'FirstTransient': 8,
+        'LastTransient': 24,
+    }
+
+    def all_values(self, enum):
+        return dict(getattr(self, enum))
+
+
+class FakeMachine(object):
+    def __init__(self, state):
+        self.state = state
+
+
+class FakeSource(object):
+    def createListener(self):
+        return object()
+
+    def registerListener(self, listener, events, active):
+        pass
+
+
+class FakeVirtualBox(object):
+    def __init__(self):
+        self.eventSource = FakeSource()
+        self.machines = {}
+
+    def findMachine(self, vmname):
+        return self.machines[vmname]
+
+
+class FakeManager(object):
+    def __init__(self):
+        self.constants = FakeConstants()
+        self.vbox = FakeVirtualBox()
+
+    def getVirtualBox(self):
+        return self.vbox
+
+
+class MachineStateEventsTest(unittest.TestCase):
+
+    def state(self, name):
+        manager = FakeManager()
+        manager.vbox.machines['csr'] = FakeMachine(FakeConstants.MachineState[name])
+        return vboxmanage._MachineStateEvents(manager).state('csr')
+
+    def test_stopped_states(self):
+        for name in ('PoweredOff', 'Aborted', 'Saved'):
+            self.assertIn(self.state(name), vboxmanage.STOPPED)
+
+    def test_running_state(self):
+        self.assertIn(self.state('Running'), vboxmanage.RUNNING)
+
+    def test_showvminfo_names(self):
+        self.assertEqual(self.state('PoweredOff'), 'poweroff')
+        self.assertEqual(self.state('Stuck'), 'gurumeditation')
+        self.assertEqual(self.state('Teleporting'), 'teleporting')
+        self.assertEqual(self.state('DeletingSnapshotPaused'),
+                         'deletingsnapshotlivepaused')
+
+    def test_unregistered(self):
+        manager = FakeManager()
+        manager.vbox.findMachine = lambda vmname: 1 / 0
+        self.assertIsNone(vboxmanage._MachineStateEvents(manager).state('csr'))
+
+
+if __name__ == '__main__':
+    unittest.main()
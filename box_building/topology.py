@@ -0,0 +1,746 @@
+#!/usr/bin/env python
+'''
+Bring up a multi-node lab topology from linked clones of one base VM.
+
+The multi-node Vagrantfiles of the labs (e.g. lab/hands_on_2 and
+nx-os/multinode_ansible_provisioning) import the box once per node, copying
+its multi GB disk every time, and "vagrant up" boots the nodes one after
+another.  This launcher reads the same topology from a JSON file:
+
+    {
+      "name": "hands_on_2",
+      "nodes": [
+        {"name": "iosxe1", "box": "iosxe/16.06.02",
+         "intnets": ["link1", "hosts1"]},
+        {"name": "iosxe2", "box": "iosxe/16.06.02",
+         "intnets": ["link1", "hosts2"],
+         "memory": 4096, "ports": {"22": 3222, "830": 3230}}
+      ]
+    }
+
+and brings it up as follows:
+
+  . every box is imported into VirtualBox once, as base VM
+    topology-base-<box>-<version>, and snapshotted; the base VM is kept
+    and shared by all topologies using the box
+  . every node is a linked clone of the base snapshot: its disk is a
+    differencing image that only holds what the node writes, and it gets
+    new MAC addresses
+  . NIC 1 is NAT with the forwarded ports of the node (guest port 22 on a
+    free port unless given; the forwards of the embedded Vagrantfile of
+    the box don't apply), NIC 2, 3, ... are on the internal networks
+    in the order listed, serial port 1 is a console socket
+    /tmp/<topology>-<node>.console (see console_transport.py)
+  . all nodes are started at once, then the management plane of each
+    node is polled until it answers with an SSH banner
+
+A box is either the name of a box installed with "vagrant box add" (its
+newest version) or a .box file.
+
+Once all nodes are up (or --timeout has passed) a table shows when each
+node became reachable, and the time to the complete topology and the disk
+space of its VMs are compared with the last run of the same topology with
+--vagrant, which brings it up from a generated Vagrantfile with "vagrant
+up" instead.
+
+E.g.:
+    python topology.py up topologies/hands_on_2.json
+    python topology.py down topologies/hands_on_2.json
+    python topology.py up --vagrant topologies/hands_on_2.json
+    python topology.py down --vagrant topologies/hands_on_2.json
+'''
+
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import logging
+import textwrap
+
+import vboxmanage
+import box_packer
+import box_catalog
+import disk_cache
+import build_trace
+
+logger = logging.getLogger(__name__)
+
+# Folder of the base VMs and of the clones, one subfolder per topology
+DEFAULT_BASE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                'vagrant_net_prog', 'topologies')
+
+# Snapshot of the base VM the nodes are cloned from
+BASE_SNAPSHOT = 'base'
+
+# Seconds from the start until every node has to be reachable
+BOOT_TIMEOUT = 900
+
+# Seconds to wait for the SSH banner of a single connection attempt
+BANNER_TIMEOUT = 5
+
+# NICs of a VirtualBox VM, the first one is NAT
+MAX_NICS = 8
+
+# Names of the forwarded ports, as the lab Vagrantfiles call them (the
+# forwards of the embedded Vagrantfile of the box are replaced by name)
+FORWARD_NAMES = {22: 'ssh', 80: 'http', 443: 'https', 830: 'netconf'}
+
+VAGRANTFILE = '''# -*- mode: ruby -*-
+# vi: set ft=ruby :
+# Generated by topology.py from {source}
+Vagrant.configure("2") do |config|
+  config.vm.synced_folder '.', '/vagrant', disabled: true
+{nodes}end
+'''
+
+VAGRANT_NODE = '''
+  config.vm.define "{name}" do |node|
+    node.vm.box = "{box}"
+{networks}    node.vm.provider "virtualbox" do |vb|
+{provider}      vb.customize ['modifyvm', :id, '--uart1', '0x3F8', 4, '--uartmode1', 'disconnected']
+    end
+  end
+'''
+
+
+class TopologyError(Exception):
+    pass
+
+
+def run(cmd, hide_error=False, cont_on_error=False, cwd=None):
+    """
+    Run command to execute CLI and catch errors and display them whether
+    in verbose mode or not.
+
+    Allow the ability to hide errors and also to continue on errors.
+    """
+
+    s_cmd = ' '.join(cmd)
+    logger.info("'%s'", s_cmd)
+
+    with build_trace.span(' '.join(cmd[:2]), 'run', cmd=s_cmd):
+        output = subprocess.Popen(cmd, cwd=cwd,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        tup_output = output.communicate()
+
+    if output.returncode != 0:
+        logger.error('Failed (%d):', output.returncode)
+    else:
+        logger.debug('Succeeded (%d):', output.returncode)
+
+    logger.debug('Output [%s]' % tup_output[0])
+
+    if not hide_error and 0 != output.returncode:
+        logger.error('Error [%s]' % tup_output[1])
+        if not cont_on_error:
+            sys.exit('Quitting due to run command error')
+        else:
+            logger.debug(
+                'Continuing despite error cont_on_error=%d', cont_on_error)
+
+    return tup_output[0]
+
+
+class Node(object):
+    """
+    A node of the topology and how far it got.
+    """
+
+    def __init__(self, topology, name, box, intnets=(), memory=None,
+                 ports=None, nic_type=None):
+        self.name = name
+        self.box = box
+        self.intnets = list(intnets)
+        self.memory = memory
+        # guest port -> host port
+        self.ports = dict((int(guest), int(host))
+                          for guest, host in (ports or {}).items())
+        self.nic_type = nic_type
+        self.vmname = '%s-%s' % (topology, name)
+        self.console_socket = os.path.join(tempfile.gettempdir(),
+                                           self.vmname + '.console')
+        self.ssh_port = self.ports.get(22)
+        self.up = None
+        self.error = None
+
+
+class Topology(object):
+    """
+    Nodes of a topology file.
+    """
+
+    def __init__(self, name, nodes, source=None):
+        self.name = name
+        self.nodes = nodes
+        self.source = source
+
+    def boxes(self):
+        boxes = []
+        for node in self.nodes:
+            if node.box not in boxes:
+                boxes.append(node.box)
+        return boxes
+
+
+def load(path):
+    """
+    Read and check a topology file.
+    """
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise TopologyError('%s: %s' % (path, e))
+
+    name = data.get('name') or os.path.splitext(os.path.basename(path))[0]
+    if not re.match(r'^[\w.-]+$', name):
+        raise TopologyError('%s: invalid topology name %r' % (path, name))
+    if not data.get('nodes'):
+        raise TopologyError('%s: no nodes' % path)
+
+    nodes = []
+    for entry in data['nodes']:
+        node_name = entry.get('name', '')
+        if not re.match(r'^[\w.-]+$', node_name):
+            raise TopologyError('%s: invalid node name %r' % (path, node_name))
+        if node_name in [node.name for node in nodes]:
+            raise TopologyError('%s: node %s defined twice' % (path, node_name))
+        if not entry.get('box'):
+            raise TopologyError('%s: node %s has no box' % (path, node_name))
+        unknown = set(entry) - set(['name', 'box', 'intnets', 'memory', 'ports',
+                                    'nic_type'])
+        if unknown:
+            raise TopologyError('%s: node %s: unknown %s' % (
+                path, node_name, ', '.join(sorted(unknown))))
+        if len(entry.get('intnets', [])) > MAX_NICS - 1:
+            raise TopologyError('%s: node %s: at most %d internal networks' % (
+                path, node_name, MAX_NICS - 1))
+        try:
+            nodes.append(Node(name, node_name, entry['box'],
+                              entry.get('intnets', []), entry.get('memory'),
+                              entry.get('ports'), entry.get('nic_type')))
+        except (TypeError, ValueError, AttributeError):
+            raise TopologyError('%s: node %s: ports must map guest to host ports'
+                                % (path, node_name))
+
+    hosts = [port for node in nodes for port in node.ports.values()]
+    if len(set(hosts)) != len(hosts):
+        raise TopologyError('%s: host ports forwarded more than once' % path)
+    return Topology(name, nodes, os.path.abspath(path))
+
+
+def forward_name(guest):
+    return FORWARD_NAMES.get(guest, 'tcp%d' % guest)
+
+
+def free_port():
+    """
+    Return a TCP port on localhost that is free right now.
+    """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def vagrant_home():
+    return os.environ.get('VAGRANT_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.vagrant.d')
+
+
+def installed_box(box):
+    """
+    Return (version, folder) of the newest installed version of a Vagrant
+    box, or None.
+    """
+
+    directory = os.path.join(vagrant_home(), 'boxes',
+                             box.replace('/', '-VAGRANTSLASH-'))
+    if not os.path.isdir(directory):
+        return None
+    versions = [version for version in os.listdir(directory)
+                if os.path.isdir(os.path.join(directory, version, 'virtualbox'))]
+    if not versions:
+        return None
+    version = max(versions, key=box_catalog.version_key)
+    return version, os.path.join(directory, version, 'virtualbox')
+
+
+def base_name(box):
+    """
+    Name of the base VM of a box: topology-base-<box>-<version>, or
+    topology-base-<file name>-<mtime> for a .box file.
+    """
+
+    if box.endswith('.box'):
+        label = '%s-%x' % (os.path.basename(box)[:-4], int(os.path.getmtime(box)))
+    else:
+        label = '%s-%s' % (box, installed_box(box)[0])
+    return 'topology-base-' + re.sub(r'[^\w.-]+', '_', label)
+
+
+def base_vm(box, base_dir):
+    """
+    Import the box as base VM and snapshot it, unless that was done before.
+    Return the name of the base VM.
+    """
+
+    if box.endswith('.box'):
+        if not os.path.isfile(box):
+            sys.exit('Box file %s not found.' % box)
+    elif installed_box(box) is None:
+        sys.exit("Box '%s' isn't installed, add it with 'vagrant box add' or "
+                 "use the .box file." % box)
+
+    vmname = base_name(box)
+    info = vboxmanage.showvminfo(vmname, run)
+    if not info:
+        logger.warn('Importing %s as %s', box, vmname)
+        if not box.endswith('.box'):
+            ovfs = [name for name in os.listdir(installed_box(box)[1])
+                    if name.endswith('.ovf')]
+            if len(ovfs) != 1:
+                sys.exit("Box '%s': expected one OVF, found %s" % (box, ovfs or 'none'))
+            run(['VBoxManage', 'import', os.path.join(installed_box(box)[1], ovfs[0]),
+                 '--vsys', '0', '--vmname', vmname, '--basefolder', base_dir])
+        else:
+            unpack_dir = tempfile.mkdtemp(prefix='unpack_', dir=base_dir)
+            try:
+                try:
+                    ovf = box_packer.unpack(box, unpack_dir)
+                except box_packer.PackError as e:
+                    sys.exit(str(e))
+                run(['VBoxManage', 'import', ovf, '--vsys', '0', '--vmname', vmname,
+                     '--basefolder', base_dir])
+            finally:
+                # the import copied the disk into the VM folder
+                shutil.rmtree(unpack_dir)
+        info = vboxmanage.showvminfo(vmname, run)
+
+    if BASE_SNAPSHOT not in [value for key, value in info.items()
+                             if key.startswith('SnapshotName')]:
+        run(['VBoxManage', 'snapshot', vmname, 'take', BASE_SNAPSHOT])
+    return vmname
+
+
+def remove_vm(vmname, console_socket=None):
+    """
+    Power off and delete a VM, if it's there, and its console socket.
+    """
+
+    state = vboxmanage.vm_state(vmname, run)
+    if state is not None and state not in vboxmanage.STOPPED:
+        logger.debug("'%s' is %s, powering off...", vmname, state)
+        run(['VBoxManage', 'controlvm', vmname, 'poweroff'], cont_on_error=True)
+        try:
+            vboxmanage.wait_for_state(vmname, vboxmanage.STOPPED, run)
+        except vboxmanage.StateTimeout as e:
+            sys.exit(str(e))
+    if state is not None:
+        run(['VBoxManage', 'unregistervm', vmname, '--delete'])
+    if console_socket and os.path.exists(console_socket):
+        os.remove(console_socket)
+
+
+def clone_node(node, base, clone_dir):
+    """
+    Create the VM of node as linked clone of the base snapshot.
+    """
+
+    remove_vm(node.vmname, node.console_socket)
+    run(['VBoxManage', 'clonevm', base, '--snapshot', BASE_SNAPSHOT,
+         '--options', 'link', '--name', node.vmname, '--basefolder', clone_dir,
+         '--register'])
+
+    spec = vboxmanage.VMSpec(node.vmname)
+    if node.memory:
+        spec.modify('--memory', node.memory)
+    spec.modify('--nic1', 'nat')
+    for number, intnet in enumerate(node.intnets, 2):
+        spec.modify('--nic%d' % number, 'intnet')
+        spec.modify('--intnet%d' % number, intnet)
+    if node.nic_type:
+        for number in range(1, len(node.intnets) + 2):
+            spec.modify('--nictype%d' % number, node.nic_type)
+    spec.modify('--uart1', '0x3f8', 4)
+    spec.modify('--uartmode1', 'server', node.console_socket)
+    if node.ssh_port is None:
+        node.ssh_port = free_port()
+        node.ports[22] = node.ssh_port
+    for guest, host in sorted(node.ports.items()):
+        spec.forward(forward_name(guest), host, guest)
+    # the box may come with forwards of its own, e.g. from its build
+    spec.apply(run)
+
+
+def ssh_banner(port, timeout=BANNER_TIMEOUT):
+    """
+    Check that an SSH server answers on localhost:port.
+
+    The NAT of VirtualBox accepts connections to a forwarded port as soon as
+    the VM runs, so only the banner shows that the guest is listening.
+    """
+
+    try:
+        s = socket.create_connection(('127.0.0.1', port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        return s.recv(64).startswith(b'SSH-')
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        s.close()
+
+
+def wait_reachable(node, start, deadline, port=None):
+    """
+    Poll the SSH port of node until it answers or deadline has passed, and
+    record the seconds since start in node.up.
+
+    port is a function returning the SSH port, or None while it isn't known
+    yet; by default node.ssh_port.
+    """
+
+    schedule = vboxmanage.backoff(initial=1, maximum=3)
+    while node.error is None:
+        current = port() if port else node.ssh_port
+        if current is not None:
+            node.ssh_port = current
+            if ssh_banner(current):
+                node.up = time.time() - start
+                logger.warn('%s is up after %d s', node.name, node.up)
+                return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            node.error = 'not reachable'
+            logger.error('%s not reachable after %d s', node.name, time.time() - start)
+            return
+        time.sleep(min(remaining, next(schedule)))
+
+
+def in_parallel(function, nodes, *args):
+    """
+    Run function(node, *args) for all nodes at once.  A node whose function
+    quits records why in node.error.
+    """
+
+    def call(node):
+        try:
+            function(node, *args)
+        except SystemExit as e:
+            node.error = str(e.code)
+
+    threads = [threading.Thread(target=call, args=(node,), name=node.name)
+               for node in nodes]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+
+def start_node(node):
+    run(['VBoxManage', 'startvm', node.vmname, '--type', 'headless'])
+
+
+def allocated(path):
+    """
+    Disk space taken by a file (sparse and dynamic files only count what
+    is written).
+    """
+
+    st = os.stat(path)
+    if hasattr(st, 'st_blocks'):
+        return st.st_blocks * 512
+    return st.st_size
+
+
+def vm_disk_usage(vmname):
+    """
+    Return the disk space of the VM folder: its disks, snapshots and logs.
+    """
+
+    info = vboxmanage.showvminfo(vmname, run)
+    if 'CfgFile' not in info:
+        return 0
+    total = 0
+    for root, _, files in os.walk(os.path.dirname(info['CfgFile'])):
+        for name in files:
+            total += allocated(os.path.join(root, name))
+    return total
+
+
+def topology_dir(topology, base_dir):
+    return os.path.join(base_dir, topology.name)
+
+
+def up_linked(topology, base_dir, timeout=BOOT_TIMEOUT, wait=True):
+    """
+    Bring the topology up from linked clones, return the result.
+    """
+
+    start = time.time()
+    build_trace.phase('base')
+    bases = dict((box, base_vm(box, base_dir)) for box in topology.boxes())
+    cloned = time.time()
+
+    build_trace.phase('clone')
+    clone_dir = topology_dir(topology, base_dir)
+    for node in topology.nodes:
+        logger.warn('Cloning %s from %s', node.vmname, bases[node.box])
+        clone_node(node, bases[node.box], clone_dir)
+    started = time.time()
+
+    build_trace.phase('boot')
+    in_parallel(start_node, topology.nodes)
+    if wait:
+        in_parallel(wait_reachable, topology.nodes, start, start + timeout)
+    finished = time.time()
+
+    usage = sum(vm_disk_usage(vmname) for vmname in bases.values()) + \
+        sum(vm_disk_usage(node.vmname) for node in topology.nodes)
+    return {
+        'mode': 'linked',
+        'seconds': finished - start,
+        'phases': [['base', cloned - start], ['clone', started - cloned],
+                   ['boot', finished - started]],
+        'disk': usage,
+        'nodes': dict((node.name, node.up) for node in topology.nodes),
+    }
+
+
+def vagrantfile(topology):
+    """
+    Return a Vagrantfile for the topology, laid out like the ones of the
+    labs.
+    """
+
+    nodes = []
+    for node in topology.nodes:
+        networks = ''
+        for intnet in node.intnets:
+            networks += ('    node.vm.network :private_network, virtualbox__intnet: '
+                         '"%s", auto_config: false\n' % intnet)
+        for guest, host in sorted(node.ports.items()):
+            networks += ("    node.vm.network :forwarded_port, guest: %d, host: %d, "
+                         "id: '%s'\n" % (guest, host, forward_name(guest)))
+        provider = ''
+        if node.memory:
+            provider += '      vb.memory = "%d"\n' % node.memory
+        if node.nic_type:
+            for number in range(1, len(node.intnets) + 2):
+                provider += ("      vb.customize ['modifyvm', :id, '--nictype%d', '%s']\n"
+                             % (number, node.nic_type))
+        nodes.append(VAGRANT_NODE.format(name=node.name, box=node.box,
+                                         networks=networks, provider=provider))
+    return VAGRANTFILE.format(source=topology.source, nodes=''.join(nodes))
+
+
+def vagrant_vm(vagrant_dir, node):
+    """
+    Return the UUID of the VM vagrant created for node, or None.
+    """
+
+    path = os.path.join(vagrant_dir, '.vagrant', 'machines', node.name,
+                        'virtualbox', 'id')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip() or None
+
+
+def vagrant_ssh_port(vagrant_dir, node):
+    """
+    Return the host port vagrant forwards to guest port 22 of node, or None
+    while the VM isn't there yet.
+    """
+
+    vm = vagrant_vm(vagrant_dir, node)
+    if vm is None:
+        return None
+    info = vboxmanage.showvminfo(vm, run)
+    if info.get('VMState') not in vboxmanage.RUNNING:
+        return None
+    for key, value in info.items():
+        fields = value.split(',')
+        if key.startswith('Forwarding(') and len(fields) == 6 and fields[5] == '22':
+            return int(fields[3])
+    return None
+
+
+def up_vagrant(topology, base_dir, timeout=BOOT_TIMEOUT, wait=True):
+    """
+    Bring the topology up with "vagrant up", return the result.
+    """
+
+    vagrant_dir = os.path.join(topology_dir(topology, base_dir), 'vagrant')
+    if not os.path.exists(vagrant_dir):
+        os.makedirs(vagrant_dir)
+    with open(os.path.join(vagrant_dir, 'Vagrantfile'), 'w') as f:
+        f.write(vagrantfile(topology))
+
+    start = time.time()
+    build_trace.phase('vagrant up')
+    waiting = []
+    if wait:
+        # poll every node while vagrant brings up the others
+        waiting = [threading.Thread(target=wait_reachable, name=node.name,
+                                    args=(node, start, start + timeout,
+                                          lambda node=node: vagrant_ssh_port(vagrant_dir, node)))
+                   for node in topology.nodes]
+        for t in waiting:
+            t.daemon = True
+            t.start()
+    logger.warn('Running vagrant up in %s', vagrant_dir)
+    # vagrant fails the nodes whose guest it can't log into
+    run(['vagrant', 'up'], cont_on_error=True, cwd=vagrant_dir)
+    for t in waiting:
+        while t.is_alive():
+            t.join(1)
+    finished = time.time()
+
+    for node in topology.nodes:
+        if vagrant_vm(vagrant_dir, node) is None:
+            node.error = 'not created'
+    usage = sum(vm_disk_usage(vagrant_vm(vagrant_dir, node)) for node in topology.nodes
+                if vagrant_vm(vagrant_dir, node))
+    return {
+        'mode': 'vagrant',
+        'seconds': finished - start,
+        'phases': [['vagrant up', finished - start]],
+        'disk': usage,
+        'nodes': dict((node.name, node.up) for node in topology.nodes),
+    }
+
+
+def down(topology, base_dir, vagrant=False):
+    """
+    Delete the VMs of the topology; the base VMs are kept for the next
+    topology.
+    """
+
+    if vagrant:
+        vagrant_dir = os.path.join(topology_dir(topology, base_dir), 'vagrant')
+        if os.path.exists(os.path.join(vagrant_dir, 'Vagrantfile')):
+            run(['vagrant', 'destroy', '-f'], cwd=vagrant_dir)
+        return
+    for node in topology.nodes:
+        logger.warn('Deleting %s', node.vmname)
+        remove_vm(node.vmname, node.console_socket)
+
+
+def result_path(topology, base_dir, mode):
+    return os.path.join(topology_dir(topology, base_dir), mode + '-result.json')
+
+
+def report(topology, result, other=None):
+    """
+    Print when each node was up, and the totals next to those of the other
+    mode.
+    """
+
+    width = max([len('NODE')] + [len(node.name) for node in topology.nodes])
+    print()
+    print('%-*s  %-6s  %8s  %s' % (width, 'NODE', 'SSH', 'UP', 'CONSOLE'))
+    for node in topology.nodes:
+        up = '%7ds' % node.up if node.up is not None else (node.error or 'started')
+        console = 'unix:' + node.console_socket if result['mode'] == 'linked' else '-'
+        print('%-*s  %-6s  %8s  %s' % (width, node.name, node.ssh_port or '-',
+                                        up, console))
+    print()
+    phases = ', '.join('%s %d s' % (name, seconds) for name, seconds in result['phases'])
+    print('%s: %d s (%s), %s of disk' % (result['mode'], result['seconds'], phases,
+                                         disk_cache.format_size(result['disk'])))
+    if other:
+        print('%s: %d s, %s of disk (%s)' % (
+            other['mode'], other['seconds'], disk_cache.format_size(other['disk']),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(other['time']))))
+    print()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+            Bring up a lab topology from linked clones of one base VM per box.
+
+            All nodes boot at once, each is reported once its SSH answers.
+        '''),
+        epilog=textwrap.dedent('''\
+            E.g.:
+                %(prog)s up topologies/hands_on_2.json
+                %(prog)s down topologies/hands_on_2.json
+        '''))
+    parser.add_argument('ACTION', choices=['up', 'down'])
+    parser.add_argument('TOPOLOGY', help='topology file (JSON)')
+    parser.add_argument('-b', '--base-dir', default=DEFAULT_BASE_DIR,
+                        help='folder for base VMs and clones (default: %(default)s)')
+    parser.add_argument('--vagrant', action='store_true',
+                        help='use a generated Vagrantfile and vagrant up instead, '
+                        'to compare')
+    parser.add_argument('-t', '--timeout', type=int, default=BOOT_TIMEOUT,
+                        help='seconds until all nodes must be reachable (default: %(default)s)')
+    parser.add_argument('--no-wait', action='store_true',
+                        help="start the nodes, but don't wait for SSH")
+    parser.add_argument('--trace',
+                        help='write a build trace (see build_trace.py) to this file')
+    parser.add_argument('-v', '--verbose',
+                        action='store_const', const=logging.INFO,
+                        default=logging.WARN, help='turn on verbose messages')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.verbose, format="==> %(message)s")
+
+    try:
+        topology = load(args.TOPOLOGY)
+    except TopologyError as e:
+        sys.exit(str(e))
+    base_dir = os.path.abspath(args.base_dir)
+    if not os.path.exists(topology_dir(topology, base_dir)):
+        os.makedirs(topology_dir(topology, base_dir))
+
+    if args.ACTION == 'down':
+        down(topology, base_dir, args.vagrant)
+        return
+
+    tracer = build_trace.start(topology.name) if args.trace else None
+    try:
+        if args.vagrant:
+            result = up_vagrant(topology, base_dir, args.timeout, not args.no_wait)
+        else:
+            result = up_linked(topology, base_dir, args.timeout, not args.no_wait)
+    finally:
+        if tracer is not None:
+            tracer.write(args.trace)
+
+    result['time'] = time.time()
+    with open(result_path(topology, base_dir, result['mode']), 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    other = result_path(topology, base_dir, 'linked' if args.vagrant else 'vagrant')
+    if os.path.exists(other):
+        with open(other) as f:
+            other = json.load(f)
+    else:
+        other = None
+    report(topology, result, other)
+
+    if any(node.error for node in topology.nodes):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
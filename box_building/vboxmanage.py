@@ -0,0 +1,342 @@
+'''
+Helpers around VBoxManage shared by the box building scripts.
+
+VMSpec collects the desired settings of a VM and turns them into as few
+VBoxManage calls as possible: one createvm that also registers the VM, one
+modifyvm carrying every changed flag and NAT port forward, and one call per storage controller
+and attachment (VBoxManage can't combine those).  Against an existing VM the
+settings are compared with "showvminfo --machinereadable" first, so settings
+that are already in place are skipped.
+
+wait_for_state() waits for VM power state changes without busy polling.
+
+All functions take the run() of the calling script, so errors are handled
+and logged the same way as for every other command.
+'''
+
+import os
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _text(output):
+    """
+    run() hands back bytes on Python 3.
+    """
+
+    if isinstance(output, bytes):
+        return output.decode('utf-8', 'replace')
+    return output
+
+
+def parse_machinereadable(output):
+    """
+    Parse "showvminfo --machinereadable" output into a dict.
+
+    Keys and values are unquoted, e.g. '"IDE_Controller-0-0"="/x.vdi"'
+    becomes {'IDE_Controller-0-0': '/x.vdi'}.
+    """
+
+    info = {}
+    for line in _text(output).splitlines():
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        info[key.strip().strip('"')] = value.strip().strip('"')
+    return info
+
+
+def showvminfo(vmname, run):
+    """
+    Return the machine readable VM info, or {} if the VM doesn't exist.
+    """
+
+    return parse_machinereadable(
+        run(['VBoxManage', 'showvminfo', vmname, '--machinereadable'],
+            hide_error=True))
+
+
+def _normalize(key, values):
+    """
+    Bring a modifyvm value into the form showvminfo reports it in.
+    """
+
+    value = ','.join(str(v) for v in values).lower()
+    if key.startswith('uart') and not key.startswith('uartmode') and value != 'off':
+        # --uart1 0x3f8 4 shows up as uart1="0x03f8,4"
+        base, irq = value.split(',')
+        value = '0x%04x,%s' % (int(base, 16), irq)
+    return value
+
+
+class VMSpec(object):
+    """
+    Desired configuration of a VirtualBox VM.
+    """
+
+    def __init__(self, vmname):
+        self.vmname = vmname
+        self.settings = OrderedDict()
+        self.forwards = OrderedDict()
+        self.controllers = OrderedDict()
+        self.attachments = OrderedDict()
+
+    def modify(self, flag, *values):
+        """
+        Set a modifyvm flag, e.g. spec.modify('--memory', 4096).
+        """
+
+        self.settings[flag] = [str(v) for v in values]
+        return self
+
+    def forward(self, name, host_port, guest_port, nic=1, host_ip='127.0.0.1'):
+        """
+        Forward host_ip:host_port to guest_port of the guest (TCP), through
+        the NAT of NIC nic.
+        """
+
+        self.forwards[name] = (nic, '%s,tcp,%s,%d,,%d' % (name, host_ip, host_port,
+                                                          guest_port))
+        return self
+
+    def storagectl(self, name, bus):
+        self.controllers[name] = bus
+        return self
+
+    def attach(self, controller, port, device, medium_type, medium):
+        self.attachments[(controller, str(port), str(device))] = (medium_type, medium)
+        return self
+
+    def key(self):
+        """
+        Return the spec as plain data, e.g. as input for a build cache key.
+        """
+
+        return {
+            'settings': list(self.settings.items()),
+            'forwards': [[name, nic, rule] for name, (nic, rule) in self.forwards.items()],
+            'controllers': list(self.controllers.items()),
+            'attachments': [list(k) + list(v) for k, v in self.attachments.items()],
+        }
+
+    def commands(self, current=None):
+        """
+        Return the VBoxManage calls needed to get from current to this spec.
+
+        current is the parsed machine readable info of the VM; None means a
+        freshly created VM, so everything is applied.
+        """
+
+        cmds = []
+
+        flags = []
+        for flag, values in self.settings.items():
+            key = flag.lstrip('-')
+            if current is not None and key in current and \
+                    _normalize(key, [current[key]]) == _normalize(key, values):
+                continue
+            flags.append(flag)
+            flags.extend(values)
+
+        rules = {}
+        if current is not None:
+            for key, value in current.items():
+                if key.startswith('Forwarding('):
+                    rules[value.split(',')[0]] = value
+        for name, (nic, rule) in self.forwards.items():
+            if rules.get(name) == rule:
+                continue
+            if name in rules:
+                # a rule can't be changed, only replaced
+                flags.extend(['--natpf%d' % nic, 'delete', name])
+            flags.extend(['--natpf%d' % nic, rule])
+        if flags:
+            cmds.append(['VBoxManage', 'modifyvm', self.vmname] + flags)
+
+        if current is None:
+            present = set()
+        else:
+            present = set(v for k, v in current.items()
+                          if k.startswith('storagecontrollername'))
+        for name, bus in self.controllers.items():
+            if name not in present:
+                cmds.append(['VBoxManage', 'storagectl', self.vmname,
+                             '--name', name, '--add', bus])
+
+        for (controller, port, device), (medium_type, medium) in self.attachments.items():
+            if current is not None:
+                attached = current.get('%s-%s-%s' % (controller, port, device))
+                if attached and os.path.realpath(attached) == os.path.realpath(medium):
+                    continue
+            cmds.append(['VBoxManage', 'storageattach', self.vmname,
+                         '--storagectl', controller, '--port', port,
+                         '--device', device, '--type', medium_type,
+                         '--medium', medium])
+
+        return cmds
+
+    def create(self, run, basefolder, ostype='Linux26_64'):
+        """
+        Create and register the VM in a single call, then apply the spec.
+        """
+
+        run(['VBoxManage', 'createvm', '--name', self.vmname, '--ostype',
+             ostype, '--basefolder', basefolder, '--register'])
+        self.apply(run, current=None)
+
+    def apply(self, run, current=False):
+        """
+        Apply the spec to the VM.
+
+        By default the current settings are read first and only the
+        differences are applied.  Pass current=None to skip that for a VM
+        that was just created.
+        """
+
+        if current is False:
+            current = showvminfo(self.vmname, run)
+        cmds = self.commands(current)
+        if not cmds:
+            logger.debug('%s already matches its spec', self.vmname)
+        for cmd in cmds:
+            run(cmd)
+        return len(cmds)
+
+
+# VM states as shown by "showvminfo --machinereadable" (VMState=...)
+RUNNING = ('running',)
+STOPPED = ('poweroff', 'aborted', 'saved')
+
+# vboxapi MachineState names whose VMState name isn't just the lowercase
+# name; the First*/Last* range markers alias real states and are left out
+API_STATES = {
+    'PoweredOff': 'poweroff',
+    'Stuck': 'gurumeditation',
+    'DeletingSnapshotOnline': 'deletingsnapshotlive',
+    'DeletingSnapshotPaused': 'deletingsnapshotlivepaused',
+}
+
+
+def api_states(values):
+    """
+    Map vboxapi MachineState values (name -> value, as returned by
+    constants.all_values('MachineState')) to VMState names.
+    """
+
+    return dict((value, API_STATES.get(name, name.lower()))
+                for name, value in values.items()
+                if not name.startswith(('First', 'Last')))
+
+
+class StateTimeout(Exception):
+    pass
+
+
+def vm_state(vmname, run):
+    """
+    Return the state of the VM, or None if it isn't registered.
+    """
+
+    return showvminfo(vmname, run).get('VMState')
+
+
+def backoff(initial=0.1, factor=1.5, maximum=2.0):
+    """
+    Poll intervals: quick at first, when state changes are most likely,
+    then slower so a long wait costs next to nothing.
+    """
+
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+def _event_source():
+    """
+    Return a VirtualBox event source if the VirtualBox Python API (vboxapi)
+    is installed, otherwise None.
+    """
+
+    try:
+        from vboxapi import VirtualBoxManager
+    except ImportError:
+        return None
+    try:
+        return _MachineStateEvents(VirtualBoxManager(None, None))
+    except Exception:
+        logger.debug('VirtualBox API not usable, polling VM state instead')
+        return None
+
+
+class _MachineStateEvents(object):
+    """
+    Block on OnMachineStateChanged events instead of polling.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.vbox = manager.getVirtualBox()
+        self.states = api_states(manager.constants.all_values('MachineState'))
+        self.source = self.vbox.eventSource
+        self.listener = self.source.createListener()
+        self.source.registerListener(
+            self.listener,
+            [manager.constants.VBoxEventType_OnMachineStateChanged], False)
+
+    def state(self, vmname):
+        try:
+            machine = self.vbox.findMachine(vmname)
+        except Exception:
+            return None
+        return self.states.get(machine.state)
+
+    def wait(self, seconds):
+        event = self.source.getEvent(self.listener, int(seconds * 1000))
+        if event is not None:
+            self.source.eventProcessed(self.listener, event)
+
+    def close(self):
+        self.source.unregisterListener(self.listener)
+
+
+def wait_for_state(vmname, states, run, timeout=120, schedule=None):
+    """
+    Wait until the VM reaches one of states, return the state reached.
+
+    Uses VirtualBox events when the VirtualBox Python API is available and
+    otherwise polls "showvminfo --machinereadable" on the backoff schedule.
+    A VM that isn't registered is in state None, so states=(None,) waits for
+    a VM to go away.  Raises StateTimeout after timeout seconds.
+    """
+
+    deadline = time.time() + timeout
+    events = _event_source()
+    if schedule is None:
+        schedule = backoff()
+
+    try:
+        while True:
+            if events is not None:
+                state = events.state(vmname)
+            else:
+                state = vm_state(vmname, run)
+            if state in states:
+                logger.debug("'%s' is %s", vmname, state)
+                return state
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise StateTimeout("'%s' still %s after %g seconds, expected %s"
+                                   % (vmname, state, timeout, ' or '.join(
+                                       str(s) for s in states)))
+            if events is not None:
+                events.wait(min(remaining, 5))
+            else:
+                time.sleep(min(remaining, next(schedule)))
+    finally:
+        if events is not None:
+            events.close()